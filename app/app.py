@@ -1,10 +1,66 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from src import routers
-from fastapi.staticfiles import StaticFiles
+from src import (
+    api, assets, efficiency, invalidation, live, metrics, navigation,
+    routers, search, timing, users, view,
+)
 from fastapi.middleware.cors import CORSMiddleware
+from config import settings
+import database
+
+logger = logging.getLogger(__name__)
+
+
+async def warm_up():
+    '''Opens the pool, fills it up to MONGO_MIN_POOL_SIZE, and loads the
+    indexes and navigation snapshot before the first request needs them.'''
+    # Only the warm-up needs indexes; WARM_UP=false never imports it.
+    from src import indexes
+    ping = lambda: database.client.admin.command('ping')
+    await ping()
+    warm_ups = [ping() for _ in range(settings.mongo_min_pool_size - 1)]
+    if settings.ensure_indexes:
+        warm_ups.append(indexes.apply_indexes())
+    warm_ups.append(navigation.get_snapshot())
+    await asyncio.gather(*warm_ups)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    # Warns about a missing SESSION_SECRET now, not at the first login.
+    users.session_key()
+    preloads = []
+    if settings.precompile_templates:
+        preloads.append(asyncio.to_thread(view.precompile))
+    if settings.warm_up:
+        preloads.append(warm_up())
+    await asyncio.gather(*preloads)
+    efficiency.start()
+    search.start()
+    invalidation.start()
+    live.start()
+    metrics.start()
+    logger.info(
+        'Started in %.1f ms', (time.perf_counter() - started) * 1000
+    )
+    try:
+        yield
+    finally:
+        await metrics.stop()
+        await live.stop()
+        await invalidation.stop()
+        await efficiency.stop()
+        await search.stop()
+        users.shutdown_hash_executor()
+        database.close()
 
 
 app = FastAPI()
+# FastAPI 0.92 does not take lifespan= yet; its router does.
+app.router.lifespan_context = lifespan
 
 origins = ["*"]
 app.add_middleware(
@@ -14,7 +70,10 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(timing.TimingMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
 app.include_router(routers.router)
+app.include_router(api.router)
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
\ No newline at end of file
+app.mount("/static", assets.AssetFiles(directory="static"), name="static")
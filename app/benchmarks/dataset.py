@@ -0,0 +1,191 @@
+'''
+Deterministic synthetic dataset of users, projects and activities.
+
+The same --activities and --seed always produce the same documents,
+ObjectIds included, so results from different commits are comparable.
+Every generated user has the password PASSWORD; the project manager logs
+in as bench_pm, translators as bench_translator_<n>.
+
+    python -m benchmarks.dataset --activities 100000 --seed 1 --drop
+
+Everything is loaded into its own database, BENCHMARK_DATABASE unless
+--database says otherwise, and never into the app's or the tests'.
+Loading refuses to touch a database that already has users unless --drop
+is given, in which case its users, projects and activities collections
+are dropped first.
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import time
+
+from bson.objectid import ObjectId
+
+import database
+from src import indexes, rollups, users
+
+PASSWORD = 'benchmark'
+BENCHMARK_DATABASE = 'benchmark'
+PM_LOGIN = 'bench_pm'
+
+ACTIVITIES_PER_PROJECT = 50
+ACTIVITIES_PER_TRANSLATOR = 100
+TRANSLATORS_PER_EDITOR = 5
+FINISHED_PROJECT_SHARE = 0.3
+BATCH_SIZE = 5000
+START = datetime.datetime(2024, 1, 1)
+
+WORDS = [
+    'chapter', 'preface', 'appendix', 'glossary', 'manual', 'contract',
+    'subtitles', 'brochure', 'report', 'letters', 'catalogue', 'guide',
+    'interface', 'release', 'notes', 'article', 'patent', 'survey',
+]
+
+
+class Scale:
+    def __init__(self, activities: int):
+        self.activities = activities
+        self.projects = max(1, activities // ACTIVITIES_PER_PROJECT)
+        self.translators = max(1, activities // ACTIVITIES_PER_TRANSLATOR)
+        self.chief_editors = max(1, self.translators // TRANSLATORS_PER_EDITOR)
+
+    def as_dict(self) -> dict:
+        return {
+            'activities': self.activities, 'projects': self.projects,
+            'translators': self.translators,
+            'chief_editors': self.chief_editors,
+        }
+
+
+def use_benchmark_database(name: str = BENCHMARK_DATABASE): #TESTED
+    if name in (database.APP_DATABASE, database.TEST_DATABASE):
+        raise SystemExit(f'Refusing to run benchmarks against {name!r}')
+    database.use_database(name)
+
+def object_id(rng: random.Random) -> ObjectId:
+    return ObjectId(rng.randbytes(12))
+
+def generate_users(scale: Scale, rng: random.Random, password: str) -> list:
+    def user(login: str, username: str, role: str) -> dict:
+        return {
+            '_id': object_id(rng), 'login': login, 'username': username,
+            'password': password, 'role': role, 'status': None,
+            'efficiency': 0.0, 'is_active': True,
+        }
+    return (
+        [user(PM_LOGIN, 'Bench Manager', 'project_manager')]
+        + [
+            user(f'bench_editor_{n}', f'Editor {n}', 'chief_editor')
+            for n in range(scale.chief_editors)
+        ]
+        + [
+            user(f'bench_translator_{n}', f'Translator {n}', 'translator')
+            for n in range(scale.translators)
+        ]
+    )
+
+def generate_projects(scale: Scale, rng: random.Random, editors: list) -> list:
+    return [
+        {
+            '_id': object_id(rng),
+            'project_name': f"{' '.join(rng.choices(WORDS, k=2))} {n}",
+            'editor': str(rng.choice(editors)['_id']),
+            'deadline': START + datetime.timedelta(days=rng.randint(30, 720)),
+            'project_status': (
+                'finished' if rng.random() < FINISHED_PROJECT_SHARE
+                else 'created'
+            ),
+        }
+        for n in range(scale.projects)
+    ]
+
+def generate_activities(
+    scale: Scale, rng: random.Random, projects: list, translators: list,
+):
+    '''Yields activity documents lazily, so 1M activities never sit in
+    memory at once.'''
+    for n in range(scale.activities):
+        project = projects[n % len(projects)]
+        finished = (
+            project['project_status'] == 'finished' or rng.random() < 0.2
+        )
+        yield {
+            '_id': object_id(rng),
+            'activity_name': f"{rng.choice(WORDS)} {n}",
+            'project_name': project['project_name'],
+            'project_id': project['_id'],
+            'translators': str(rng.choice(translators)['_id']),
+            'editor': project['editor'],
+            'deadline': project['deadline'] - datetime.timedelta(
+                days=rng.randint(0, 29)
+            ),
+            'project_status': 'in work',
+            'completeness': 1.0 if finished else round(rng.random(), 2),
+            'status': 'finished' if finished else 'created',
+        }
+
+def generate(activities: int, seed: int, password: str = ''):
+    '''Returns (scale, users, projects, activity iterator).'''
+    scale = Scale(activities)
+    rng = random.Random(seed)
+    all_users = generate_users(scale, rng, password)
+    editors = [user for user in all_users if user['role'] == 'chief_editor']
+    translators = [user for user in all_users if user['role'] == 'translator']
+    projects = generate_projects(scale, rng, editors)
+    return (
+        scale, all_users, projects,
+        generate_activities(scale, rng, projects, translators),
+    )
+
+async def insert_batched(collection, documents):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) == BATCH_SIZE:
+            await collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await collection.insert_many(batch, ordered=False)
+
+async def load(
+    activities: int, seed: int, drop: bool,
+    database_name: str = BENCHMARK_DATABASE,
+) -> dict:
+    use_benchmark_database(database_name)
+    if not drop and await database.users_collection.estimated_document_count():
+        raise SystemExit('The database already has users; pass --drop')
+    started = time.perf_counter()
+    for collection in (
+        database.users_collection, database.projects_collection,
+        database.activities_collection,
+    ):
+        await collection.drop()
+    # One hash shared by every user: PBKDF2 per user would dominate.
+    salt = 'benchmarksalt'
+    password = f'{salt}${users.hash_password(PASSWORD, salt)}'
+    scale, all_users, projects, activity_documents = generate(
+        activities, seed, password
+    )
+    await database.users_collection.insert_many(all_users)
+    await insert_batched(database.projects_collection, projects)
+    await insert_batched(database.activities_collection, activity_documents)
+    await indexes.apply_indexes()
+    await rollups.rebuild_rollups()
+    return {
+        'database': database_name, 'seed': seed, **scale.as_dict(),
+        'load_seconds': round(time.perf_counter() - started, 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--activities', type=int, default=10_000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--drop', action='store_true')
+    parser.add_argument('--database', default=BENCHMARK_DATABASE)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(load(
+        args.activities, args.seed, args.drop, args.database
+    )), indent=2))
@@ -0,0 +1,100 @@
+'''
+p99 latency of an unrelated route while logins are hashing passwords.
+
+Runs the same workload twice against an in-process ASGI app: once with
+the blocking users.validate_password and once with
+users.validate_password_async, and prints the results as JSON.
+
+    python -m benchmarks.hashing --logins 8 --pings 200
+'''
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from fastapi import FastAPI
+from httpx import AsyncClient
+
+from src import users
+
+PASSWORD = 'manager_project'
+HASHED_PASSWORD = (
+    'VgGdZKkexOUy$e1f631580bc78759077f5398a4b4661c846e0f3ddea4ae992b51991fc6ae95d5'
+)
+
+PING_INTERVAL = 0.01
+
+bench_app = FastAPI()
+
+
+@bench_app.get('/ping')
+async def ping():
+    return {'ok': True}
+
+@bench_app.post('/login_sync')
+async def login_sync():
+    return {'ok': users.validate_password(PASSWORD, HASHED_PASSWORD)}
+
+@bench_app.post('/login_async')
+async def login_async():
+    return {
+        'ok': await users.validate_password_async(PASSWORD, HASHED_PASSWORD)
+    }
+
+
+def percentile(samples: list, q: float) -> float:
+    samples = sorted(samples)
+    index = min(len(samples) - 1, round(q * (len(samples) - 1)))
+    return samples[index]
+
+async def run(login_route: str, logins: int, pings: int) -> dict:
+    latencies = []
+    async with AsyncClient(app=bench_app, base_url='http://bench') as ac:
+        async def login_loop(stop: asyncio.Event):
+            while not stop.is_set():
+                await ac.post(login_route)
+                await asyncio.sleep(0)
+
+        async def ping_loop():
+            # Latency is measured from the moment each ping was due, so
+            # time spent waiting for a blocked event loop is counted too.
+            first = time.perf_counter()
+            for i in range(pings):
+                due = first + i * PING_INTERVAL
+                await asyncio.sleep(max(0, due - time.perf_counter()))
+                await ac.get('/ping')
+                latencies.append((time.perf_counter() - due) * 1000)
+
+        stop = asyncio.Event()
+        workers = [
+            asyncio.create_task(login_loop(stop)) for _ in range(logins)
+        ]
+        await ping_loop()
+        stop.set()
+        await asyncio.gather(*workers)
+    return {
+        'route': login_route,
+        'concurrent_logins': logins,
+        'pings': pings,
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+    }
+
+async def main(logins: int, pings: int):
+    users.get_hash_executor()
+    results = [
+        await run('/login_sync', logins, pings),
+        await run('/login_async', logins, pings),
+    ]
+    users.shutdown_hash_executor()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=8)
+    parser.add_argument('--pings', type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.logins, args.pings))
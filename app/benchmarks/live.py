@@ -0,0 +1,87 @@
+'''
+Fan-out cost of the live dashboard stream.
+
+Opens --connections streams (src.live.stream) spread over --users users,
+then publishes --events activity writes on the change feed, each for a
+random translator and editor, and measures how long the dispatcher takes
+to route each one and how long until a connection's stream yields it.
+Results are printed as JSON, in milliseconds. Each stream reads its
+user's counter from live_versions_collection when it opens, so the
+database must be reachable; the counters go to BENCHMARK_DATABASE.
+
+    python -m benchmarks.live --connections 5000 --users 2000
+'''
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from bson.objectid import ObjectId
+
+from benchmarks.dataset import BENCHMARK_DATABASE, use_benchmark_database
+from benchmarks.hashing import percentile
+from src import live
+from src.changefeed import feed
+
+
+async def consume(user_id: str, sent: dict, delays: list):
+    async for message in live.stream(user_id, keepalive=3600):
+        if message.startswith(b'event: activity'):
+            delays.append((time.perf_counter() - sent['at']) * 1000)
+
+async def run(connections: int, users: int, events: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    user_ids = [str(ObjectId()) for _ in range(users)]
+    sent, delays = {}, []
+    readers = [
+        asyncio.create_task(consume(user_ids[index % users], sent, delays))
+        for index in range(connections)
+    ]
+    live.start()
+    await asyncio.sleep(0.1)
+    dispatch = []
+    for _ in range(events):
+        activity = {
+            '_id': ObjectId(), 'activity_name': 'Chapter', 'status': 'created',
+            'translators': rng.choice(user_ids),
+            'editor': rng.choice(user_ids),
+        }
+        sent['at'] = time.perf_counter()
+        feed.publish(
+            {'operation': 'insert', 'activity': activity, 'before': None}
+        )
+        started = time.perf_counter()
+        # Let the dispatcher and every reader run once.
+        while not live.settled():
+            await asyncio.sleep(0)
+        dispatch.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(0)
+    for reader in readers:
+        reader.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    await live.stop()
+    return {
+        'connections': connections,
+        'users': users,
+        'events': events,
+        'dispatch_p50_ms': round(percentile(dispatch, 0.5), 3),
+        'dispatch_p99_ms': round(percentile(dispatch, 0.99), 3),
+        'delivery_p50_ms': round(percentile(delays, 0.5), 3),
+        'delivery_p99_ms': round(percentile(delays, 0.99), 3),
+        'delivered': len(delays),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--events', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database', default=BENCHMARK_DATABASE)
+    args = parser.parse_args()
+    use_benchmark_database(args.database)
+    print(json.dumps(asyncio.run(run(
+        args.connections, args.users, args.events, args.seed
+    )), indent=2))
@@ -0,0 +1,164 @@
+'''
+Per-route latency and throughput of the ASGI app.
+
+Drives app.app in process with httpx.AsyncClient against the database
+loaded by benchmarks.dataset (--database, BENCHMARK_DATABASE by default),
+and prints p50/p95/p99 latency and throughput per route as JSON. Save
+the output of two commits and compare.
+
+    python -m benchmarks.dataset --activities 100000 --drop
+    python -m benchmarks.runner --requests 500 --concurrency 16 \
+        --output before.json
+'''
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import time
+
+from httpx import AsyncClient
+
+import database
+from app import app
+from benchmarks.dataset import (
+    BENCHMARK_DATABASE, PASSWORD, PM_LOGIN, use_benchmark_database,
+)
+from benchmarks.hashing import percentile
+
+BASE_URL = 'http://localhost:8000'
+LOGIN_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+SAMPLE_SIZE = 50
+PAGES = 5
+
+
+def login_form(login: str) -> dict:
+    return {'username': login, 'password': PASSWORD}
+
+async def signed_in_client(login: str) -> AsyncClient:
+    client = AsyncClient(app=app, base_url=BASE_URL)
+    response = await client.post(
+        '/login_form', headers=LOGIN_HEADERS, data=login_form(login)
+    )
+    if 'Authorization' not in response.cookies:
+        await client.aclose()
+        raise SystemExit(f'Could not log in as {login}; load a dataset first')
+    return client
+
+async def sample_ids(collection, query: dict) -> list:
+    cursor = collection.find(query, {'_id': 1}).sort('_id', 1)
+    documents = await cursor.to_list(SAMPLE_SIZE)
+    return [str(document['_id']) for document in documents]
+
+async def measure(requests: int, concurrency: int, send) -> dict:
+    '''send(number) performs one request and returns its response.'''
+    latencies = []
+    errors = 0
+    numbers = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for number in numbers:
+            started = time.perf_counter()
+            response = await send(number)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.5), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'throughput_rps': round(requests / elapsed, 1),
+    }
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(requests: int, concurrency: int, warmup: int) -> dict:
+    async with app.router.lifespan_context(app):
+        return await measure_routes(requests, concurrency, warmup)
+
+async def measure_routes(requests: int, concurrency: int, warmup: int) -> dict:
+    clients = []
+    try:
+        pm = await signed_in_client(PM_LOGIN)
+        clients.append(pm)
+        cursor = database.users_collection.find(
+            {'role': 'translator'}, {'login': 1}
+        ).sort('login', 1)
+        translators = []
+        for user in await cursor.to_list(8):
+            translators.append(await signed_in_client(user['login']))
+        clients.extend(translators)
+        anonymous = AsyncClient(app=app, base_url=BASE_URL)
+        clients.append(anonymous)
+        project_ids = await sample_ids(database.projects_collection, {})
+
+        routes = {
+            'GET /projects': lambda number: pm.get(
+                '/projects', params={'page': number % PAGES + 1}
+            ),
+            'GET /project/{id}': lambda number: pm.get(
+                f'/project/{project_ids[number % len(project_ids)]}'
+            ),
+            'GET /me': lambda number: translators[
+                number % len(translators)
+            ].get('/me'),
+            'POST /login_form': lambda number: anonymous.post(
+                '/login_form', headers=LOGIN_HEADERS,
+                data=login_form(PM_LOGIN),
+            ),
+        }
+        results = {}
+        for route, send in routes.items():
+            if warmup:
+                await measure(warmup, min(concurrency, warmup), send)
+            results[route] = await measure(requests, concurrency, send)
+        dataset = {}
+        for name, collection in (
+            ('users', database.users_collection),
+            ('projects', database.projects_collection),
+            ('activities', database.activities_collection),
+        ):
+            dataset[name] = await collection.estimated_document_count()
+        return {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'dataset': dataset,
+            'routes': results,
+        }
+    finally:
+        for client in clients:
+            await client.aclose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--output')
+    parser.add_argument('--database', default=BENCHMARK_DATABASE)
+    args = parser.parse_args()
+    use_benchmark_database(args.database)
+    report = json.dumps(
+        asyncio.run(run(args.requests, args.concurrency, args.warmup)),
+        indent=2,
+    )
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(report + '\n')
+    print(report)
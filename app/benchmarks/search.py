@@ -0,0 +1,53 @@
+'''
+Lookup latency of the in-process search index. The target is a p99
+under 10 ms at 100k documents.
+
+    python -m benchmarks.search --documents 100000
+'''
+import argparse
+import json
+import random
+import time
+
+from benchmarks.hashing import percentile
+from src import search
+
+WORDS = [
+    'chapter', 'preface', 'appendix', 'glossary', 'war', 'peace', 'river',
+    'winter', 'garden', 'letters', 'journey', 'stone', 'night', 'city',
+    'harbor', 'mountain', 'silver', 'shadow', 'orchard', 'lantern',
+]
+
+
+def main(documents: int, queries: int, seed: int):
+    rng = random.Random(seed)
+    index = search.SearchIndex()
+    started = time.perf_counter()
+    for number in range(documents):
+        title = ' '.join(rng.choices(WORDS, k=3)) + f' {number}'
+        index.add(search.ACTIVITY, str(number), title, None)
+    build_seconds = time.perf_counter() - started
+    latencies = []
+    for _ in range(queries):
+        query = ' '.join(
+            rng.choice(WORDS)[:rng.randint(2, 6)] for _ in range(2)
+        )
+        started = time.perf_counter()
+        index.search(query, limit=20)
+        latencies.append((time.perf_counter() - started) * 1000)
+    print(json.dumps({
+        'documents': documents,
+        'build_seconds': round(build_seconds, 2),
+        'queries': queries,
+        'p50_ms': round(percentile(latencies, 0.5), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, default=100_000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    main(args.documents, args.queries, args.seed)
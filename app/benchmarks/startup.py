@@ -0,0 +1,90 @@
+'''
+Time from process start to the first served request.
+
+Starts uvicorn with app:app in a fresh process several times and records
+when the first GET /login (which needs no database) gets its response.
+Environment variables given with --env are passed to the server, e.g.
+--env WARM_UP=false to compare against a cold start.
+
+    python -m benchmarks.startup --runs 5
+'''
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+POLL_INTERVAL = 0.01
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def first_response(env: dict, timeout: float) -> dict:
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [
+            sys.executable, '-m', 'uvicorn', 'app:app',
+            '--host', '127.0.0.1', '--port', str(port),
+            '--log-level', 'warning',
+        ],
+        env={**os.environ, **env},
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise SystemExit(f'server exited with {server.returncode}')
+            try:
+                request_started = time.perf_counter()
+                response = httpx.get(f'http://127.0.0.1:{port}/login')
+            except httpx.TransportError:
+                time.sleep(POLL_INTERVAL)
+                continue
+            finished = time.perf_counter()
+            return {
+                'status': response.status_code,
+                'ready_seconds': round(request_started - started, 3),
+                'first_request_ms': round(
+                    (finished - request_started) * 1000, 3
+                ),
+                'total_seconds': round(finished - started, 3),
+            }
+        raise SystemExit(f'no response within {timeout}s')
+    finally:
+        server.terminate()
+        server.wait()
+
+def main(runs: int, env: dict, timeout: float):
+    samples = [first_response(env, timeout) for _ in range(runs)]
+    print(json.dumps({
+        'runs': runs,
+        'env': env,
+        'median_total_seconds': statistics.median(
+            sample['total_seconds'] for sample in samples
+        ),
+        'median_first_request_ms': statistics.median(
+            sample['first_request_ms'] for sample in samples
+        ),
+        'samples': samples,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--env', action='append', default=[])
+    args = parser.parse_args()
+    main(
+        args.runs,
+        dict(item.split('=', 1) for item in args.env),
+        args.timeout,
+    )
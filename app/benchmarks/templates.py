@@ -0,0 +1,107 @@
+'''
+First-request and steady-state render times for every page template.
+
+Each template is rendered once with an empty bytecode cache (a cold
+worker), once with a warm bytecode cache but a fresh environment (a new
+worker after the first one), and then repeatedly from the in-memory cache.
+Results are printed as JSON, in milliseconds.
+
+    python -m benchmarks.templates --renders 200
+'''
+import argparse
+import json
+import statistics
+import tempfile
+import time
+
+from jinja2 import (
+    ChainableUndefined, Environment, FileSystemBytecodeCache, FileSystemLoader
+)
+
+from benchmarks.hashing import percentile
+from src import assets
+
+DIRECTORY = 'templates/'
+ROWS = 50
+
+
+class Sample:
+    # Stands in for any document field: every lookup and call succeeds.
+    def __getattr__(self, name):
+        return self
+
+    def __getitem__(self, key):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return 'sample'
+
+    def __str__(self):
+        return 'sample'
+
+    def __iter__(self):
+        return iter(())
+
+    def __mul__(self, other):
+        return 0
+
+    __rmul__ = __mul__
+
+
+CONTEXT = {
+    name: [Sample() for _ in range(ROWS)]
+    for name in (
+        'activities', 'project_activities', 'chief_editors_list',
+        'all_projects', 'projects', 'project_translators', 'translators_list',
+    )
+}
+CONTEXT['num_of_pages'] = range(1, 6)
+CONTEXT['page_cursors'] = [None, *(Sample() for _ in range(4))]
+CONTEXT['current_page'] = 1
+CONTEXT['request'] = Sample()
+
+
+def environment(cache_dir: str) -> Environment:
+    env = Environment(
+        loader=FileSystemLoader(DIRECTORY),
+        autoescape=True,
+        bytecode_cache=FileSystemBytecodeCache(cache_dir),
+        auto_reload=False,
+        undefined=ChainableUndefined,
+    )
+    env.globals['static_url'] = assets.static_url
+    return env
+
+def first_render(cache_dir: str, name: str) -> float:
+    env = environment(cache_dir)
+    started = time.perf_counter()
+    env.get_template(name).render(CONTEXT)
+    return (time.perf_counter() - started) * 1000
+
+def run(renders: int) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        names = environment(cache_dir).list_templates(extensions=['html'])
+        for name in names:
+            cold = first_render(cache_dir, name)
+            warm = first_render(cache_dir, name)
+            template = environment(cache_dir).get_template(name)
+            samples = []
+            for _ in range(renders):
+                started = time.perf_counter()
+                template.render(CONTEXT)
+                samples.append((time.perf_counter() - started) * 1000)
+            results[name] = {
+                'first_render_cold_ms': round(cold, 3),
+                'first_render_bytecode_ms': round(warm, 3),
+                'steady_p50_ms': round(statistics.median(samples), 3),
+                'steady_p99_ms': round(percentile(samples, 0.99), 3),
+            }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--renders', type=int, default=200)
+    args = parser.parse_args()
+    print(json.dumps(run(args.renders), indent=2))
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pydantic import BaseSettings
 
 
@@ -6,10 +7,71 @@ class Settings(BaseSettings):
     mongo_initdb_root_password: str
     mongo_initdb_database: str
 
+    mongo_uri: str = ''
+    mongo_host: str = 'mongo'
+    mongo_port: int = 27017
+    mongo_max_pool_size: int = 100
+    mongo_min_pool_size: int = 0
+    mongo_max_idle_time_ms: int = 0
+    mongo_wait_queue_timeout_ms: int = 0
+    mongo_connect_timeout_ms: int = 20000
+    mongo_server_selection_timeout_ms: int = 30000
+    mongo_socket_timeout_ms: int = 0
+    mongo_compressors: str = 'zstd,snappy,zlib'
+    mongo_read_concern: str = 'local'
+    mongo_list_read_preference: str = 'secondaryPreferred'
+    mongo_list_max_staleness: int = -1
+
+    hash_executor: str = 'process'
+    hash_workers: int = 2
+
+    session_secret: str = ''
+    session_ttl: int = 86400
+    user_cache_size: int = 1024
+    user_cache_ttl: float = 60.0
+
+    ensure_indexes: bool = True
+    navigation_ttl: float = 30.0
+    page_piece_timeout: float = 10.0
+    efficiency_target_per_week: float = 5.0
+    efficiency_rescore_interval: float = 3600.0
+    import_batch_size: int = 500
+    import_max_errors: int = 1000
+    import_max_line_length: int = 65536
+    export_batch_size: int = 1000
+    export_name_cache_size: int = 10000
+
+    template_cache_dir: str = ''
+    template_auto_reload: bool = True
+    precompile_templates: bool = True
+
+    timing_sample_rate: float = 1.0
+    loop_lag_interval: float = 0.5
+    warm_up: bool = True
+
+    invalidation_bus: str = 'auto'
+    invalidation_bus_size: int = 1048576
+    invalidation_bus_max_events: int = 10000
+
+    live_queue_size: int = 100
+    live_keepalive: float = 15.0
+    live_max_age: float = 3600.0
+
     class Config:
         env_file = "../.env"
-        
 
 
-settings = Settings()
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
+
+
+class LazySettings:
+    '''Reads the environment and .env on first use rather than when
+    config is imported.'''
+
+    def __getattr__(self, name):
+        return getattr(get_settings(), name)
+
 
+settings = LazySettings()
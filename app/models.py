@@ -1,10 +1,13 @@
 from pydantic import BaseModel
 from datetime import datetime
 
+ACTIVITY_STATUSES = ('created', 'finished')
+
 class ProjectCreate(BaseModel):
     project_name: str
-    deadline: str
+    deadline: datetime
     editor: str
+    project_status: str = 'created'
 
 class UserCreate(BaseModel):
     login: str
@@ -38,12 +41,14 @@ class User(UserBase):
 class ActivityModel(BaseModel):
     activity_name: str
     project_name: str
+    project_id: str | None
     translators: str | None
     editor: str
     deadline: datetime
     project_status: str
     completeness: float
     status: str
+    finished_at: datetime | None = None
 
 class LoginForm(BaseModel):
     login: str
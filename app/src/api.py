@@ -0,0 +1,141 @@
+from bson.objectid import ObjectId
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import ORJSONResponse
+from src import users
+
+
+async def get_api_user(request: Request):
+    token = request.cookies.get('Authorization')
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    session = users.decode_session_token(token) if token else None
+    user = await users.get_cached_user(session['id']) if session else None
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail='Not authenticated',
+            headers={'WWW-Authenticate': 'Bearer'}
+        )
+    return user
+
+def require_role(*roles: str):
+    async def check_role(user: dict = Depends(get_api_user)):
+        if user['role'] not in roles:
+            raise HTTPException(status_code=403, detail='Not allowed')
+        return user
+    return Depends(check_role)
+
+
+router = APIRouter(
+    prefix='/api/v1',
+    default_response_class=ORJSONResponse,
+    dependencies=[Depends(get_api_user)],
+)
+
+Limit = Query(50, ge=1, le=500)
+# The same pages are only shown to project managers in the HTML app.
+ProjectManager = require_role('project_manager')
+
+
+def parse_fields(fields: str | None) -> list | None:
+    return fields.split(',') if fields else None
+
+def with_keys(wanted: list | None, *keys) -> list | None:
+    return None if wanted is None else [*wanted, *keys]
+
+def select_fields(items: list, fields: str | None) -> list: #TESTED
+    wanted = parse_fields(fields)
+    return [item.as_dict(wanted) for item in items]
+
+def page(items: list, limit: int, fields: str | None, next_cursor) -> dict:
+    return {
+        'items': select_fields(items, fields),
+        'next_cursor': next_cursor if len(items) == limit else None,
+    }
+
+def check_object_id(object_id: str):
+    if not ObjectId.is_valid(object_id):
+        raise HTTPException(status_code=404, detail='Not found')
+
+def check_cursor(cursor: str | None): #TESTED
+    if cursor is not None and not ObjectId.is_valid(cursor):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+@router.get('/projects', dependencies=[ProjectManager])
+async def list_projects(
+    status: str = 'created', limit: int = Limit, cursor: str = None,
+    fields: str = None,
+):
+    if cursor is not None:
+        try:
+            users.decode_project_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+    projects = await users.get_projects(
+        status, limit=limit, cursor=cursor,
+        fields=with_keys(parse_fields(fields), 'id', 'deadline'),
+    )
+    next_cursor = projects and users.encode_project_cursor(projects[-1])
+    return page(projects, limit, fields, next_cursor)
+
+@router.get('/projects/{project_id}', dependencies=[ProjectManager])
+async def read_project(project_id: str, fields: str = None):
+    check_object_id(project_id)
+    project = await users.get_project_record(project_id, parse_fields(fields))
+    if project is None:
+        raise HTTPException(status_code=404, detail='Not found')
+    return select_fields([project], fields)[0]
+
+@router.get('/projects/{project_id}/activities', dependencies=[ProjectManager])
+async def list_project_activities(
+    project_id: str, limit: int = Limit, cursor: str = None,
+    fields: str = None,
+):
+    check_object_id(project_id)
+    check_cursor(cursor)
+    activities = await users.get_project_activities(
+        project_id, limit=limit, after=cursor,
+        fields=with_keys(parse_fields(fields), '_id'),
+    )
+    next_cursor = activities and activities[-1]['_id']
+    return page(activities, limit, fields, next_cursor)
+
+@router.get('/users', dependencies=[ProjectManager])
+async def list_users(
+    role: str = None, limit: int = Limit, cursor: str = None,
+    fields: str = None,
+):
+    check_cursor(cursor)
+    result = await users.get_users(
+        role, limit=limit, after=cursor,
+        fields=with_keys(parse_fields(fields), 'id'),
+    )
+    next_cursor = result and result[-1]['id']
+    return page(result, limit, fields, next_cursor)
+
+@router.get('/users/{user_id}', dependencies=[ProjectManager])
+async def read_user(user_id: str, fields: str = None):
+    user = await users.UserLoader().load(user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail='Not found')
+    return select_fields([user], fields)[0]
+
+@router.get('/users/{user_id}/activities')
+async def list_user_activities(
+    user_id: str, role: str = Query('translator', regex='^(translator|editor)$'),
+    limit: int = Limit, cursor: str = None, fields: str = None,
+    user: dict = Depends(get_api_user),
+):
+    # Like /me and /translator/{id}: your own, or anyone's for managers.
+    if user['role'] != 'project_manager' and str(user['_id']) != user_id:
+        raise HTTPException(status_code=403, detail='Not allowed')
+    check_object_id(user_id)
+    check_cursor(cursor)
+    activities = await users.get_user_activities(
+        user_id, 'translators' if role == 'translator' else 'editor',
+        with_keys(parse_fields(fields), '_id'), limit=limit, after=cursor,
+    )
+    next_cursor = activities and activities[-1]['_id']
+    return page(activities, limit, fields, next_cursor)
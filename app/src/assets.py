@@ -0,0 +1,206 @@
+'''
+Fingerprinted, precompressed static assets.
+
+The build step copies every file under static/ to static/dist/ with a
+content hash in its name, writes gzip (and, when the brotli package is
+installed, brotli) variants next to compressible files, and records the
+mapping in static/dist/manifest.json:
+
+    python -m src.assets
+
+Stylesheets are hashed last, after their url() references to other assets
+have been rewritten to the hashed names, since dist/ holds no unhashed
+copies for them to resolve to.
+
+Templates link assets through static_url(), which falls back to the plain
+file when the manifest has not been built. AssetFiles serves the hashed
+files with immutable cache headers and picks the smallest precompressed
+variant the client accepts.
+'''
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+STATIC_DIR = 'static'
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+URL_PREFIX = '/static'
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.html', '.json', '.txt', '.map'}
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+CSS_URL = re.compile(rb'''url\(\s*(['"]?)([^'")]+?)\1\s*\)''')
+# Scheme (data:, https:), protocol-relative, root-relative or fragment.
+ABSOLUTE_URL = re.compile(r'^(?:[a-z][a-z0-9+.-]*:|/|#)', re.IGNORECASE)
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+_manifest = None
+
+
+def fingerprint(name: str, content: bytes) -> str: #TESTED
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    stem, extension = os.path.splitext(name)
+    return f'{stem}.{digest}{extension}'
+
+def compressed_variants(content: bytes) -> dict: #TESTED
+    variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    # Only the build step needs brotli, so it is not imported with the app.
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        variants['.br'] = brotli.compress(content)
+    # A variant that does not save anything is not worth serving.
+    return {
+        suffix: data for suffix, data in variants.items()
+        if len(data) < len(content)
+    }
+
+def rewrite_css_urls(name: str, content: bytes, manifest: dict) -> bytes: #TESTED
+    '''Points the relative url() references of the stylesheet name at
+    their hashed files in manifest. Other references are left alone.'''
+    directory = posixpath.dirname(name)
+    # The stylesheet is written to the same directory under dist/.
+    hashed_directory = posixpath.join(DIST, directory)
+
+    def replace(match):
+        reference = match.group(2).decode()
+        path = re.split('[?#]', reference, 1)[0]
+        if not path or ABSOLUTE_URL.match(path):
+            return match.group(0)
+        target = manifest.get(posixpath.normpath(posixpath.join(directory, path)))
+        if target is None:
+            return match.group(0)
+        relative = posixpath.relpath(target, hashed_directory)
+        quote = match.group(1)
+        return b'url(%s%s%s)' % (
+            quote, (relative + reference[len(path):]).encode(), quote
+        )
+
+    return CSS_URL.sub(replace, content)
+
+def build(static_dir: str = STATIC_DIR) -> dict: #TESTED
+    dist = os.path.join(static_dir, DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+    os.makedirs(dist)
+    sources = []
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(
+            directory for directory in dirs
+            if os.path.join(root, directory) != dist
+        )
+        for file_name in sorted(files):
+            source = os.path.join(root, file_name)
+            sources.append(
+                (os.path.relpath(source, static_dir).replace(os.sep, '/'), source)
+            )
+    # Stylesheets last, so the files they reference are already hashed.
+    sources.sort(key=lambda item: item[0].endswith('.css'))
+    manifest = {}
+    for name, source in sources:
+        with open(source, 'rb') as file:
+            content = file.read()
+        if name.endswith('.css'):
+            content = rewrite_css_urls(name, content, manifest)
+        hashed = fingerprint(name, content)
+        target = os.path.join(dist, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as file:
+            file.write(content)
+        if os.path.splitext(name)[1] in COMPRESSIBLE:
+            for suffix, data in compressed_variants(content).items():
+                with open(target + suffix, 'wb') as file:
+                    file.write(data)
+        manifest[name] = f'{DIST}/{hashed}'
+    with open(os.path.join(dist, MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+def load_manifest(static_dir: str = STATIC_DIR) -> dict:
+    try:
+        with open(os.path.join(static_dir, DIST, MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def static_url(name: str) -> str: #TESTED
+    global _manifest
+    if _manifest is None:
+        _manifest = load_manifest()
+    return f'{URL_PREFIX}/{_manifest.get(name, name)}'
+
+def accepted_encodings(accept_encoding: str) -> set: #TESTED
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class AssetFiles(StaticFiles):
+    '''StaticFiles that serves the fingerprinted files under dist/ as
+    immutable, from a precompressed variant when the client accepts one.
+    Everything else is revalidated on each use.'''
+
+    def file_response(
+        self, full_path, stat_result, scope, status_code: int = 200,
+    ):
+        request_headers = Headers(scope=scope)
+        dist = os.path.join(os.path.realpath(self.directory), DIST, '')
+        if not os.path.realpath(full_path).startswith(dist):
+            response = FileResponse(
+                full_path, status_code=status_code, stat_result=stat_result,
+                method=scope['method'],
+                headers={'Cache-Control': REVALIDATE},
+            )
+        else:
+            response = self._variant_response(
+                full_path, stat_result, scope, status_code,
+                accepted_encodings(request_headers.get('accept-encoding', '')),
+            )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    def _variant_response(
+        self, full_path, stat_result, scope, status_code, accepted,
+    ):
+        headers = {'Cache-Control': IMMUTABLE, 'Vary': 'Accept-Encoding'}
+        media_type = mimetypes.guess_type(str(full_path))[0] or 'text/plain'
+        for encoding, suffix in ENCODINGS:
+            variant = f'{full_path}{suffix}'
+            if encoding in accepted and os.path.isfile(variant):
+                return FileResponse(
+                    variant, status_code=status_code, method=scope['method'],
+                    media_type=media_type,
+                    headers={**headers, 'Content-Encoding': encoding},
+                )
+        return FileResponse(
+            full_path, status_code=status_code, stat_result=stat_result,
+            method=scope['method'], media_type=media_type, headers=headers,
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--static-dir', default=STATIC_DIR)
+    args = parser.parse_args()
+    manifest = build(args.static_dir)
+    print(f'{len(manifest)} assets fingerprinted into {args.static_dir}/{DIST}')
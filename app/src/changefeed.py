@@ -0,0 +1,50 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityFeed:
+    '''In-process fan-out of activity writes.
+
+    The write functions in src/users.py publish one event per write:
+    {'operation': 'insert' | 'update', 'activity': <document after the
+    write>, 'before': <document before the write, or None>}. Each
+    subscriber gets its own bounded queue, so a slow consumer drops its
+    own events instead of slowing writers down; missed() tells it how
+    many it lost, so it can rebuild what it derives from them.
+    '''
+
+    def __init__(self, maxsize: int = 1000):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._subscribers = {}
+
+    def publish(self, event: dict):
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                self._subscribers[queue] += 1
+                logger.warning(
+                    'activity feed subscriber is full, event dropped'
+                )
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(self.maxsize)
+        self._subscribers[queue] = 0
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.pop(queue, None)
+
+    def missed(self, queue: asyncio.Queue) -> int: #TESTED
+        '''Events dropped from queue since the last call.'''
+        count = self._subscribers.get(queue, 0)
+        if count:
+            self._subscribers[queue] = 0
+        return count
+
+
+feed = ActivityFeed()
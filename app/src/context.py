@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+from types import SimpleNamespace
+from fastapi import HTTPException, Request, Response, status
+from config import settings
+from src import users, versions
+
+logger = logging.getLogger(__name__)
+
+_NO_DEFAULT = object()
+
+
+class Piece:
+    '''One independent piece of page data.
+
+    fetch is a zero-argument callable returning an awaitable. If the
+    piece takes longer than timeout seconds, default is used instead,
+    or the request fails with 504 when there is no default.
+    '''
+
+    def __init__(self, fetch, timeout: float = None, default=_NO_DEFAULT):
+        self.fetch = fetch
+        self.timeout = timeout
+        self.default = default
+
+
+class PageContext:
+    '''Checks authentication first, then loads page data concurrently.'''
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.user = None
+        self.timings = {}
+        self.etag = None
+        request.state.page_timings = self.timings
+
+    async def authorize(self, roles: tuple = None):
+        '''Returns the path to redirect to, or None if the user may see
+        the page.'''
+        started = time.perf_counter()
+        self.user = await users.get_current_user_from_cookie(self.request)
+        self.timings['auth'] = (time.perf_counter() - started) * 1000
+        if not self.user:
+            return '/login'
+        if roles is not None and self.user['role'] not in roles:
+            return '/'
+        return None
+
+    def not_modified(self, *scopes: str):
+        '''Tags the page with the versions of the scopes it is built
+        from. Returns a 304 response if the client already has this
+        version, so the caller can return before loading anything.'''
+        self.etag = versions.etag(
+            scopes, self.user['_id'], self.user['role'], self.request.url
+        )
+        if versions.matches(
+            self.request.headers.get('if-none-match'), self.etag
+        ):
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers=self._cache_headers()
+            )
+        return None
+
+    def tagged(self, response):
+        if self.etag:
+            response.headers.update(self._cache_headers())
+        return response
+
+    def _cache_headers(self) -> dict:
+        # Browsers keep the page but must revalidate it on every visit.
+        return {'ETag': self.etag, 'Cache-Control': 'private, no-cache'}
+
+    async def fetch(self, **pieces) -> SimpleNamespace:
+        names = list(pieces)
+        results = await asyncio.gather(
+            *[self._run(name, pieces[name]) for name in names]
+        )
+        logger.debug(
+            '%s page pieces: %s', self.request.url.path, self.timings
+        )
+        return SimpleNamespace(**dict(zip(names, results)))
+
+    async def _run(self, name: str, piece):
+        if not isinstance(piece, Piece):
+            piece = Piece(piece)
+        timeout = piece.timeout or settings.page_piece_timeout
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(piece.fetch(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                '%s: %s timed out after %ss',
+                self.request.url.path, name, timeout
+            )
+            if piece.default is _NO_DEFAULT:
+                raise HTTPException(
+                    status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                    detail=f'Timed out loading {name}'
+                )
+            return piece.default
+        finally:
+            self.timings[name] = (time.perf_counter() - started) * 1000
@@ -0,0 +1,249 @@
+'''
+Background scoring of translators and chief editors.
+
+Consumes activity writes from the change feed and, whenever an activity
+becomes finished, credits its translator and editor. Lateness is judged
+by the activity's own finished_at, so imported history is scored as of
+when it was finished; finished activities without one are not scored.
+Each user keeps running counters in efficiency_stats, so history is
+never rescanned:
+
+    on_time_ratio       finished on or before the deadline day / finished
+    throughput_per_week finished / weeks since the first finished one
+    efficiency          on_time_ratio * min(1, throughput / target)
+
+Scores are computed by the server, in the same update that moves the
+counters. Throughput falls while a user finishes nothing, so every
+worker also rescores all users each efficiency_rescore_interval seconds.
+
+If the feed drops events because scoring fell behind, the counters are
+rebuilt from the activities collection. They can be rebuilt by hand too:
+
+    python -m src.efficiency
+'''
+import asyncio
+import json
+import logging
+from datetime import datetime
+from bson.objectid import ObjectId
+from pymongo.errors import PyMongoError
+import database
+from config import settings
+from src import invalidation, users, versions
+from src.changefeed import feed
+
+logger = logging.getLogger(__name__)
+
+FINISHED = 'finished'
+WEEK_MS = 604800000
+SCORED = {'efficiency_stats.finished': {'$gt': 0}}
+SCORED_ROLES = {'role': {'$in': ['translator', 'chief_editor']}}
+
+_worker = None
+_rescorer = None
+
+
+def score_stages(now: datetime) -> list: #TESTED
+    '''Update pipeline stages that set the scores from efficiency_stats.'''
+    finished = {'$ifNull': ['$efficiency_stats.finished', 0]}
+    weeks = {'$max': [1, {'$divide': [
+        {'$subtract': [now, '$efficiency_stats.first_finished_at']}, WEEK_MS
+    ]}]}
+    return [
+        {'$set': {
+            'on_time_ratio': {'$cond': [
+                {'$gt': [finished, 0]},
+                {'$divide': [
+                    {'$ifNull': ['$efficiency_stats.on_time', 0]}, finished
+                ]},
+                0.0,
+            ]},
+            'throughput_per_week': {'$cond': [
+                {'$gt': [finished, 0]}, {'$divide': [finished, weeks]}, 0.0
+            ]},
+        }},
+        {'$set': {
+            'on_time_ratio': {'$round': ['$on_time_ratio', 3]},
+            'throughput_per_week': {'$round': ['$throughput_per_week', 3]},
+            'efficiency': {'$round': [{'$multiply': [
+                '$on_time_ratio',
+                {'$min': [1.0, {'$divide': [
+                    '$throughput_per_week', settings.efficiency_target_per_week
+                ]}]},
+            ]}, 3]},
+        }},
+    ]
+
+def is_newly_finished(event: dict) -> bool: #TESTED
+    before = event.get('before')
+    return (
+        event['activity'].get('status') == FINISHED
+        and (before is None or before.get('status') != FINISHED)
+    )
+
+def is_on_time(finished_at: datetime, deadline: datetime) -> bool: #TESTED
+    # Deadlines are days, stored at midnight.
+    return finished_at.date() <= deadline.date()
+
+async def credit_user(user_id: str, on_time: bool, finished_at: datetime):
+    if not ObjectId.is_valid(user_id):
+        return
+    # One pipeline update, so concurrent finishes never score from stale
+    # counters.
+    result = await database.users_collection.update_one(
+        {'_id': ObjectId(user_id)},
+        [
+            {'$set': {
+                'efficiency_stats.finished': {'$add': [
+                    {'$ifNull': ['$efficiency_stats.finished', 0]}, 1
+                ]},
+                'efficiency_stats.on_time': {'$add': [
+                    {'$ifNull': ['$efficiency_stats.on_time', 0]},
+                    int(on_time),
+                ]},
+                'efficiency_stats.first_finished_at': {'$min': [
+                    '$efficiency_stats.first_finished_at', finished_at
+                ]},
+            }},
+            *score_stages(datetime.now()),
+        ]
+    )
+    if not result.matched_count:
+        return
+    users.invalidate_user(user_id)
+    # /me shows the scores, and answers 304 until the user scope moves.
+    scopes = versions.bump(versions.user_scope(user_id))
+    await invalidation.publish(invalidation.USER, scopes, user_id=user_id)
+
+async def rescore(now: datetime = None, query: dict = SCORED) -> list:
+    '''Recomputes the scores of the users matching query as of now, and
+    returns their ids.'''
+    user_ids = [
+        str(user['_id']) async for user in
+        database.users_collection.find(query, {'_id': 1})
+    ]
+    await database.users_collection.update_many(
+        query, score_stages(now or datetime.now())
+    )
+    # Every worker rescores, so each only drops its own cached copies.
+    users.get_user_cache().clear()
+    versions.bump(versions.USERS, *map(versions.user_scope, user_ids))
+    return user_ids
+
+async def rebuild_stats(now: datetime = None) -> int:
+    '''Recounts efficiency_stats from the finished activities, the way
+    handle_event credits them, and rescores everyone.'''
+    await database.users_collection.update_many(
+        {'efficiency_stats': {'$exists': True}},
+        {'$unset': {'efficiency_stats': ''}}
+    )
+    day = lambda date: {'$dateTrunc': {'date': date, 'unit': 'day'}}
+    pipeline = [
+        {'$match': {'status': FINISHED, 'finished_at': {'$ne': None}}},
+        {'$project': {
+            'finished_at': 1,
+            'on_time': {'$lte': [day('$finished_at'), day('$deadline')]},
+            'user_id': {'$filter': {
+                'input': {'$setUnion': [['$translators', '$editor']]},
+                'cond': {'$not': [{'$in': ['$$this', [None, '']]}]},
+            }},
+        }},
+        {'$unwind': '$user_id'},
+        {'$group': {
+            '_id': {'$convert': {
+                'input': '$user_id', 'to': 'objectId', 'onError': None,
+            }},
+            'finished': {'$sum': 1},
+            'on_time': {'$sum': {'$cond': ['$on_time', 1, 0]}},
+            'first_finished_at': {'$min': '$finished_at'},
+        }},
+        {'$match': {'_id': {'$ne': None}}},
+        {'$project': {'efficiency_stats': {
+            'finished': '$finished', 'on_time': '$on_time',
+            'first_finished_at': '$first_finished_at',
+        }}},
+        {'$merge': {
+            'into': database.users_collection.name,
+            'on': '_id',
+            'whenMatched': 'merge',
+            'whenNotMatched': 'discard',
+        }},
+    ]
+    await database.activities_collection.aggregate(pipeline).to_list(None)
+    return len(await rescore(now, SCORED_ROLES))
+
+async def handle_event(event: dict):
+    # Every worker sees remote events; only the writer's worker scores.
+    if event.get('remote') or not is_newly_finished(event):
+        return
+    activity = event['activity']
+    finished_at = activity.get('finished_at')
+    if finished_at is None:
+        return
+    on_time = is_on_time(finished_at, activity['deadline'])
+    for user_id in {activity.get('translators'), activity.get('editor')}:
+        if user_id:
+            await credit_user(user_id, on_time, finished_at)
+
+async def run():
+    queue = feed.subscribe()
+    behind = False
+    try:
+        while True:
+            event = await queue.get()
+            if feed.missed(queue) or behind:
+                behind = not await catch_up(queue)
+                continue
+            try:
+                await handle_event(event)
+            except PyMongoError:
+                logger.exception(
+                    'could not score activity %s', event['activity'].get('_id')
+                )
+    finally:
+        feed.unsubscribe(queue)
+
+async def catch_up(queue) -> bool:
+    # The queued events are in the activities collection already, so they
+    # are counted by the rebuild rather than credited again after it.
+    while not queue.empty():
+        queue.get_nowait()
+    logger.warning('scoring fell behind the activity feed, rebuilding')
+    try:
+        await rebuild_stats()
+    except PyMongoError:
+        # Retried with the next event.
+        logger.exception('could not rebuild efficiency stats')
+        return False
+    return True
+
+async def run_rescore():
+    while True:
+        await asyncio.sleep(settings.efficiency_rescore_interval)
+        try:
+            await rescore()
+        except PyMongoError:
+            logger.exception('could not rescore users')
+
+def start():
+    global _worker, _rescorer
+    if _worker is None:
+        _worker = asyncio.create_task(run())
+    if _rescorer is None and settings.efficiency_rescore_interval > 0:
+        _rescorer = asyncio.create_task(run_rescore())
+
+async def stop():
+    global _worker, _rescorer
+    for task in (_worker, _rescorer):
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    _worker = _rescorer = None
+
+
+if __name__ == '__main__':
+    users_scored = asyncio.run(rebuild_stats())
+    print(json.dumps({'users_scored': users_scored}))
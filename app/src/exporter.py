@@ -0,0 +1,179 @@
+'''
+Streaming CSV/NDJSON export of activities and projects.
+
+Rows are read straight from a Motor cursor and encoded one cursor batch
+at a time. User ids are turned into usernames through a bounded cache;
+ids missing from it are resolved with one $in query per batch. Memory
+use depends on the batch size, not on the number of exported rows.
+'''
+import csv
+import io
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+import orjson
+import database
+from config import settings
+from src import metrics, rollups
+from src.cache import TTLCache
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+MEDIA_TYPES = {CSV: 'text/csv', NDJSON: 'application/x-ndjson'}
+
+_username_cache = None
+
+ACTIVITY_COLUMNS = [
+    'id', 'project_id', 'project_name', 'activity_name', 'translator_id',
+    'translator', 'editor_id', 'editor', 'deadline', 'status',
+    'project_status', 'completeness',
+]
+ACTIVITY_PROJECTION = {
+    'project_id': 1, 'project_name': 1, 'activity_name': 1, 'translators': 1,
+    'editor': 1, 'deadline': 1, 'status': 1, 'project_status': 1,
+    'completeness': 1,
+}
+PROJECT_COLUMNS = [
+    'id', 'project_name', 'editor_id', 'editor', 'deadline', 'status',
+    'activity_total', 'completeness', 'next_deadline',
+]
+PROJECT_PROJECTION = {
+    'project_name': 1, 'editor': 1, 'deadline': 1, 'project_status': 1,
+    'activity_total': 1, 'completeness_sum': 1, 'next_deadline': 1,
+}
+
+
+def activities_query(
+    project_id: str = None, status: str = None,
+    deadline_from: datetime = None, deadline_to: datetime = None,
+) -> dict: #TESTED
+    query = {'activity_name': {'$ne': 'initial_activity'}}
+    if project_id:
+        query['project_id'] = ObjectId(project_id)
+    if status:
+        query['status'] = status
+    if deadline_from or deadline_to:
+        query['deadline'] = {}
+        if deadline_from:
+            query['deadline']['$gte'] = deadline_from
+        if deadline_to:
+            # deadline_to is the last day exported, whatever the time.
+            query['deadline']['$lt'] = deadline_to + timedelta(days=1)
+    return query
+
+def activity_row(activity: dict, usernames: dict) -> dict:
+    translator = activity.get('translators')
+    return {
+        'id': str(activity['_id']),
+        'project_id': str(activity.get('project_id') or ''),
+        'project_name': activity.get('project_name'),
+        'activity_name': activity.get('activity_name'),
+        'translator_id': translator,
+        'translator': usernames.get(translator),
+        'editor_id': activity.get('editor'),
+        'editor': usernames.get(activity.get('editor')),
+        'deadline': activity.get('deadline'),
+        'status': activity.get('status'),
+        'project_status': activity.get('project_status'),
+        'completeness': activity.get('completeness'),
+    }
+
+def project_row(project: dict, usernames: dict) -> dict:
+    progress = rollups.rollup_helper(project)
+    return {
+        'id': str(project['_id']),
+        'project_name': project.get('project_name'),
+        'editor_id': project.get('editor'),
+        'editor': usernames.get(project.get('editor')),
+        'deadline': project.get('deadline'),
+        'status': project.get('project_status'),
+        'activity_total': progress['activity_total'],
+        'completeness': progress['completeness'],
+        'next_deadline': progress['next_deadline'],
+    }
+
+def get_username_cache() -> TTLCache:
+    global _username_cache
+    if _username_cache is None:
+        _username_cache = TTLCache(settings.export_name_cache_size, 300)
+        metrics.register_cache('export_usernames', _username_cache)
+    return _username_cache
+
+async def resolve_usernames(user_ids: set) -> dict:
+    username_cache = get_username_cache()
+    usernames = {}
+    missing = []
+    for user_id in user_ids:
+        username = username_cache.get(user_id)
+        if username is None:
+            if ObjectId.is_valid(user_id):
+                missing.append(ObjectId(user_id))
+        else:
+            usernames[user_id] = username
+    if missing:
+        users_collection = database.list_reads(database.users_collection)
+        async for user in users_collection.find(
+            {'_id': {'$in': missing}}, {'username': 1}
+        ):
+            username_cache.set(str(user['_id']), user['username'])
+            usernames[str(user['_id'])] = user['username']
+    return usernames
+
+def encode(rows: list, columns: list, file_format: str) -> bytes: #TESTED
+    if file_format == NDJSON:
+        return b''.join(orjson.dumps(row) + b'\n' for row in rows)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in (row[column] for column in columns)
+        ])
+    return buffer.getvalue().encode()
+
+async def stream(
+    cursor, make_row, user_fields: tuple, columns: list, file_format: str
+):
+    if file_format == CSV:
+        yield encode([dict(zip(columns, columns))], columns, CSV)
+    batch = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) >= settings.export_batch_size:
+            yield await _encode_batch(
+                batch, make_row, user_fields, columns, file_format
+            )
+            batch = []
+    if batch:
+        yield await _encode_batch(
+            batch, make_row, user_fields, columns, file_format
+        )
+
+async def _encode_batch(batch, make_row, user_fields, columns, file_format):
+    usernames = await resolve_usernames({
+        document.get(field) for document in batch for field in user_fields
+        if document.get(field)
+    })
+    return encode(
+        [make_row(document, usernames) for document in batch],
+        columns, file_format
+    )
+
+def export_activities(query: dict, file_format: str):
+    cursor = database.list_reads(database.activities_collection).find(
+        query, ACTIVITY_PROJECTION,
+        sort=[('_id', 1)],
+        batch_size=settings.export_batch_size,
+    )
+    return stream(
+        cursor, activity_row, ('translators', 'editor'), ACTIVITY_COLUMNS,
+        file_format
+    )
+
+def export_projects(status: str, file_format: str):
+    query = {'project_status': status} if status else {}
+    cursor = database.list_reads(database.projects_collection).find(
+        query, PROJECT_PROJECTION,
+        sort=[('deadline', 1), ('_id', 1)],
+        batch_size=settings.export_batch_size,
+    )
+    return stream(cursor, project_row, ('editor',), PROJECT_COLUMNS, file_format)
@@ -0,0 +1,184 @@
+'''
+Streaming bulk import of activities into one project.
+
+The request body is read chunk by chunk and split into lines, each line
+is validated against models.ActivityModel on its own, and valid rows are
+written with ordered insert_many batches. At most one batch of rows is
+held in memory at a time.
+
+CSV input needs a header row; NDJSON input has one JSON object per line.
+Recognised columns are activity_name, translators (or translator),
+deadline and optionally editor, status (created or finished; rows with
+other statuses are reported as errors), completeness and finished_at
+(when a finished activity was finished; without it, it is not scored).
+CSV fields cannot contain line breaks.
+
+A body that is not UTF-8, or has a line longer than
+import_max_line_length characters, stops the import with a ValueError;
+rows already inserted stay.
+'''
+import codecs
+import csv
+import json
+from pydantic import ValidationError, validator
+from pymongo.errors import BulkWriteError
+import models
+from config import settings
+from src import users
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+
+
+async def iter_lines(chunks, max_length: int = None): #TESTED
+    max_length = max_length or settings.import_max_line_length
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer = ''
+    number = 0
+
+    def decode(chunk: bytes, final: bool = False) -> str:
+        pending = len(decoder.getstate()[0])
+        try:
+            return decoder.decode(chunk, final)
+        except UnicodeDecodeError as error:
+            position = max(error.start - pending, 0)
+            line_number = number + chunk[:position].count(b'\n') + 1
+            raise ValueError(f'line {line_number} is not valid UTF-8')
+
+    def check(line: str, line_number: int):
+        if len(line) > max_length:
+            raise ValueError(
+                f'line {line_number} is longer than {max_length} characters'
+            )
+
+    async for chunk in chunks:
+        buffer += decode(chunk)
+        *lines, buffer = buffer.split('\n')
+        for line in lines:
+            number += 1
+            check(line, number)
+            yield line.rstrip('\r')
+        # An unfinished line is never buffered beyond the limit either.
+        check(buffer, number + 1)
+    buffer += decode(b'', final=True)
+    if buffer:
+        check(buffer, number + 1)
+        yield buffer.rstrip('\r')
+
+async def iter_rows(chunks, file_format: str):
+    '''Yields (row number, dict or parse error message).'''
+    header = None
+    number = 0
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        if file_format == CSV and header is None:
+            header = [column.strip() for column in next(csv.reader([line]))]
+            continue
+        number += 1
+        try:
+            if file_format == CSV:
+                yield number, dict(zip(header, next(csv.reader([line]))))
+            else:
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError('expected a JSON object')
+                yield number, row
+        except (ValueError, csv.Error) as error:
+            yield number, str(error)
+
+
+class ImportedActivity(models.ActivityModel):
+
+    @validator('status')
+    def known_status(cls, status):
+        if status not in models.ACTIVITY_STATUSES:
+            expected = ', '.join(models.ACTIVITY_STATUSES)
+            raise ValueError(f'unknown status, expected one of {expected}')
+        return status
+
+
+def build_activity(row: dict, project: dict) -> models.ActivityModel: #TESTED
+    deadline = row.get('deadline')
+    if isinstance(deadline, str) and len(deadline.strip()) == 10:
+        # Plain dates, as entered in the activity form, mean midnight.
+        deadline = f'{deadline.strip()}T00:00'
+    return ImportedActivity(
+        activity_name=row.get('activity_name'),
+        project_name=project['project_name'],
+        project_id=project['id'],
+        translators=row.get('translators', row.get('translator')) or None,
+        editor=row.get('editor') or project['editor'],
+        deadline=deadline,
+        project_status='in work',
+        completeness=row.get('completeness') or 0.0,
+        status=row.get('status') or 'created',
+        finished_at=row.get('finished_at') or None,
+    )
+
+
+class ImportReport:
+
+    def __init__(self, max_errors: int):
+        self.max_errors = max_errors
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, row: int, errors):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'row': row, 'errors': errors})
+
+    def as_dict(self) -> dict:
+        return {
+            'inserted': self.inserted,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors),
+        }
+
+
+async def _flush(batch: list, report: ImportReport):
+    try:
+        await users.create_activities([activity for _, activity in batch])
+        report.inserted += len(batch)
+    except BulkWriteError as error:
+        inserted = error.details['nInserted']
+        report.inserted += inserted
+        write_error = error.details['writeErrors'][0]
+        report.error(batch[inserted][0], [write_error['errmsg']])
+        for row, _ in batch[inserted + 1:]:
+            report.error(
+                row, ['not inserted: an earlier row in the batch failed']
+            )
+
+async def import_activities(
+    chunks, file_format: str, project: dict, batch_size: int = None
+) -> dict:
+    batch_size = batch_size or settings.import_batch_size
+    report = ImportReport(settings.import_max_errors)
+    batch = []
+    try:
+        async for number, row in iter_rows(chunks, file_format):
+            if isinstance(row, str):
+                report.error(number, [row])
+                continue
+            try:
+                batch.append((number, build_activity(row, project)))
+            except ValidationError as error:
+                report.error(number, [
+                    f"{'.'.join(map(str, item['loc']))}: {item['msg']}"
+                    for item in error.errors()
+                ])
+                continue
+            if len(batch) >= batch_size:
+                await _flush(batch, report)
+                batch = []
+    except ValueError as error:
+        raise ValueError(
+            f'{error}; {report.inserted} rows were imported before it'
+        ) from error
+    if batch:
+        await _flush(batch, report)
+    return report.as_dict()
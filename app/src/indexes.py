@@ -0,0 +1,122 @@
+'''
+Declarative index registry.
+
+Applied idempotently at startup; run ahead of a deploy with
+
+    python -m src.indexes          # create missing indexes
+    python -m src.indexes --check  # only report drift
+
+Both exit 1 on drift, and when creating or checking the indexes failed;
+those failures are listed under 'failed' in the printed report.
+'''
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import PyMongoError
+import database
+
+logger = logging.getLogger(__name__)
+
+INDEXES = {
+    'users_collection': [
+        IndexModel([('login', ASCENDING)], unique=True),
+        IndexModel([('role', ASCENDING)]),
+    ],
+    'tokens_collection': [
+        IndexModel([('expires', ASCENDING)], expireAfterSeconds=0),
+    ],
+    'activities_collection': [
+        IndexModel([('project_id', ASCENDING)]),
+        IndexModel([('project_name', ASCENDING)]),
+        # _id second, for paging a user's activities.
+        IndexModel([('translators', ASCENDING), ('_id', ASCENDING)]),
+        IndexModel([('editor', ASCENDING), ('_id', ASCENDING)]),
+    ],
+    'projects_collection': [
+        IndexModel([('project_name', ASCENDING)], unique=True),
+        IndexModel([
+            ('project_status', ASCENDING),
+            ('deadline', ASCENDING),
+            ('_id', ASCENDING),
+        ]),
+        IndexModel([('editor', ASCENDING)]),
+    ],
+}
+
+COMPARED_OPTIONS = ('unique', 'expireAfterSeconds', 'sparse')
+
+
+def _options(index: dict) -> dict:
+    return {
+        option: index[option]
+        for option in COMPARED_OPTIONS if option in index
+    }
+
+def compare_indexes(existing: dict, registry: dict = INDEXES) -> dict: #TESTED
+    '''Compares index_information() results, by collection name, with the
+    registry.'''
+    report = {'missing': [], 'changed': [], 'extra': []}
+    for collection_name, models in registry.items():
+        current_indexes = dict(existing.get(collection_name, {}))
+        current_indexes.pop('_id_', None)
+        for model in models:
+            wanted = model.document
+            name = wanted['name']
+            current = current_indexes.pop(name, None)
+            if current is None:
+                report['missing'].append(f'{collection_name}.{name}')
+            elif (list(current['key']) != list(wanted['key'].items())
+                    or _options(current) != _options(wanted)):
+                report['changed'].append(f'{collection_name}.{name}')
+        report['extra'].extend(
+            f'{collection_name}.{name}' for name in current_indexes
+        )
+    return report
+
+async def check_indexes() -> dict:
+    existing = {}
+    for collection_name in INDEXES:
+        existing[collection_name] = (
+            await database.database[collection_name].index_information()
+        )
+    return compare_indexes(existing)
+
+async def check_or_fail(failed: list = ()) -> dict:
+    report = {'failed': list(failed)}
+    try:
+        report.update(await check_indexes())
+    except PyMongoError as error:
+        logger.error('could not check indexes: %s', error)
+        report['failed'].append('check')
+    return report
+
+async def apply_indexes() -> dict:
+    failed = []
+    for collection_name, models in INDEXES.items():
+        try:
+            await database.database[collection_name].create_indexes(models)
+        except PyMongoError as error:
+            logger.error(
+                'could not create indexes on %s: %s', collection_name, error
+            )
+            failed.append(collection_name)
+    report = await check_or_fail(failed)
+    if any(report.values()):
+        logger.warning('index drift: %s', report)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.check:
+        report = asyncio.run(check_or_fail())
+    else:
+        report = asyncio.run(apply_indexes())
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if any(report.values()) else 0)
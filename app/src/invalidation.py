@@ -0,0 +1,195 @@
+'''
+Cross-worker invalidation bus.
+
+The write functions in src/users.py apply their invalidations locally and
+then publish them here, as documents in a capped collection:
+
+    {'origin': <worker id>, 'kind': 'user' | 'project' | 'activity',
+     'scopes': [<src.versions scopes bumped>], 'at': <utc datetime>, ...}
+
+with user_id/username/role for users, project_id/project_name for
+projects, and changes (the src.changefeed events) for activities.
+
+Every worker subscribes at startup and replays the other workers' events:
+it bumps the same version scopes, drops cached users, invalidates the
+navigation snapshot, updates the search index and republishes activity
+changes on its own feed marked remote. It subscribes with a change stream
+where the deployment supports one and tails the capped collection
+otherwise (standalone mongod). If the subscription breaks, events may
+have been missed, so every local cache is reset, and open dashboards are
+told to reload, before resubscribing.
+Staleness is therefore bounded by the bus delay, plus the retry delay
+after a failure.
+'''
+import asyncio
+import logging
+import os
+import secrets
+import socket
+from datetime import datetime
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
+import database
+from config import settings
+from src import live, metrics, navigation, search, users, versions
+from src.changefeed import feed
+
+logger = logging.getLogger(__name__)
+
+USER = 'user'
+PROJECT = 'project'
+ACTIVITY = 'activity'
+HELLO = 'hello'
+
+CHANGE_STREAM = 'change_stream'
+TAILABLE = 'tailable'
+AUTO = 'auto'
+OFF = 'off'
+
+# Server error code when change streams need a replica set.
+CHANGE_STREAMS_UNSUPPORTED = 40573
+RETRY_DELAY = 1.0
+
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}'
+
+received = metrics.Counter(
+    'invalidation_events_received_total',
+    'Invalidation events applied from other workers.', ('kind',),
+)
+delay = metrics.Histogram(
+    'invalidation_delay_seconds',
+    'Time from publishing an invalidation to applying it here.',
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+resyncs = metrics.Counter(
+    'invalidation_resyncs_total',
+    'Full local invalidations after the bus subscription broke.',
+)
+
+_subscriber = None
+
+
+async def publish(kind: str, scopes=(), **payload):
+    if settings.invalidation_bus == OFF:
+        return
+    try:
+        await database.invalidations_collection.insert_one({
+            'origin': WORKER_ID, 'kind': kind, 'scopes': list(scopes),
+            'at': datetime.utcnow(), **payload,
+        })
+    except PyMongoError:
+        # Other workers catch up through their cache TTLs.
+        logger.exception('could not publish %s invalidation', kind)
+
+def apply(event: dict): #TESTED
+    versions.bump(*event.get('scopes', ()))
+    kind = event['kind']
+    if kind == USER:
+        users.invalidate_user(event['user_id'])
+        if 'username' in event:
+            navigation.invalidate()
+            search.index_user(
+                event['user_id'], event['username'], event.get('role')
+            )
+    elif kind == PROJECT:
+        navigation.invalidate()
+        search.index_project(event['project_id'], event['project_name'])
+    elif kind == ACTIVITY:
+        for change in event['changes']:
+            search.index_activity(change['activity'])
+            feed.publish({**change, 'remote': True})
+
+def receive(event: dict):
+    if event.get('origin') == WORKER_ID or event.get('kind') == HELLO:
+        return
+    try:
+        apply(event)
+        received.inc(event['kind'])
+        if event.get('at'):
+            delay.observe(
+                max(0.0, (datetime.utcnow() - event['at']).total_seconds())
+            )
+    except Exception:
+        # A malformed event must not end the subscription; whatever it
+        # was meant to invalidate is dropped with everything else.
+        logger.exception('could not apply invalidation event %r', event)
+        resync()
+
+def resync(): #TESTED
+    '''Forgets everything that may have been changed by a missed event.'''
+    resyncs.inc()
+    users.get_user_cache().clear()
+    navigation.invalidate()
+    versions.reset()
+    live.reload_all()
+
+async def ensure_collection():
+    try:
+        await database.database.create_collection(
+            'invalidations_collection', capped=True,
+            size=settings.invalidation_bus_size,
+            max=settings.invalidation_bus_max_events,
+        )
+    except CollectionInvalid:
+        return
+    # A tailable cursor on an empty capped collection dies immediately.
+    await database.invalidations_collection.insert_one(
+        {'origin': WORKER_ID, 'kind': HELLO, 'at': datetime.utcnow()}
+    )
+
+async def watch():
+    async with database.invalidations_collection.watch(
+        [{'$match': {'operationType': 'insert'}}]
+    ) as stream:
+        async for change in stream:
+            receive(change['fullDocument'])
+
+async def tail():
+    collection = database.invalidations_collection
+    last = await collection.find_one({}, sort=[('$natural', -1)])
+    while True:
+        query = {'_id': {'$gt': last['_id']}} if last else {}
+        cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+        while cursor.alive:
+            async for event in cursor:
+                last = event
+                receive(event)
+        # The cursor dies when the capped collection overwrote its
+        # position, so events may have been missed.
+        resync()
+        await asyncio.sleep(RETRY_DELAY)
+
+async def run(mode: str):
+    while True:
+        try:
+            await ensure_collection()
+            if mode == TAILABLE:
+                await tail()
+            else:
+                await watch()
+        except PyMongoError as error:
+            if (
+                mode == AUTO and isinstance(error, OperationFailure)
+                and error.code == CHANGE_STREAMS_UNSUPPORTED
+            ):
+                logger.info('change streams unavailable, tailing instead')
+                mode = TAILABLE
+                continue
+            logger.exception('invalidation bus subscription broke')
+            resync()
+            await asyncio.sleep(RETRY_DELAY)
+
+def start():
+    global _subscriber
+    if _subscriber is None and settings.invalidation_bus != OFF:
+        _subscriber = asyncio.create_task(run(settings.invalidation_bus))
+
+async def stop():
+    global _subscriber
+    if _subscriber is not None:
+        _subscriber.cancel()
+        try:
+            await _subscriber
+        except asyncio.CancelledError:
+            pass
+        _subscriber = None
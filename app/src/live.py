@@ -0,0 +1,255 @@
+'''
+Live activity updates for the /me dashboards, as Server-Sent Events.
+
+One task per worker consumes the change feed (local writes and, through
+src/invalidation.py, the other workers' writes) and routes each activity
+event to the open connections of the users it concerns: its translator
+and editor, and whoever it was reassigned away from. Each event is
+encoded once however many tabs receive it, so an open dashboard costs a
+queue, not a query per poll.
+
+The stream carries three events:
+
+    activity  {'operation': 'insert' | 'update' | 'remove',
+               'activity': {'id': ..., <fields shown in the tables>}}
+    reload    events may have been missed; the page reloads itself
+    bye       the connection reached live_max_age; the page reconnects,
+              so the session is checked again, with the page_version()
+              the data carries
+
+Connections have bounded queues. One that falls behind is sent a reload
+instead of the events it missed.
+
+Whether a page missed anything is decided with per-user write counters
+kept in live_versions_collection, so the page and its stream agree even
+when they are served by different workers. Activity writes advance the
+counters of the users they concern and carry the new values in their
+feed event; a page is rendered with its user's counter, the stream
+starts with a reload if the counter moved since, and bye carries the
+counter of the last event the connection delivered.
+'''
+import asyncio
+import logging
+from datetime import datetime
+import orjson
+from pymongo import ReturnDocument
+import database
+from config import settings
+from src import metrics
+from src.changefeed import feed
+
+logger = logging.getLogger(__name__)
+
+HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+PAYLOAD_FIELDS = (
+    'activity_name', 'project_name', 'status', 'deadline', 'completeness',
+)
+RETRY_MS = 5000
+
+KEEPALIVE = b': keepalive\n\n'
+
+connections = metrics.Gauge(
+    'live_connections', 'Open live dashboard connections.'
+)
+dropped = metrics.Counter(
+    'live_reloads_total', 'Connections told to reload after falling behind.'
+)
+
+_dispatcher = None
+_pending = None
+
+
+def encode(event: str, data=None) -> bytes: #TESTED
+    return f'event: {event}\ndata: '.encode() + orjson.dumps(data) + b'\n\n'
+
+RELOAD = encode('reload')
+
+def activity_payload(activity: dict) -> dict: #TESTED
+    payload = {'id': str(activity['_id'])}
+    for field in PAYLOAD_FIELDS:
+        value = activity.get(field)
+        # Dates are shown the way the templates render them.
+        payload[field] = str(value) if isinstance(value, datetime) else value
+    payload['translator'] = activity.get('translators')
+    payload['editor'] = activity.get('editor')
+    return payload
+
+async def page_version(user_id: str) -> int: #TESTED
+    '''Counts the activity writes that concerned user_id so far.'''
+    document = await database.live_versions_collection.find_one(
+        {'_id': user_id}
+    )
+    return document['version'] if document else 0
+
+async def advance(counts: dict) -> dict: #TESTED
+    '''Adds counts[user_id] writes to each user's counter and returns
+    the new values.'''
+    advanced = {}
+    for user_id, count in counts.items():
+        document = await database.live_versions_collection.find_one_and_update(
+            {'_id': user_id}, {'$inc': {'version': count}},
+            upsert=True, return_document=ReturnDocument.AFTER,
+        )
+        advanced[user_id] = document['version']
+    return advanced
+
+async def stamp(events: list): #TESTED
+    '''Advances the counters for a batch of activity events and gives
+    each event the counter values it brought its users to.'''
+    counts = {}
+    for event in events:
+        for user_id in members(event['activity']) | members(event['before']):
+            counts[user_id] = counts.get(user_id, 0) + 1
+    advanced = await advance(counts)
+    # Events are numbered in order, ending at the advanced values.
+    for event in reversed(events):
+        event['versions'] = {}
+        for user_id in members(event['activity']) | members(event['before']):
+            event['versions'][user_id] = advanced[user_id]
+            advanced[user_id] -= 1
+
+def members(activity: dict | None) -> set:
+    if not activity:
+        return set()
+    return {
+        user_id for user_id in
+        (activity.get('translators'), activity.get('editor')) if user_id
+    }
+
+
+class LiveHub:
+    '''Open connections by user id, each with its own bounded queue of
+    encoded messages.'''
+
+    def __init__(self, maxsize: int = 100):
+        self.maxsize = maxsize
+        self._connections = {}
+
+    def __len__(self):
+        return sum(map(len, self._connections.values()))
+
+    def connect(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(self.maxsize)
+        self._connections.setdefault(user_id, set()).add(queue)
+        connections.inc()
+        return queue
+
+    def disconnect(self, user_id: str, queue: asyncio.Queue):
+        queues = self._connections.get(user_id)
+        if queues and queue in queues:
+            queues.discard(queue)
+            connections.dec()
+            if not queues:
+                del self._connections[user_id]
+
+    def send(self, user_ids, message: bytes, versions: dict = None):
+        versions = versions or {}
+        for user_id in user_ids:
+            item = (versions.get(user_id), message)
+            for queue in self._connections.get(user_id, ()):
+                try:
+                    queue.put_nowait(item)
+                except asyncio.QueueFull:
+                    self._reload(queue)
+
+    def broadcast(self, message: bytes):
+        self.send(list(self._connections), message)
+
+    def dispatch(self, event: dict): #TESTED
+        activity = event['activity']
+        if activity.get('activity_name') == 'initial_activity':
+            return
+        recipients = members(activity)
+        versions = event.get('versions')
+        self.send(recipients, encode('activity', {
+            'operation': event['operation'],
+            'activity': activity_payload(activity),
+        }), versions)
+        removed = members(event.get('before')) - recipients
+        if removed:
+            self.send(removed, encode('activity', {
+                'operation': 'remove',
+                'activity': {'id': str(activity['_id'])},
+            }), versions)
+
+    @staticmethod
+    def _reload(queue: asyncio.Queue):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait((None, RELOAD))
+        dropped.inc()
+
+
+hub = LiveHub(settings.live_queue_size)
+
+
+def reload_all():
+    '''Tells every open page to reload, for when events may have been
+    missed.'''
+    hub.broadcast(RELOAD)
+
+def settled() -> bool:
+    '''True when every feed event so far has been routed.'''
+    return _pending is None or _pending.empty()
+
+async def stream(
+    user_id: str, since: str = None, keepalive: float = None,
+    max_age: float = None,
+): #TESTED
+    keepalive = settings.live_keepalive if keepalive is None else keepalive
+    max_age = settings.live_max_age if max_age is None else max_age
+    loop = asyncio.get_running_loop()
+    closes_at = loop.time() + max_age
+    queue = hub.connect(user_id)
+    try:
+        # Read after connecting, so no event falls between the two.
+        current = delivered = await page_version(user_id)
+        yield f'retry: {RETRY_MS}\n\n'.encode()
+        if since is not None and since != str(current):
+            yield RELOAD
+        while (remaining := closes_at - loop.time()) > 0:
+            # asyncio.timeout, unlike wait_for, never swallows the
+            # cancellation Starlette sends when the client disconnects.
+            try:
+                async with asyncio.timeout(min(keepalive, remaining)):
+                    version, message = await queue.get()
+            except TimeoutError:
+                yield KEEPALIVE
+                continue
+            if version is not None:
+                delivered = max(delivered, version)
+            yield message
+        yield encode('bye', delivered)
+    finally:
+        hub.disconnect(user_id, queue)
+
+async def run():
+    global _pending
+    queue = _pending = feed.subscribe()
+    try:
+        while True:
+            event = await queue.get()
+            try:
+                hub.dispatch(event)
+            except (KeyError, TypeError):
+                logger.exception(
+                    'could not route activity %s', event['activity'].get('_id')
+                )
+    finally:
+        feed.unsubscribe(queue)
+        _pending = None
+
+def start():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = asyncio.create_task(run())
+
+async def stop():
+    global _dispatcher
+    if _dispatcher is not None:
+        _dispatcher.cancel()
+        try:
+            await _dispatcher
+        except asyncio.CancelledError:
+            pass
+        _dispatcher = None
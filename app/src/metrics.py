@@ -0,0 +1,335 @@
+'''
+Process metrics in the Prometheus text exposition format, served at
+/metrics:
+
+- per-route request latency histograms and the in-flight request count,
+  from MetricsMiddleware;
+- Mongo connection pool sizes and checkout wait times, from a pymongo
+  ConnectionPoolListener registered on the client in database.py;
+- hits, misses and sizes of the named in-process caches;
+- event-loop lag, sampled by a background task (start/stop). Anything
+  blocking the loop, such as a PBKDF2 hash, shows up here directly.
+'''
+import asyncio
+import bisect
+import threading
+import time
+from pymongo import monitoring
+from config import settings
+from src.timing import route_path
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+UNMATCHED = '<unmatched>'
+
+_metrics = []
+_caches = {}
+_lag_task = None
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape(value) -> str:
+    return (
+        str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def header(self) -> list:
+        return [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.kind}',
+        ]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> list:
+        return [
+            f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}'
+            for labels, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: tuple = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            counts, total = self._values.get(
+                labels, ([0] * (len(self.buckets) + 1), 0.0)
+            )
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[labels] = (counts, total + value)
+
+    def count(self, *labels) -> int:
+        return sum(self._values.get(labels, ((), 0.0))[0])
+
+    def samples(self) -> list:
+        lines = []
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(
+                    f'{self.name}_bucket'
+                    f'{_labels(self.labelnames, labels, le)} {cumulative}'
+                )
+            lines.append(
+                f'{self.name}_sum{_labels(self.labelnames, labels)} '
+                f'{_number(total)}'
+            )
+            lines.append(
+                f'{self.name}_count{_labels(self.labelnames, labels)} '
+                f'{cumulative}'
+            )
+        return lines
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Request latency by route.',
+    ('method', 'route', 'status'),
+)
+requests_in_flight = Gauge(
+    'http_requests_in_flight', 'Requests currently being served.'
+)
+pool_connections = Gauge(
+    'mongo_pool_connections', 'Open connections in the Mongo pool.',
+    ('address',),
+)
+pool_checked_out = Gauge(
+    'mongo_pool_checked_out', 'Connections checked out of the Mongo pool.',
+    ('address',),
+)
+pool_max_size = Gauge(
+    'mongo_pool_max_size', 'maxPoolSize of the Mongo client.'
+)
+pool_checkout_wait = Histogram(
+    'mongo_pool_checkout_wait_seconds',
+    'Time spent waiting for a connection from the Mongo pool.',
+    ('address',),
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+pool_checkout_failures = Counter(
+    'mongo_pool_checkout_failures_total',
+    'Failed Mongo connection checkouts by reason.', ('address', 'reason'),
+)
+loop_lag = Gauge(
+    'event_loop_lag_seconds', 'Delay of the last event-loop lag probe.'
+)
+loop_lag_seconds = Histogram(
+    'event_loop_lag_probe_seconds', 'Delay of event-loop lag probes.',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+
+
+def register_cache(name: str, cache):
+    '''Exposes hits, misses and size of an object with hits and misses
+    counters and a length, such as src.cache.TTLCache.'''
+    _caches[name] = cache
+
+def cache_samples() -> list:
+    if not _caches:
+        return []
+    metrics = (
+        ('cache_hits_total', 'counter', 'Cache hits.',
+         lambda cache: cache.hits),
+        ('cache_misses_total', 'counter', 'Cache misses.',
+         lambda cache: cache.misses),
+        ('cache_hit_ratio', 'gauge', 'Share of lookups that hit.',
+         lambda cache: cache.hits / ((cache.hits + cache.misses) or 1)),
+        ('cache_entries', 'gauge', 'Entries currently cached.', len),
+    )
+    lines = []
+    for name, kind, help, value in metrics:
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+        for cache_name, cache in sorted(_caches.items()):
+            lines.append(
+                f'{name}{_labels(("cache",), (cache_name,))} '
+                f'{_number(value(cache))}'
+            )
+    return lines
+
+def render() -> str: #TESTED
+    lines = []
+    for metric in _metrics:
+        lines += metric.header() + metric.samples()
+    lines += cache_samples()
+    return '\n'.join(lines) + '\n'
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    '''Pool events arrive on Motor's executor threads; checkout start and
+    end of one checkout happen on the same thread.'''
+
+    def __init__(self):
+        self._checkout = threading.local()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pool_connections.set(0, _address(event))
+        pool_checked_out.set(0, _address(event))
+
+    def connection_created(self, event):
+        pool_connections.inc(_address(event))
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pool_connections.dec(_address(event))
+
+    def connection_check_out_started(self, event):
+        self._checkout.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        self._observe_wait(event)
+        pool_checkout_failures.inc(_address(event), event.reason)
+
+    def connection_checked_out(self, event):
+        self._observe_wait(event)
+        pool_checked_out.inc(_address(event))
+
+    def connection_checked_in(self, event):
+        pool_checked_out.dec(_address(event))
+
+    def _observe_wait(self, event):
+        started = getattr(self._checkout, 'started', None)
+        if started is not None:
+            pool_checkout_wait.observe(
+                time.perf_counter() - started, _address(event)
+            )
+            self._checkout.started = None
+
+
+def _address(event) -> str:
+    host, port = event.address
+    return f'{host}:{port}'
+
+
+pool_listener = PoolListener()
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.routes = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            requests_in_flight.dec()
+            request_duration.observe(
+                time.perf_counter() - started,
+                scope['method'], self._route(scope), status_code,
+            )
+
+    def _route(self, scope) -> str:
+        # Only route templates become labels, never raw paths.
+        endpoint = scope.get('endpoint')
+        if endpoint is None or 'app' not in scope:
+            return UNMATCHED
+        if endpoint not in self.routes:
+            self.routes[endpoint] = route_path(scope['app'], endpoint)
+        return self.routes[endpoint] or UNMATCHED
+
+
+async def sample_loop_lag(interval: float):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        loop_lag.set(lag)
+        loop_lag_seconds.observe(lag)
+
+def start():
+    global _lag_task
+    if _lag_task is None:
+        _lag_task = asyncio.create_task(
+            sample_loop_lag(settings.loop_lag_interval)
+        )
+
+async def stop():
+    global _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        try:
+            await _lag_task
+        except asyncio.CancelledError:
+            pass
+        _lag_task = None
@@ -0,0 +1,73 @@
+'''
+Moves projects stored as 'initial_activity' documents in
+activities_collection into projects_collection.
+
+    python -m src.migrations
+
+Projects keep their _id, so existing /project/{id} links stay valid.
+Every other activity of the project gets a project_id reference. The
+migration is idempotent and can be rerun safely.
+'''
+import asyncio
+import json
+import logging
+from pymongo import ReplaceOne, UpdateMany
+import database
+
+logger = logging.getLogger(__name__)
+
+
+async def migrate_projects() -> dict:
+    report = {'projects': 0, 'activities': 0, 'duplicates': []}
+    project_writes = []
+    activity_writes = []
+    seen_names = set()
+    migrated_ids = []
+    async for project in database.activities_collection.find(
+        {'activity_name': 'initial_activity'}, sort=[('_id', 1)]
+    ):
+        if project['project_name'] in seen_names:
+            report['duplicates'].append(str(project['_id']))
+            continue
+        seen_names.add(project['project_name'])
+        migrated_ids.append(project['_id'])
+        project_writes.append(ReplaceOne(
+            {'_id': project['_id']},
+            {
+                'project_name': project['project_name'],
+                'editor': project['editor'],
+                'deadline': project['deadline'],
+                'project_status': project['project_status'],
+            },
+            upsert=True
+        ))
+        activity_writes.append(UpdateMany(
+            {
+                'project_name': project['project_name'],
+                'activity_name': {'$ne': 'initial_activity'},
+            },
+            {'$set': {'project_id': project['_id']}}
+        ))
+    if project_writes:
+        result = await database.projects_collection.bulk_write(
+            project_writes, ordered=False
+        )
+        report['projects'] = result.upserted_count + result.modified_count
+        result = await database.activities_collection.bulk_write(
+            activity_writes, ordered=False
+        )
+        report['activities'] = result.modified_count
+        await database.activities_collection.delete_many(
+            {'_id': {'$in': migrated_ids}}
+        )
+    if report['duplicates']:
+        logger.warning(
+            'projects with duplicate names were left in '
+            'activities_collection: %s', report['duplicates']
+        )
+    return report
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(asyncio.run(migrate_projects()), indent=2))
@@ -0,0 +1,68 @@
+import asyncio
+import time
+from config import settings
+from src import users
+
+
+class NavigationSnapshot:
+    '''Everything the project manager sidebar renders, already sorted.'''
+
+    def __init__(
+        self, chief_editors: list, translators: list,
+        created_projects: list, finished_projects: list,
+    ):
+        self.chief_editors = chief_editors
+        self.translators = translators
+        self.projects = {
+            'created': created_projects,
+            'finished': finished_projects,
+        }
+        self.built_at = time.monotonic()
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.built_at < settings.navigation_ttl
+
+
+_snapshot = None
+_generation = 0
+_lock = asyncio.Lock()
+# Set by invalidate(): the next build follows a write made here and must
+# see it, so it reads from the primary instead of a secondary.
+_read_primary = False
+
+
+async def _build(secondary_ok: bool) -> NavigationSnapshot:
+    chief_editors, translators, created, finished = await asyncio.gather(
+        users.get_list_of_users('chief_editor', secondary_ok=secondary_ok),
+        users.get_list_of_users('translator', secondary_ok=secondary_ok),
+        users.get_projects('created', secondary_ok=secondary_ok),
+        users.get_projects('finished', secondary_ok=secondary_ok),
+    )
+    by_username = lambda user: user['username'].lower()
+    return NavigationSnapshot(
+        sorted(chief_editors, key=by_username),
+        sorted(translators, key=by_username),
+        created,
+        finished,
+    )
+
+async def get_snapshot() -> NavigationSnapshot:
+    global _snapshot, _read_primary
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.is_fresh():
+        return snapshot
+    async with _lock:
+        if _snapshot is not None and _snapshot.is_fresh():
+            return _snapshot
+        generation = _generation
+        snapshot = await _build(secondary_ok=not _read_primary)
+        if generation == _generation:
+            _snapshot = snapshot
+            _read_primary = False
+        return snapshot
+
+def invalidate():
+    global _snapshot, _generation, _read_primary
+    _generation += 1
+    _snapshot = None
+    _read_primary = True
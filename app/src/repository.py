@@ -0,0 +1,117 @@
+'''
+Projection-aware reads with compact record types.
+
+Each record type declares the Mongo fields it is built from, and only
+those fields are requested from the server. Records use __slots__ and
+support item access, so templates and routers can keep using
+record['field'].
+'''
+from src import rollups
+
+
+class Record:
+    __slots__ = ()
+    # attribute name -> Mongo field
+    source = {}
+
+    def __init__(self, document: dict):
+        for attribute, field in self.source.items():
+            value = document.get(field)
+            if field == '_id' and value is not None:
+                value = str(value)
+            setattr(self, attribute, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.as_dict()})'
+
+    @classmethod
+    def projection(cls, fields: list = None) -> dict:
+        attributes = cls.source if fields is None else [
+            attribute for attribute in fields if attribute in cls.source
+        ]
+        return {cls.source[attribute]: 1 for attribute in attributes}
+
+    def as_dict(self, fields: list = None) -> dict:
+        attributes = self.__slots__ if fields is None else fields
+        return {
+            attribute: getattr(self, attribute)
+            for attribute in attributes if hasattr(self, attribute)
+        }
+
+
+class UserRef(Record):
+    __slots__ = ('id', 'username')
+    source = {'id': '_id', 'username': 'username'}
+
+
+class UserSummary(Record):
+    __slots__ = (
+        'id', 'login', 'username', 'role', 'efficiency', 'status', 'is_active'
+    )
+    source = {attribute: attribute for attribute in __slots__}
+    source['id'] = '_id'
+
+
+class ProjectRecord(Record):
+    __slots__ = (
+        'id', 'project_name', 'editor', 'status', 'deadline', 'progress'
+    )
+    source = {
+        'id': '_id',
+        'project_name': 'project_name',
+        'editor': 'editor',
+        'status': 'project_status',
+        'deadline': 'deadline',
+    }
+    rollup_fields = (
+        'activity_total', 'activity_counts', 'completeness_sum',
+        'next_deadline',
+    )
+
+    def __init__(self, document: dict):
+        super().__init__(document)
+        self.progress = None
+        if 'activity_total' in document:
+            self.progress = rollups.rollup_helper(document)
+
+    @classmethod
+    def projection(cls, fields: list = None) -> dict:
+        projection = super().projection(fields)
+        if fields is None or 'progress' in fields:
+            projection.update({field: 1 for field in cls.rollup_fields})
+        return projection
+
+
+class ActivityRecord(Record):
+    __slots__ = (
+        '_id', 'project_name', 'editor', 'status', 'activity_name',
+        'translator', 'deadline', 'project_status', 'completeness',
+    )
+    source = {attribute: attribute for attribute in __slots__}
+    source['translator'] = 'translators'
+
+
+async def find(
+    collection, record_type, query: dict, fields: list = None, **options
+) -> list:
+    '''Runs query on collection and returns record_type instances.
+
+    fields restricts the projection to those record attributes; any
+    other keyword (sort, skip, limit) is passed to find().
+    '''
+    projection = record_type.projection(fields)
+    if '_id' not in projection:
+        projection['_id'] = 0
+    return [
+        record_type(document)
+        async for document in collection.find(query, projection, **options)
+    ]
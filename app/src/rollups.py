@@ -0,0 +1,163 @@
+'''
+Per-project activity rollups kept on projects_collection documents:
+activity_total, activity_counts (by status), completeness_sum and
+next_deadline (earliest deadline of an unfinished activity).
+
+They are maintained incrementally by users.create_activity and
+users.edit_activity. To recompute them from scratch run
+
+    python -m src.rollups
+'''
+import asyncio
+import json
+import database
+from models import ACTIVITY_STATUSES
+
+FINISHED = 'finished'
+UNKNOWN = 'unknown'
+
+
+def rollup_helper(project) -> dict: #TESTED
+    total = project.get('activity_total', 0)
+    return {
+        'activity_total': total,
+        'activity_counts': project.get('activity_counts', {}),
+        'completeness': (
+            project.get('completeness_sum', 0) / total if total else 0.0
+        ),
+        'next_deadline': project.get('next_deadline'),
+    }
+
+def rollup_update(increments: dict, open_deadline=None) -> list: #TESTED
+    '''Update pipeline adding increments to the rollup counters and,
+    given an open_deadline, moving next_deadline to it if it is earlier.
+    A pipeline rather than $inc/$min because recompute_next_deadline and
+    rebuild_rollups store next_deadline as null, which BSON sorts below
+    every date, so $min would never replace it.'''
+    fields = {
+        field: {'$add': [{'$ifNull': [f'${field}', 0]}, amount]}
+        for field, amount in increments.items()
+    }
+    if open_deadline is not None:
+        # The $min expression, unlike the update operator, skips nulls.
+        fields['next_deadline'] = {'$min': ['$next_deadline', open_deadline]}
+    return [{'$set': fields}]
+
+def status_counter(status) -> str: #TESTED
+    # The status becomes part of a field path, where '.' or a leading '$'
+    # would break the update, so other statuses are counted as unknown.
+    if status not in ACTIVITY_STATUSES:
+        status = UNKNOWN
+    return f'activity_counts.{status}'
+
+async def recompute_next_deadline(project_id):
+    next_activity = await database.activities_collection.find_one(
+        {'project_id': project_id, 'status': {'$ne': FINISHED}},
+        {'deadline': 1},
+        sort=[('deadline', 1)]
+    )
+    await database.projects_collection.update_one(
+        {'_id': project_id},
+        {'$set': {
+            'next_deadline': next_activity['deadline'] if next_activity else None
+        }}
+    )
+
+async def activities_created(project_id, activities: list):
+    if project_id is None or not activities:
+        return
+    increments = {'activity_total': len(activities), 'completeness_sum': 0}
+    open_deadlines = []
+    for activity in activities:
+        counter = status_counter(activity['status'])
+        increments[counter] = increments.get(counter, 0) + 1
+        increments['completeness_sum'] += activity['completeness']
+        if activity['status'] != FINISHED:
+            open_deadlines.append(activity['deadline'])
+    await database.projects_collection.update_one(
+        {'_id': project_id},
+        rollup_update(increments, min(open_deadlines, default=None))
+    )
+
+async def activity_created(activity: dict):
+    await activities_created(activity.get('project_id'), [activity])
+
+async def activity_changed(before: dict, after: dict):
+    project_id = after.get('project_id')
+    if project_id is None:
+        return
+    increments = {}
+    if before['status'] != after['status']:
+        increments[status_counter(before['status'])] = -1
+        increments[status_counter(after['status'])] = 1
+    if before['completeness'] != after['completeness']:
+        increments['completeness_sum'] = (
+            after['completeness'] - before['completeness']
+        )
+    was_open = before['status'] != FINISHED
+    is_open = after['status'] != FINISHED
+    open_deadline = None
+    if is_open and (not was_open or after['deadline'] < before['deadline']):
+        open_deadline = after['deadline']
+    if increments or open_deadline is not None:
+        await database.projects_collection.update_one(
+            {'_id': project_id}, rollup_update(increments, open_deadline)
+        )
+    if was_open and (not is_open or after['deadline'] > before['deadline']):
+        # The old deadline may have been the project's next deadline.
+        project = await database.projects_collection.find_one(
+            {'_id': project_id, 'next_deadline': before['deadline']},
+            {'_id': 1}
+        )
+        if project:
+            await recompute_next_deadline(project_id)
+
+async def rebuild_rollups() -> int:
+    await database.projects_collection.update_many({}, {'$set': {
+        'activity_total': 0,
+        'activity_counts': {},
+        'completeness_sum': 0,
+        'next_deadline': None,
+    }})
+    pipeline = [
+        {'$match': {'project_id': {'$ne': None}}},
+        {'$group': {
+            '_id': {
+                'project_id': '$project_id',
+                'status': {'$cond': [
+                    {'$in': ['$status', list(ACTIVITY_STATUSES)]},
+                    '$status', UNKNOWN,
+                ]},
+            },
+            'count': {'$sum': 1},
+            'completeness_sum': {'$sum': '$completeness'},
+            'next_deadline': {'$min': {
+                '$cond': [{'$ne': ['$status', FINISHED]}, '$deadline', None]
+            }},
+        }},
+        {'$group': {
+            '_id': '$_id.project_id',
+            'activity_total': {'$sum': '$count'},
+            'completeness_sum': {'$sum': '$completeness_sum'},
+            'next_deadline': {'$min': '$next_deadline'},
+            'activity_counts': {
+                '$push': {'k': '$_id.status', 'v': '$count'}
+            },
+        }},
+        {'$set': {'activity_counts': {'$arrayToObject': '$activity_counts'}}},
+        {'$merge': {
+            'into': database.projects_collection.name,
+            'on': '_id',
+            'whenMatched': 'merge',
+            'whenNotMatched': 'discard',
+        }},
+    ]
+    await database.activities_collection.aggregate(pipeline).to_list(None)
+    return await database.projects_collection.count_documents(
+        {'activity_total': {'$gt': 0}}
+    )
+
+
+if __name__ == '__main__':
+    projects = asyncio.run(rebuild_rollups())
+    print(json.dumps({'projects_with_activities': projects}))
@@ -1,19 +1,22 @@
 from fastapi import (
-    APIRouter, HTTPException, Depends, Request, Response, status
+    APIRouter, HTTPException, Depends, Query, Request, Response, status
 )
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
 from src import users
-import math
+import asyncio
 import models
 import datetime
-from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
-from src import view
+from config import settings
+from fastapi.responses import HTMLResponse, ORJSONResponse, PlainTextResponse
+from src import live, metrics, navigation, search, versions, view
+from src.context import PageContext
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates/")
 url = "localhost:8000"
+PROJECTS_PER_PAGE = 8
 
 '''USER STORY AUTHORIZATION'''
 
@@ -57,7 +60,9 @@ async def app_create_user(user: models.UserCreate):
     db_user = await users.get_user_by_login(login=user.login)
     if db_user:
         raise HTTPException(status_code=400, detail="Login already registered")
-    return await users.create_user(user=user)
+    result = await users.create_user(user=user)
+    navigation.invalidate()
+    return result
 
 @router.get('/login', response_class=HTMLResponse)
 async def login(request: Request, not_valid: bool = False):
@@ -81,7 +86,7 @@ async def auth(
             headers = {"Location": f"http://{url}/login?not_valid=true"}
         )
         
-    if not users.validate_password(
+    if not await users.validate_password_async(
         password=form_data.password, hashed_password=user["password"]
     ):
         raise HTTPException(
@@ -90,9 +95,8 @@ async def auth(
             headers = {"Location": f"http://{url}/login?not_valid=true"}
         )
 
-    token = await users.create_user_token(
-        user_id=users.user_helper(user)["id"]
-    )
+    token = users.create_session_token(str(user['_id']), user['role'])
+    users.get_user_cache().set(str(user['_id']), user)
     response = RedirectResponse(
         f'http://{url}/', 
         status_code=status.HTTP_303_SEE_OTHER
@@ -101,7 +105,7 @@ async def auth(
         key='Authorization',
         value=token,
         httponly=True,
-        expires=86400
+        expires=settings.session_ttl
     )
     return response
 
@@ -125,57 +129,125 @@ async def translator_logout(response: Response):
 
 @router.get("/me")
 async def read_users_me(request: Request):
-    user = await users.get_current_user_from_cookie(request)
+    context = PageContext(request)
+    redirect = await context.authorize(('translator', 'chief_editor'))
+    if redirect:
+        return RedirectResponse(
+            f'http://{url}{redirect}', status_code=status.HTTP_303_SEE_OTHER
+        )
+    user = context.user
+    user_id = str(user['_id'])
+    not_modified = context.not_modified(
+        versions.USERS, versions.user_scope(user_id)
+    )
+    if not_modified:
+        return not_modified
+    # Read before the data, so the live stream reloads the page if a
+    # write lands in between.
+    live_version = await live.page_version(user_id)
     if user['role'] == 'translator':
-        user_id = str(user['_id'])
-        activities = await users.get_user_activities(user_id, 'translators')
-        current_user = await users.get_user_by_id(user_id)
-        return view.translator_page(request, activities, current_user)
-    if user['role'] == 'chief_editor':
-        user_id = str(user['_id'])
-        activities = await users.get_user_activities(user_id, 'editor')
-        current_chief_editor = await users.get_user_by_id(user_id)
-        return view.chief_editor_page(
-            request, current_chief_editor, activities
+        data = await context.fetch(
+            activities=lambda: users.get_user_activities(user_id, 'translators')
         )
-    return RedirectResponse(
-        f'http://{url}', status_code=status.HTTP_303_SEE_OTHER
+        current_user = users.user_summary_helper(user)
+        return context.tagged(view.translator_page(
+            request, data.activities, current_user, live_version
+        ))
+    data = await context.fetch(
+        activities=lambda: users.get_user_activities(user_id, 'editor')
+    )
+    current_chief_editor = users.user_summary_helper(user)
+    return context.tagged(view.chief_editor_page(
+        request, current_chief_editor, data.activities, live_version
+    ))
+
+@router.get("/me/events")
+async def stream_my_events(request: Request, since: str | None = None):
+    context = PageContext(request)
+    if await context.authorize(('translator', 'chief_editor')):
+        raise HTTPException(status_code=401, detail='Not authenticated')
+    return StreamingResponse(
+        live.stream(str(context.user['_id']), since),
+        media_type='text/event-stream', headers=live.HEADERS,
     )
 
 '''USER STORY PROJECT AND ARCHIVE'''
 
+async def get_projects_page(project_status: str, page: int, cursor: str):
+    # The archive is read-only, so replication lag there is harmless.
+    secondary_ok = project_status == 'finished'
+    if not cursor and page > 1:
+        # A bare page number (typed in, or from a mangled link) is found in
+        # the sidebar snapshot rather than by skipping rows.
+        snapshot = await navigation.get_snapshot()
+        cursors = users.page_cursors(
+            snapshot.projects[project_status], PROJECTS_PER_PAGE
+        )
+        if page > len(cursors):
+            return []
+        cursor = cursors[page - 1]
+    projects_current_page = await users.get_projects(
+        project_status, limit=PROJECTS_PER_PAGE, cursor=cursor,
+        secondary_ok=secondary_ok,
+    )
+    editors = await users.UserLoader().load_many(
+        [project['editor'] for project in projects_current_page]
+    )
+    for project, editor in zip(projects_current_page, editors):
+        if editor:
+            project['editor'] = editor['username']
+    return projects_current_page
+
 @router.get("/projects")
 async def show_projects(
         request: Request, archive: bool = False, page: int = 1,
-        incorrect_name: bool = False, incorrect_time: bool = False,
+        cursor: str | None = None, incorrect_name: bool = False,
+        incorrect_time: bool = False,
     ):
-    
-    chief_editors_list = await users.get_list_of_users('chief_editor')
-    translators_list = await users.get_list_of_users('translator')
-    if archive:
-        projects = await users.get_projects('finished')
-    else:
-        projects = await users.get_projects('created')
-    projects = sorted(projects, key=lambda d: d['deadline'])
-    for project in projects:
-        result = await users.get_user_by_id(project['editor'])
-        project['editor'] = result['username']
-    projects_current_page = projects[8*(page-1):8*page]
-    num_of_pages = [x+1 for x in range(math.floor(len(projects)/8) + 1)]
-    user = await users.get_current_user_from_cookie(request)
-    if not user:
+    context = PageContext(request)
+    redirect = await context.authorize(('project_manager',))
+    if redirect:
         return RedirectResponse(
-            f'http://{url}/login', status_code=status.HTTP_303_SEE_OTHER
-        )
-    if user['role'] == 'project_manager':
-        return view.projects_page(
-            request, chief_editors_list, projects, projects_current_page, 
-            translators_list, num_of_pages, page, archive, incorrect_time,
-            incorrect_name,
+            f'http://{url}{redirect}', status_code=status.HTTP_303_SEE_OTHER
         )
-    return RedirectResponse(
-        f'http://{url}', status_code=status.HTTP_303_SEE_OTHER
+    not_modified = context.not_modified(versions.PROJECTS, versions.USERS)
+    if not_modified:
+        return not_modified
+    project_status = 'finished' if archive else 'created'
+    if cursor:
+        try:
+            users.decode_project_cursor(cursor)
+        except ValueError:
+            # A mangled link falls back to the page number.
+            cursor = None
+    data = await context.fetch(
+        snapshot=navigation.get_snapshot,
+        projects_current_page=lambda: get_projects_page(
+            project_status, page, cursor
+        ),
+    )
+    projects_current_page = data.projects_current_page
+    next_cursor = None
+    if len(projects_current_page) == PROJECTS_PER_PAGE:
+        next_cursor = users.encode_project_cursor(projects_current_page[-1])
+    # The sidebar already lists every project in page order, so each
+    # numbered link gets a cursor and no page is read with skip.
+    page_cursors = users.page_cursors(
+        data.snapshot.projects[project_status], PROJECTS_PER_PAGE
     )
+    num_of_pages = [x+1 for x in range(len(page_cursors))]
+    return context.tagged(view.projects_page(
+        request, data.snapshot.chief_editors,
+        data.snapshot.projects[project_status], projects_current_page,
+        data.snapshot.translators, num_of_pages, page, archive,
+        incorrect_time, incorrect_name, next_cursor, page_cursors,
+    ))
+
+async def find_project(project_id: str):
+    try:
+        return await users.get_project_by_id(project_id)
+    except TypeError:
+        return None
 
 @router.get("/project/{project_id}")
 async def show_project(
@@ -183,42 +255,52 @@ async def show_project(
     project_id: str, 
     incorrect_time: bool = False
 ):
-    chief_editors_list = await users.get_list_of_users('chief_editor')
-    translators_list = await users.get_list_of_users('translator')
-    project =  await users.get_project_by_id(project_id)
-    if project['status'] == 'finished':
-        projects = await users.get_projects('finished')
-    else:
-        projects = await users.get_projects('created')
-    projects = sorted(projects, key=lambda d: d['deadline']) 
-    user = await users.get_current_user_from_cookie(request)
-    project_activities = list(
-        filter(
-            lambda i: i['activity_name'] != 'initial_activity', 
-            await users.get_activities_of_the_project(project['project_name'])
-        )
-    )
-    project_translators = []
-    for project_activity in project_activities:
-        result = await users.get_user_by_id(project_activity['translator'])
-        project_activity['translator'] = result['username']
-        if result not in project_translators:
-            project_translators.append(result)
-    current_chief_editor = await users.get_user_by_id(project['editor'])
-    if not user:
+    context = PageContext(request)
+    redirect = await context.authorize(('project_manager',))
+    if redirect:
         return RedirectResponse(
-            f'http://{url}/login', status_code=status.HTTP_303_SEE_OTHER
-        )
-    if user['role'] == 'project_manager':
-        return view.project_page(
-            request, chief_editors_list, projects, translators_list, 
-            project['project_name'], current_chief_editor, project['status'],
-            project_activities, project_id, project_translators, 
-            incorrect_time,
+            f'http://{url}{redirect}', status_code=status.HTTP_303_SEE_OTHER
         )
-    return RedirectResponse(
-        f'http://{url}', status_code=status.HTTP_303_SEE_OTHER
+    if not ObjectId.is_valid(project_id):
+        raise HTTPException(status_code=404, detail='Project not found')
+    not_modified = context.not_modified(
+        versions.PROJECTS, versions.USERS, versions.project_scope(project_id)
+    )
+    if not_modified:
+        return not_modified
+    data = await context.fetch(
+        snapshot=navigation.get_snapshot,
+        project=lambda: find_project(project_id),
+        project_activities=lambda: users.get_project_activities(project_id),
+    )
+    snapshot = data.snapshot
+    project = data.project
+    if project is None:
+        raise HTTPException(status_code=404, detail='Project not found')
+    project_activities = data.project_activities
+    if project['status'] == 'finished':
+        projects = snapshot.projects['finished']
+    else:
+        projects = snapshot.projects['created']
+    loader = users.UserLoader()
+    current_chief_editor, translators = await asyncio.gather(
+        loader.load(project['editor']),
+        loader.load_many(
+            [activity['translator'] for activity in project_activities]
+        ),
     )
+    project_translators = {}
+    for project_activity, translator in zip(project_activities, translators):
+        if translator:
+            project_activity['translator'] = translator['username']
+            project_translators[translator['id']] = translator
+    project_translators = list(project_translators.values())
+    return context.tagged(view.project_page(
+        request, snapshot.chief_editors, projects, snapshot.translators,
+        project['project_name'], current_chief_editor,
+        project['status'], project_activities, project_id,
+        project_translators, incorrect_time,
+    ))
     
 
 @router.post("/create_project")
@@ -241,19 +323,22 @@ async def create_project(request: Request):
             status_code=status.HTTP_303_SEE_OTHER
         )
     editor = result['editor']
-    activity = {
-        'activity_name': 'initial_activity',
+    project = {
         'project_name': project_name,
-        'translators': None,
         'editor': editor,
         'deadline': datetime.datetime(
             int(deadline[0]), int(deadline[1]), int(deadline[2]), 0, 0
         ),
         'project_status': 'created',
-        'completeness': 0,
-        'status': 'finished'
     }
-    await users.create_activity(models.ActivityModel(**activity))
+    try:
+        await users.create_project(models.ProjectCreate(**project))
+    except DuplicateKeyError:
+        return RedirectResponse(
+            f'http://{url}/projects?incorrect_name=true', 
+            status_code=status.HTTP_303_SEE_OTHER
+        )
+    navigation.invalidate()
     return RedirectResponse(
         f'http://{url}/projects', status_code=status.HTTP_303_SEE_OTHER
     )
@@ -279,21 +364,23 @@ async def edit_project(request: Request):
             f'http://{url}/projects?incorrect_name=true', 
             status_code=status.HTTP_303_SEE_OTHER
         )
-    activity = {
-        'activity_name': 'initial_activity',
+    project = {
         'project_name': project_name,
-        'translators': None,
         'editor': editor,
         'deadline': datetime.datetime(
             int(deadline[0]), int(deadline[1]), int(deadline[2]), 0, 0
         ),
-        'project_status': 'created',
-        'completeness': 0,
-        'status': 'finished'
     }
-    await users.edit_project(
-        models.ActivityModel(**activity), result['_id']
-    )
+    try:
+        await users.edit_project(
+            models.ProjectCreate(**project), result['_id']
+        )
+    except DuplicateKeyError:
+        return RedirectResponse(
+            f'http://{url}/projects?incorrect_name=true', 
+            status_code=status.HTTP_303_SEE_OTHER
+        )
+    navigation.invalidate()
     return RedirectResponse(
         f'http://{url}/projects', status_code=status.HTTP_303_SEE_OTHER
     )
@@ -302,19 +389,16 @@ async def edit_project(request: Request):
 async def change_chief_editor(request: Request):
     result = await request.form()
     project = await users.get_project_by_id(result['_id'])
-    activity = {
-        'activity_name': 'initial_activity',
+    project = {
         'project_name': project['project_name'],
-        'translators': None,
         'editor': result['editor'],
         'deadline': project['deadline'],
         'project_status': project['status'],
-        'completeness': 0,
-        'status': 'finished'
     }
     await users.edit_project(
-        models.ActivityModel(**activity), result['_id']
+        models.ProjectCreate(**project), result['_id']
     )
+    navigation.invalidate()
     return RedirectResponse(
         f"http://{url}/project/{result['_id']}",
         status_code=status.HTTP_303_SEE_OTHER
@@ -329,6 +413,7 @@ async def create_activity(request: Request):
     activity = {
         'activity_name': form['activity_name'],
         'project_name': form['project_name'],
+        'project_id': form['project_id'],
         'translators': form['translator'],
         'editor': form['current_chief_editor'],
         'deadline': datetime.datetime(
@@ -376,51 +461,190 @@ async def edit_activity(request: Request):
         status_code=status.HTTP_303_SEE_OTHER
     )
 
+@router.post("/project/finish_activity")
+async def finish_activity(request: Request):
+    user = await users.get_current_user_from_cookie(request)
+    if not user or user['role'] != 'project_manager':
+        raise HTTPException(status_code=403, detail='Not allowed')
+    form = await request.form()
+    if not ObjectId.is_valid(form['activity_id']):
+        raise HTTPException(status_code=404, detail='Activity not found')
+    await users.finish_activity(form['activity_id'])
+    return RedirectResponse(
+        f"http://{url}/project/{form['project_id']}",
+        status_code=status.HTTP_303_SEE_OTHER
+    )
+
+@router.post("/project/{project_id}/import_activities")
+async def import_activities(
+    request: Request, project_id: str, format: str | None = None,
+    batch_size: int | None = Query(None, ge=1, le=10000),
+):
+    user = await users.get_current_user_from_cookie(request)
+    if not user or user['role'] != 'project_manager':
+        raise HTTPException(status_code=403, detail='Not allowed')
+    # The import and export modules load on their first use, not at startup.
+    from src import importer
+    if format is None:
+        content_type = request.headers.get('content-type', '')
+        format = importer.CSV if 'csv' in content_type else importer.NDJSON
+    if format not in (importer.CSV, importer.NDJSON):
+        raise HTTPException(status_code=400, detail='Unsupported format')
+    if not ObjectId.is_valid(project_id):
+        raise HTTPException(status_code=404, detail='Project not found')
+    try:
+        project = await users.get_project_by_id(project_id)
+    except TypeError:
+        raise HTTPException(status_code=404, detail='Project not found')
+    try:
+        return await importer.import_activities(
+            request.stream(), format, project, batch_size
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+'''USER STORY EXPORT'''
+
+def check_export_format(format: str):
+    from src import exporter
+    if format not in exporter.MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail='Unsupported format')
+
+def export_response(rows, format: str, name: str):
+    from src import exporter
+    return StreamingResponse(
+        rows,
+        media_type=exporter.MEDIA_TYPES[format],
+        headers={
+            'Content-Disposition': f'attachment; filename="{name}.{format}"'
+        }
+    )
+
+@router.get("/export/activities")
+async def export_activities(
+    request: Request, format: str = 'csv',
+    project_id: str | None = None,
+    activity_status: str | None = Query(None, alias='status'),
+    deadline_from: datetime.date | None = None,
+    deadline_to: datetime.date | None = None,
+):
+    user = await users.get_current_user_from_cookie(request)
+    if not user or user['role'] != 'project_manager':
+        raise HTTPException(status_code=403, detail='Not allowed')
+    check_export_format(format)
+    from src import exporter
+    if project_id and not ObjectId.is_valid(project_id):
+        raise HTTPException(status_code=404, detail='Project not found')
+    to_datetime = lambda day: day and datetime.datetime.combine(
+        day, datetime.time()
+    )
+    query = exporter.activities_query(
+        project_id, activity_status, to_datetime(deadline_from),
+        to_datetime(deadline_to),
+    )
+    return export_response(
+        exporter.export_activities(query, format), format, 'activities'
+    )
+
+@router.get("/export/projects")
+async def export_projects(
+    request: Request, format: str = 'csv',
+    project_status: str | None = Query(None, alias='status'),
+):
+    user = await users.get_current_user_from_cookie(request)
+    if not user or user['role'] != 'project_manager':
+        raise HTTPException(status_code=403, detail='Not allowed')
+    check_export_format(format)
+    from src import exporter
+    return export_response(
+        exporter.export_projects(project_status, format), format, 'projects'
+    )
+
+'''USER STORY SEARCH'''
+
+@router.get("/search", response_class=ORJSONResponse)
+async def search_everything(
+    request: Request, q: str = Query(..., min_length=1, max_length=200),
+    kind: list[str] | None = Query(None),
+    limit: int = Query(20, ge=1, le=100), offset: int = Query(0, ge=0),
+):
+    user = await users.get_current_user_from_cookie(request)
+    if not user:
+        raise HTTPException(status_code=401, detail='Not authenticated')
+    # Hits link to every project and user page, which only PMs may see.
+    if user['role'] != 'project_manager':
+        raise HTTPException(status_code=403, detail='Not allowed')
+    result = search.index.search(q, kinds=kind, limit=limit, offset=offset)
+    return {**result, 'complete': search.index.ready}
+
+'''USER STORY METRICS'''
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def show_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type='text/plain; version=0.0.4'
+    )
 
 '''USER STORY TRANSLATOR'''
 
 @router.get("/translator/{translator_id}")
 async def show_translator(request: Request, translator_id: str):
-    current_translator = await users.get_user_by_id(translator_id)
-    chief_editors_list = await users.get_list_of_users('chief_editor')
-    translators_list = await users.get_list_of_users('translator')
-    projects = await users.get_projects('created')
-    projects = sorted(projects, key=lambda d: d['deadline'])
-    activities = await users.get_user_activities(translator_id, 'translators')
-    user = await users.get_current_user_from_cookie(request)
-    if not user:
+    context = PageContext(request)
+    redirect = await context.authorize(('project_manager',))
+    if redirect:
         return RedirectResponse(
-            f'http://{url}/login', status_code=status.HTTP_303_SEE_OTHER
+            f'http://{url}{redirect}', status_code=status.HTTP_303_SEE_OTHER
         )
-    if user['role'] == 'project_manager':
-        return view.translator_pm_page(
-            request, chief_editors_list, projects,
-            translators_list, current_translator['username'], activities
-        )
-    return RedirectResponse(
-        f'http://{url}', status_code=status.HTTP_303_SEE_OTHER
+    if not ObjectId.is_valid(translator_id):
+        raise HTTPException(status_code=404, detail='Translator not found')
+    not_modified = context.not_modified(
+        versions.PROJECTS, versions.USERS, versions.user_scope(translator_id)
     )
+    if not_modified:
+        return not_modified
+    data = await context.fetch(
+        current_translator=lambda: users.UserLoader().load(translator_id),
+        snapshot=navigation.get_snapshot,
+        activities=lambda: users.get_user_activities(
+            translator_id, 'translators'
+        ),
+    )
+    translator = data.current_translator
+    if translator is None or translator['role'] != 'translator':
+        raise HTTPException(status_code=404, detail='Translator not found')
+    return context.tagged(view.translator_pm_page(
+        request, data.snapshot.chief_editors, data.snapshot.projects['created'],
+        data.snapshot.translators, data.current_translator['username'],
+        data.activities
+    ))
 
 '''USER STORY CHIEF EDITOR'''
 
 @router.get("/chief_editor/{chief_editor_id}")
 async def show_chief_editor(request: Request, chief_editor_id: str):
-    current_chief_editor = await users.get_user_by_id(chief_editor_id)
-    chief_editors_list = await users.get_list_of_users('chief_editor')
-    translators_list = await users.get_list_of_users('translator')
-    projects = await users.get_projects('created')
-    projects = sorted(projects, key=lambda d: d['deadline'])
-    activities = await users.get_user_activities(chief_editor_id, 'editor')
-    user = await users.get_current_user_from_cookie(request)
-    if not user:
+    context = PageContext(request)
+    redirect = await context.authorize(('project_manager',))
+    if redirect:
         return RedirectResponse(
-            f'http://{url}/login', status_code=status.HTTP_303_SEE_OTHER
-        )
-    if user['role'] == 'project_manager':
-        return view.chief_editor_pm_page(
-            request, chief_editors_list, projects,
-            translators_list, current_chief_editor, activities
+            f'http://{url}{redirect}', status_code=status.HTTP_303_SEE_OTHER
         )
-    return RedirectResponse(
-        f'http://{url}', status_code=status.HTTP_303_SEE_OTHER
+    if not ObjectId.is_valid(chief_editor_id):
+        raise HTTPException(status_code=404, detail='Chief editor not found')
+    not_modified = context.not_modified(
+        versions.PROJECTS, versions.USERS,
+        versions.user_scope(chief_editor_id)
+    )
+    if not_modified:
+        return not_modified
+    data = await context.fetch(
+        current_chief_editor=lambda: users.UserLoader().load(chief_editor_id),
+        snapshot=navigation.get_snapshot,
+        activities=lambda: users.get_user_activities(chief_editor_id, 'editor'),
     )
+    chief_editor = data.current_chief_editor
+    if chief_editor is None or chief_editor['role'] != 'chief_editor':
+        raise HTTPException(status_code=404, detail='Chief editor not found')
+    return context.tagged(view.chief_editor_pm_page(
+        request, data.snapshot.chief_editors, data.snapshot.projects['created'],
+        data.snapshot.translators, data.current_chief_editor, data.activities
+    ))
@@ -0,0 +1,301 @@
+'''
+In-process inverted index over project names, activity names and
+usernames, supporting token and prefix search.
+
+The index is built from Mongo once per worker at startup and then kept
+current by the write functions in src/users.py. Writes made while the
+build is still reading win over what it read, so it never brings back a
+stale title. Query tokens are matched as prefixes of indexed tokens;
+exact token matches and titles starting with the query rank higher.
+'''
+import asyncio
+import heapq
+import logging
+import re
+from bisect import bisect_left, insort
+from collections import defaultdict
+from pymongo.errors import PyMongoError
+import database
+
+logger = logging.getLogger(__name__)
+
+PROJECT = 'project'
+ACTIVITY = 'activity'
+USER = 'user'
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> list: #TESTED
+    return _TOKEN.findall(text.lower()) if text else []
+
+
+class SearchIndex:
+
+    def __init__(self):
+        self.ready = False
+        self._written = None
+        self._documents = {}
+        self._postings = defaultdict(set)
+        self._leading = {}
+        self._order = {}
+        self._by_length = {}
+        self._lengths = []
+        self._tokens = []
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add(self, kind: str, doc_id: str, title: str, url: str):
+        if self._written is not None:
+            self._written.add((kind, doc_id))
+        self._add(kind, doc_id, title, url)
+
+    def remove(self, kind: str, doc_id: str):
+        if self._written is not None:
+            self._written.add((kind, doc_id))
+        self._remove(kind, doc_id)
+
+    def begin_build(self):
+        self._written = set()
+
+    def load(self, kind: str, doc_id: str, title: str, url: str): #TESTED
+        '''Adds a document read by the build, unless it was added or
+        removed since the build began: that write is newer.'''
+        if (kind, doc_id) not in self._written:
+            self._add(kind, doc_id, title, url)
+
+    def end_build(self):
+        self._written = None
+
+    def _add(self, kind: str, doc_id: str, title: str, url: str):
+        key = (kind, doc_id)
+        self._remove(kind, doc_id)
+        words = tokenize(title)
+        tokens = frozenset(words)
+        lowered = title.lower()
+        self._documents[key] = (title, url, lowered, tokens)
+        self._order[key] = (len(lowered), lowered)
+        same_length = self._by_length.get(len(lowered))
+        if same_length is None:
+            same_length = self._by_length[len(lowered)] = set()
+            insort(self._lengths, len(lowered))
+        same_length.add(key)
+        if words and lowered.startswith(words[0]):
+            self._leading.setdefault(words[0], set()).add(key)
+        for token in tokens:
+            postings = self._postings[token]
+            if not postings:
+                insort(self._tokens, token)
+            postings.add(key)
+
+    def _remove(self, kind: str, doc_id: str):
+        key = (kind, doc_id)
+        document = self._documents.pop(key, None)
+        if document is None:
+            return
+        del self._order[key]
+        same_length = self._by_length[len(document[2])]
+        same_length.discard(key)
+        if not same_length:
+            del self._by_length[len(document[2])]
+            del self._lengths[bisect_left(self._lengths, len(document[2]))]
+        words = tokenize(document[2])
+        if words and document[2].startswith(words[0]):
+            leading = self._leading[words[0]]
+            leading.discard(key)
+            if not leading:
+                del self._leading[words[0]]
+        for token in document[3]:
+            postings = self._postings[token]
+            postings.discard(key)
+            if not postings:
+                del self._postings[token]
+                del self._tokens[bisect_left(self._tokens, token)]
+
+    def _prefixed(self, prefix: str):
+        position = bisect_left(self._tokens, prefix)
+        while (position < len(self._tokens)
+                and self._tokens[position].startswith(prefix)):
+            yield self._tokens[position]
+            position += 1
+
+    def _matching(self, query_token: str) -> set:
+        postings = [
+            self._postings[token] for token in self._prefixed(query_token)
+        ]
+        if len(postings) == 1:
+            return postings[0]
+        return set().union(*postings)
+
+    def search(
+        self, query: str, kinds: tuple = None, limit: int = 20,
+        offset: int = 0,
+    ) -> dict: #TESTED
+        query_tokens = list(dict.fromkeys(tokenize(query)))
+        if not query_tokens:
+            return {'total': 0, 'results': []}
+        # Candidate selection is pure set algebra. A query token that is
+        # a prefix of another one matches a superset of it, so it cannot
+        # narrow the candidates.
+        narrowing = [
+            token for token in query_tokens
+            if not any(
+                other != token and other.startswith(token)
+                for other in query_tokens
+            )
+        ]
+        matching = sorted(map(self._matching, narrowing), key=len)
+        candidates = matching[0].intersection(*matching[1:])
+        if kinds:
+            candidates = {key for key in candidates if key[0] in kinds}
+        documents = self._documents
+        # Every candidate scores len(query_tokens), plus one per exact
+        # token match and one if its title starts with the query. The
+        # candidates with at least n bonus points are built with set
+        # operations, so only the best tiers are ever sorted.
+        phrase = ' '.join(query_tokens)
+        leading = candidates.intersection(self._leading_keys(query_tokens))
+        if len(query_tokens) > 1:
+            leading = {
+                key for key in leading if documents[key][2].startswith(phrase)
+            }
+        at_least = [candidates]
+        for bonus in (
+            *[self._postings.get(token, ()) for token in query_tokens], leading
+        ):
+            at_least.append(set())
+            for points in range(len(at_least) - 1, 0, -1):
+                at_least[points] = at_least[points].union(
+                    at_least[points - 1].intersection(bonus)
+                )
+        wanted = offset + limit
+        ranked = []
+        for points in range(len(at_least) - 1, -1, -1):
+            tier = at_least[points]
+            if points + 1 < len(at_least):
+                tier = tier.difference(at_least[points + 1])
+            first = self._first(tier, wanted - len(ranked))
+            ranked.extend((points, key) for key in first)
+            if len(ranked) >= wanted:
+                break
+        results = []
+        for extra, key in ranked[offset:]:
+            title, url = documents[key][:2]
+            results.append({
+                'kind': key[0], 'id': key[1], 'title': title, 'url': url,
+                'score': len(query_tokens) + extra,
+            })
+        return {'total': len(candidates), 'results': results}
+
+    def _first(self, keys: set, count: int) -> list:
+        '''The count keys with the shortest, then alphabetically first,
+        titles.'''
+        if len(keys) > count * 10:
+            # Shorter titles rank first, so the keys are gathered one
+            # title length at a time until there are enough of them.
+            shortest = []
+            for length in self._lengths:
+                shortest.extend(keys.intersection(self._by_length[length]))
+                if len(shortest) >= count:
+                    break
+            keys = shortest
+        return heapq.nsmallest(count, keys, key=self._order.__getitem__)
+
+    def _leading_keys(self, query_tokens: list) -> set:
+        # A title starting with the query starts with a token the first
+        # query token prefixes, or with exactly that token when more
+        # follow. With one query token that is the whole condition.
+        if len(query_tokens) > 1:
+            return self._leading.get(query_tokens[0], set())
+        return set().union(*[
+            self._leading[token] for token in self._prefixed(query_tokens[0])
+            if token in self._leading
+        ])
+
+
+def project_url(project_id: str) -> str:
+    return f'/project/{project_id}'
+
+def user_url(user_id: str, role: str) -> str:
+    if role == 'translator':
+        return f'/translator/{user_id}'
+    if role == 'chief_editor':
+        return f'/chief_editor/{user_id}'
+    return None
+
+
+index = SearchIndex()
+
+
+def project_entry(project_id: str, project_name: str) -> tuple:
+    return PROJECT, project_id, project_name, project_url(project_id)
+
+def activity_entry(activity: dict) -> tuple:
+    project_id = activity.get('project_id')
+    return (
+        ACTIVITY, str(activity['_id']), activity['activity_name'],
+        project_url(str(project_id)) if project_id else None
+    )
+
+def user_entry(user_id: str, username: str, role: str) -> tuple:
+    return USER, user_id, username, user_url(user_id, role)
+
+def index_project(project_id: str, project_name: str):
+    index.add(*project_entry(project_id, project_name))
+
+def index_activity(activity: dict):
+    index.add(*activity_entry(activity))
+
+def index_user(user_id: str, username: str, role: str):
+    index.add(*user_entry(user_id, username, role))
+
+
+async def build():
+    index.begin_build()
+    try:
+        async for project in database.projects_collection.find(
+            {}, {'project_name': 1}
+        ):
+            index.load(*project_entry(
+                str(project['_id']), project['project_name']
+            ))
+        async for activity in database.activities_collection.find(
+            {'activity_name': {'$ne': 'initial_activity'}},
+            {'activity_name': 1, 'project_id': 1}
+        ):
+            index.load(*activity_entry(activity))
+        async for user in database.users_collection.find(
+            {}, {'username': 1, 'role': 1}
+        ):
+            index.load(*user_entry(
+                str(user['_id']), user['username'], user.get('role')
+            ))
+    finally:
+        index.end_build()
+    index.ready = True
+    logger.info('search index built with %s documents', len(index))
+
+_builder = None
+
+def start():
+    global _builder
+
+    async def run():
+        try:
+            await build()
+        except PyMongoError:
+            logger.exception('could not build the search index')
+
+    if _builder is None:
+        _builder = asyncio.create_task(run())
+
+async def stop():
+    global _builder
+    if _builder is not None:
+        _builder.cancel()
+        try:
+            await _builder
+        except asyncio.CancelledError:
+            pass
+        _builder = None
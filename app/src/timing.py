@@ -0,0 +1,189 @@
+'''
+Per-request phase timing.
+
+TimingMiddleware traces a sampled share of requests (TIMING_SAMPLE_RATE).
+For a traced request it collects:
+
+- every Mongo command, through a pymongo CommandListener registered on the
+  client in database.py;
+- template rendering, through view.render;
+- the page pieces recorded by PageContext.
+
+The breakdown goes out in a Server-Timing header and in one structured log
+line per request on the src.timing logger.
+'''
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from pymongo import monitoring
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+current = ContextVar('request_timing', default=None)
+
+
+class RequestTiming:
+    def __init__(self, request_id: str, method: str, path: str):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.route = path
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.commands = {}
+        # Mongo events arrive on Motor's executor threads.
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, milliseconds: float):
+        with self._lock:
+            total, count = self.phases.get(phase, (0.0, 0))
+            self.phases[phase] = (total + milliseconds, count + 1)
+
+    def add_command(self, name: str, milliseconds: float):
+        self.add('mongo', milliseconds)
+        with self._lock:
+            total, count = self.commands.get(name, (0.0, 0))
+            self.commands[name] = (total + milliseconds, count + 1)
+
+    def elapsed(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self, page_timings: dict = None) -> str: #TESTED
+        total = self.elapsed()
+        entries = []
+        measured = 0.0
+        for phase, (milliseconds, count) in sorted(self.phases.items()):
+            measured += milliseconds
+            entries.append(
+                f'{phase};dur={milliseconds:.1f};desc="{count}x"'
+            )
+        for name, milliseconds in (page_timings or {}).items():
+            entries.append(f'page-{name};dur={milliseconds:.1f}')
+        # Mongo commands of concurrent page pieces overlap, so "other"
+        # (time in Python outside Mongo and rendering) is a lower bound.
+        entries.append(f'other;dur={max(0.0, total - measured):.1f}')
+        entries.append(f'total;dur={total:.1f}')
+        return ', '.join(entries)
+
+    def as_dict(self, status_code: int, page_timings: dict = None) -> dict:
+        rounded = lambda timings: {
+            name: {'ms': round(milliseconds, 3), 'count': count}
+            for name, (milliseconds, count) in timings.items()
+        }
+        return {
+            'request_id': self.request_id,
+            'method': self.method,
+            'route': self.route,
+            'path': self.path,
+            'status': status_code,
+            'total_ms': round(self.elapsed(), 3),
+            'phases': rounded(self.phases),
+            'mongo_commands': rounded(self.commands),
+            'page': {
+                name: round(milliseconds, 3)
+                for name, milliseconds in (page_timings or {}).items()
+            },
+        }
+
+
+def record(phase: str, started: float):
+    '''Adds the time since started (a perf_counter value) to phase of the
+    traced request, if any.'''
+    timing = current.get()
+    if timing is not None:
+        timing.add(phase, (time.perf_counter() - started) * 1000)
+
+
+class CommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        timing = current.get()
+        if timing is not None:
+            timing.add_command(event.command_name, event.duration_micros / 1000)
+
+
+command_timer = CommandTimer()
+
+
+def route_path(app, endpoint) -> str | None:
+    # Mounts (such as /static) put their app in the scope as the endpoint.
+    for route in app.routes:
+        if (
+            getattr(route, 'endpoint', None) is endpoint
+            or getattr(route, 'app', None) is endpoint
+        ):
+            return route.path
+    return None
+
+
+class TimingMiddleware:
+    def __init__(self, app, sample_rate: float = None):
+        self.app = app
+        self.sample_rate = (
+            settings.timing_sample_rate if sample_rate is None
+            else sample_rate
+        )
+        self.routes = {}
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope['type'] != 'http'
+            or self.sample_rate <= 0
+            or random.random() >= self.sample_rate
+        ):
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope['headers'])
+        request_id = (
+            headers.get(b'x-request-id', b'').decode('latin-1')
+            or uuid.uuid4().hex
+        )
+        timing = RequestTiming(request_id, scope['method'], scope['path'])
+        token = current.set(timing)
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                message.setdefault('headers', [])
+                message['headers'] = list(message['headers']) + [
+                    (b'server-timing', timing.server_timing(
+                        self._page_timings(scope)
+                    ).encode('latin-1')),
+                    (b'x-request-id', request_id.encode('latin-1')),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current.reset(token)
+            timing.route = self._route(scope) or timing.path
+            record = timing.as_dict(status_code, self._page_timings(scope))
+            logger.info(json.dumps(record), extra={'timing': record})
+
+    def _route(self, scope) -> str | None:
+        endpoint = scope.get('endpoint')
+        if endpoint is None or 'app' not in scope:
+            return None
+        if endpoint not in self.routes:
+            self.routes[endpoint] = route_path(scope['app'], endpoint)
+        return self.routes[endpoint]
+
+    @staticmethod
+    def _page_timings(scope) -> dict:
+        return scope.get('state', {}).get('page_timings') or {}
@@ -1,11 +1,32 @@
+import asyncio
+import base64
 import hashlib
+import hmac
+import json
+import logging
 import random
+import secrets
 import string
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from fastapi import  Request
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
 from datetime import datetime, timedelta
 import database
 import models
+from config import settings
+from src import (
+    invalidation, live, metrics, repository, rollups, search, versions
+)
+from src.cache import TTLCache
+from src.changefeed import feed
+
+logger = logging.getLogger(__name__)
+
+_hash_executor = None
+_user_cache = None
 
 def user_helper(user) -> dict: #TESTED
     return {
@@ -19,6 +40,17 @@ def user_helper(user) -> dict: #TESTED
         "is_active": user["is_active"]
     }
 
+def user_summary_helper(user) -> dict: #TESTED
+    return {
+        "id": str(user["_id"]),
+        "login": str(user["login"]),
+        "username": user["username"],
+        "role": user["role"],
+        "efficiency": user["efficiency"],
+        "status": user["status"],
+        "is_active": user["is_active"]
+    }
+
 def token_helper(token) -> dict: #TESTED
     return {
         "access_token": str(token["_id"]),
@@ -28,13 +60,16 @@ def token_helper(token) -> dict: #TESTED
     }
 
 def project_helper(activity) -> dict: #TESTED
-    return {
+    project = {
         'project_name': activity['project_name'],
         'editor': str(activity['editor']),
         'status': activity['project_status'],
         'deadline': str(activity['deadline']),
         'id': str(activity['_id'])
     }
+    if 'activity_total' in activity:
+        project['progress'] = rollups.rollup_helper(activity)
+    return project
 
 def activity_helper(activity) -> dict: #TESTED
     return {
@@ -68,6 +103,38 @@ def validate_password(password: str, hashed_password: str) -> bool: #TESTED
     salt, hashed = hashed_password.split("$")
     return hash_password(password, salt) == hashed
 
+def get_hash_executor():
+    global _hash_executor
+    if _hash_executor is None:
+        if settings.hash_executor == 'thread':
+            _hash_executor = ThreadPoolExecutor(
+                max_workers=settings.hash_workers,
+                thread_name_prefix='hash_password'
+            )
+        else:
+            _hash_executor = ProcessPoolExecutor(
+                max_workers=settings.hash_workers
+            )
+    return _hash_executor
+
+def shutdown_hash_executor():
+    global _hash_executor
+    if _hash_executor is not None:
+        _hash_executor.shutdown(wait=False, cancel_futures=True)
+        _hash_executor = None
+
+async def hash_password_async(password: str, salt: str = None): #TESTED
+    if salt is None:
+        salt = get_random_string()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_hash_executor(), hash_password, password, salt
+    )
+
+async def validate_password_async(password: str, hashed_password: str) -> bool: #TESTED
+    salt, hashed = hashed_password.split("$")
+    return await hash_password_async(password, salt) == hashed
+
 async def get_user_by_login(login: str): #TESTED
     return await database.users_collection.find_one({"login": login})
 
@@ -84,7 +151,7 @@ async def create_user_token(user_id: str): #TESTED
 
 async def create_user(user: models.UserCreate): #TESTED
     salt = get_random_string()
-    hashed_password = hash_password(user.password, salt)
+    hashed_password = await hash_password_async(user.password, salt)
     new_user = {
         "login": user.login,
         "username": user.username,
@@ -95,6 +162,12 @@ async def create_user(user: models.UserCreate): #TESTED
         "is_active": True
     }
     user_id = await database.users_collection.insert_one(new_user)
+    scopes = versions.bump(versions.USERS)
+    search.index_user(str(user_id.inserted_id), user.username, user.role)
+    await invalidation.publish(
+        invalidation.USER, scopes, user_id=str(user_id.inserted_id),
+        username=user.username, role=user.role,
+    )
     token = await create_user_token(str(user_id.inserted_id))
     token_dict = {
         "access_token": token["access_token"],
@@ -109,19 +182,109 @@ async def create_user(user: models.UserCreate): #TESTED
     }
 
 
+_random_session_key = None
+
+def session_key() -> bytes: #TESTED
+    global _random_session_key
+    if settings.session_secret:
+        return settings.session_secret.encode()
+    if _random_session_key is None:
+        _random_session_key = secrets.token_bytes(32)
+        logger.warning(
+            'SESSION_SECRET is not set; signing sessions with a random key, '
+            'so they end when this worker restarts and other workers '
+            'reject them'
+        )
+    return _random_session_key
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def create_session_token(user_id: str, role: str, ttl: int = None) -> str: #TESTED
+    if ttl is None:
+        ttl = settings.session_ttl
+    payload = json.dumps(
+        {'id': user_id, 'role': role, 'exp': int(time.time()) + ttl},
+        separators=(',', ':')
+    ).encode()
+    signature = hmac.new(session_key(), payload, hashlib.sha256).digest()
+    return f'{_b64encode(payload)}.{_b64encode(signature)}'
+
+def decode_session_token(token: str): #TESTED
+    try:
+        payload, signature = token.split('.')
+        payload = _b64decode(payload)
+        signature = _b64decode(signature)
+    except ValueError:
+        return None
+    expected = hmac.new(session_key(), payload, hashlib.sha256).digest()
+    if not hmac.compare_digest(signature, expected):
+        return None
+    session = json.loads(payload)
+    if session['exp'] < time.time():
+        return None
+    return session
+
+def get_user_cache() -> TTLCache:
+    global _user_cache
+    if _user_cache is None:
+        _user_cache = TTLCache(
+            settings.user_cache_size, settings.user_cache_ttl
+        )
+        metrics.register_cache('users', _user_cache)
+    return _user_cache
+
+async def get_cached_user(user_id: str):
+    user_cache = get_user_cache()
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await database.users_collection.find_one(
+            {"_id": ObjectId(user_id)}
+        )
+        if user is not None:
+            user_cache.set(user_id, user)
+    return user
+
+def invalidate_user(user_id: str):
+    get_user_cache().invalidate(user_id)
+
 async def get_current_user_from_cookie(request:Request):
     token=request.cookies.get('Authorization')
     if token:
-        user = await database.users_collection.find_one(
-            {"_id": ObjectId(token[57:81])}
-        )
-        return user
+        session = decode_session_token(token)
+        if session:
+            return await get_cached_user(session['id'])
 
 
-async def create_activity(activity: models.ActivityModel): #TESTED
-    new_activity = {
+async def create_project(project: models.ProjectCreate): #TESTED
+    new_project = {
+        'project_name': project.project_name,
+        'editor': project.editor,
+        'deadline': project.deadline,
+        'project_status': project.project_status,
+    }
+    project_id = await database.projects_collection.insert_one(new_project)
+    search.index_project(str(project_id.inserted_id), project.project_name)
+    scopes = versions.bump(
+        versions.PROJECTS, versions.project_scope(project_id.inserted_id)
+    )
+    await invalidation.publish(
+        invalidation.PROJECT, scopes,
+        project_id=str(project_id.inserted_id),
+        project_name=project.project_name,
+    )
+    return str(project_id.inserted_id)
+
+def activity_document(activity: models.ActivityModel) -> dict:
+    document = {
         'activity_name': activity.activity_name,
         'project_name': activity.project_name,
+        'project_id': (
+            ObjectId(activity.project_id) if activity.project_id else None
+        ),
         'translators': activity.translators,
         'editor': activity.editor,
         'deadline': activity.deadline,
@@ -129,76 +292,254 @@ async def create_activity(activity: models.ActivityModel): #TESTED
         'completeness': activity.completeness,
         'status': activity.status
     }
+    if activity.finished_at is not None:
+        document['finished_at'] = activity.finished_at
+    return document
+
+async def create_activity(activity: models.ActivityModel): #TESTED
+    new_activity = activity_document(activity)
     activity_id = await database.activities_collection.insert_one(new_activity)
+    await rollups.activity_created(new_activity)
+    scopes = versions.bump_activity(new_activity)
+    search.index_activity(new_activity)
+    event = {'operation': 'insert', 'activity': new_activity, 'before': None}
+    await live.stamp([event])
+    feed.publish(event)
+    await invalidation.publish(invalidation.ACTIVITY, scopes, changes=[event])
     return str(activity_id.inserted_id)
 
+async def create_activities(activities: list): #TESTED
+    '''Inserts a batch of activities of one project with an ordered
+    insert_many. On BulkWriteError the rows before the failing one are
+    kept, accounted for in the rollups and published, and the error is
+    re-raised.'''
+    new_activities = [activity_document(activity) for activity in activities]
+    inserted = []
+    try:
+        await database.activities_collection.insert_many(
+            new_activities, ordered=True
+        )
+        inserted = new_activities
+    except BulkWriteError as error:
+        inserted = new_activities[:error.details['nInserted']]
+        raise
+    finally:
+        if inserted:
+            await rollups.activities_created(
+                inserted[0]['project_id'], inserted
+            )
+        scopes = set()
+        events = [
+            {'operation': 'insert', 'activity': new_activity, 'before': None}
+            for new_activity in inserted
+        ]
+        if events:
+            await live.stamp(events)
+        for event in events:
+            scopes.update(versions.bump_activity(event['activity']))
+            search.index_activity(event['activity'])
+            feed.publish(event)
+        if events:
+            await invalidation.publish(
+                invalidation.ACTIVITY, sorted(scopes), changes=events
+            )
+    return [str(new_activity['_id']) for new_activity in inserted]
 
-async def edit_project(activity: models.ActivityModel, activity_id: str): #TESTED
-    result = await database.activities_collection.update_one(
-        {"_id": ObjectId(activity_id)},
+
+async def edit_project(project: models.ProjectCreate, project_id: str): #TESTED
+    result = await database.projects_collection.update_one(
+        {"_id": ObjectId(project_id)},
         {"$set" : 
             {
-                'project_name': activity.project_name,
-                'deadline': activity.deadline, 
-                'editor': activity.editor
+                'project_name': project.project_name,
+                'deadline': project.deadline, 
+                'editor': project.editor
             }
         }
     )
+    if result.modified_count:
+        search.index_project(project_id, project.project_name)
+        scopes = versions.bump(
+            versions.PROJECTS, versions.project_scope(project_id)
+        )
+        renamed = await database.activities_collection.update_many(
+            {
+                'project_id': ObjectId(project_id),
+                'project_name': {'$ne': project.project_name}
+            },
+            {'$set': {'project_name': project.project_name}}
+        )
+        if renamed.modified_count:
+            scopes += await _bump_project_members(project_id)
+        await invalidation.publish(
+            invalidation.PROJECT, scopes, project_id=project_id,
+            project_name=project.project_name,
+        )
     return result.modified_count
 
+async def _bump_project_members(project_id: str) -> list:
+    # Activity pages of everyone working on the project show its name.
+    query = {'project_id': ObjectId(project_id)}
+    members = await asyncio.gather(
+        database.activities_collection.distinct('translators', query),
+        database.activities_collection.distinct('editor', query),
+    )
+    return versions.bump(*[
+        versions.user_scope(user_id) for user_ids in members
+        for user_id in user_ids
+    ])
+
 async def edit_activity(activity: models.ActivityModel, activity_id: str): #TESTED
-    result = await database.activities_collection.update_one(
+    changes = {
+        'activity_name': activity.activity_name,
+        'deadline': activity.deadline, 
+        'translators': activity.translators
+    }
+    before = await database.activities_collection.find_one_and_update(
         {"_id": ObjectId(activity_id)},
-        {"$set" : 
-            {
-                'activity_name': activity.activity_name,
-                'deadline': activity.deadline, 
-                'translators': activity.translators
-            }
-        }
+        {"$set" : changes}
     )
-    return result.modified_count
+    if before is None:
+        return 0
+    await _activity_changed(before, {**before, **changes})
+    return int(any(before.get(key) != value for key, value in changes.items()))
+
+async def finish_activity(activity_id: str, finished_at: datetime = None): #TESTED
+    '''Marks an open activity finished at finished_at (now by default),
+    which is what the efficiency scores are computed from.'''
+    changes = {
+        'status': 'finished', 'completeness': 1.0,
+        'finished_at': finished_at or datetime.now(),
+    }
+    before = await database.activities_collection.find_one_and_update(
+        {'_id': ObjectId(activity_id), 'status': {'$ne': 'finished'}},
+        {'$set': changes}
+    )
+    if before is None:
+        return 0
+    await _activity_changed(before, {**before, **changes})
+    return 1
+
+async def _activity_changed(before: dict, after: dict):
+    await rollups.activity_changed(before, after)
+    scopes = versions.bump_activity(before) + versions.bump_activity(after)
+    search.index_activity(after)
+    event = {'operation': 'update', 'activity': after, 'before': before}
+    await live.stamp([event])
+    feed.publish(event)
+    await invalidation.publish(invalidation.ACTIVITY, scopes, changes=[event])
+
+def encode_project_cursor(project: dict) -> str: #TESTED
+    return _b64encode(f"{project['deadline']}|{project['id']}".encode())
+
+def decode_project_cursor(cursor: str): #TESTED
+    '''Raises ValueError for anything encode_project_cursor did not
+    produce.'''
+    try:
+        deadline, project_id = _b64decode(cursor).decode().split('|')
+        return datetime.fromisoformat(deadline), ObjectId(project_id)
+    except InvalidId as error:
+        raise ValueError(str(error)) from error
+
+def page_cursors(projects: list, per_page: int) -> list: #TESTED
+    '''The cursor each page of projects, sorted as get_projects sorts them,
+    starts after; None for the first page.'''
+    return [None] + [
+        encode_project_cursor(projects[end - 1])
+        for end in range(per_page, len(projects), per_page)
+    ]
 
-async def get_projects(status: str): #TESTED
-    projects = []
-    async for project in database.activities_collection.find({
-        'activity_name': 'initial_activity', 'project_status': status}
-    ):
-        projects.append(project_helper(project))
-    return projects
+def _projects_query(status: str) -> dict:
+    return {'project_status': status}
+
+async def get_projects(
+    status: str, limit: int = 0, cursor: str = None, skip: int = 0,
+    descending: bool = False, fields: list = None, secondary_ok: bool = False,
+): #TESTED
+    query = _projects_query(status)
+    direction = -1 if descending else 1
+    if cursor:
+        deadline, project_id = decode_project_cursor(cursor)
+        compare = '$lt' if descending else '$gt'
+        query['$or'] = [
+            {'deadline': {compare: deadline}},
+            {'deadline': deadline, '_id': {compare: project_id}},
+        ]
+    collection = database.projects_collection
+    if secondary_ok:
+        collection = database.list_reads(collection)
+    return await repository.find(
+        collection, repository.ProjectRecord, query, fields,
+        sort=[('deadline', direction), ('_id', direction)],
+        skip=skip,
+        limit=limit,
+    )
+
+async def count_projects(status: str, secondary_ok: bool = False) -> int: #TESTED
+    collection = database.projects_collection
+    if secondary_ok:
+        collection = database.list_reads(collection)
+    return await collection.count_documents(_projects_query(status))
 
 async def get_project_by_id(project_id: str): #TESTED
-    result = await database.activities_collection.find_one(
+    result = await database.projects_collection.find_one(
         {'_id': ObjectId(project_id)}
     )
     return project_helper(result)
 
+async def get_project_record(project_id: str, fields: list = None):
+    result = await repository.find(
+        database.projects_collection, repository.ProjectRecord,
+        {'_id': ObjectId(project_id)}, fields,
+        limit=1,
+    )
+    return result[0] if result else None
+
 
 async def get_current_user(): #TESTED
     pass
 
 async def get_project_names(): #TESTED
-    result = await database.activities_collection.distinct('project_name')
+    result = await database.projects_collection.distinct('project_name')
     return result
 
 async def get_activities_of_the_project(project: str): #TESTED
-    activities_list = []
-    async for activity in database.activities_collection.find(
-        {'project_name': project}
-    ):
-        activities_list.append(activity_helper(activity))
-    return activities_list
-
-async def get_list_of_users(role: str): #TESTED
-    users = []
-    async for user in database.users_collection.find({'role': role}):
-        users.append(
-            {
-                'username': user_helper(user)['username'],
-                'id': user_helper(user)['id']
-            }
-        )
-    return users
+    return await repository.find(
+        database.activities_collection, repository.ActivityRecord,
+        {'project_name': project, 'activity_name': {'$ne': 'initial_activity'}}
+    )
+
+def _after_id(query: dict, after: str | None) -> dict:
+    if after:
+        query['_id'] = {'$gt': ObjectId(after)}
+    return query
+
+async def get_project_activities(
+    project_id: str, limit: int = 0, after: str = None, fields: list = None
+): #TESTED
+    return await repository.find(
+        database.activities_collection, repository.ActivityRecord,
+        _after_id({'project_id': ObjectId(project_id)}, after), fields,
+        sort=[('_id', 1)],
+        limit=limit,
+    )
+
+async def get_list_of_users(role: str, secondary_ok: bool = False): #TESTED
+    collection = database.users_collection
+    if secondary_ok:
+        collection = database.list_reads(collection)
+    return await repository.find(collection, repository.UserRef, {'role': role})
+
+async def get_users(
+    role: str = None, limit: int = 0, after: str = None, fields: list = None
+): #TESTED
+    query = {'role': role} if role else {}
+    return await repository.find(
+        database.users_collection, repository.UserSummary,
+        _after_id(query, after), fields,
+        sort=[('_id', 1)],
+        limit=limit,
+    )
 
 async def get_user_by_id(user_id: str): #TESTED
     result = await database.users_collection.find_one(
@@ -206,10 +547,69 @@ async def get_user_by_id(user_id: str): #TESTED
     )
     return user_helper(result)
 
-async def get_user_activities(user_id: str, user_role: str): #TESTED
-    activities_list = []
-    async for activity in database.activities_collection.find(
-        {user_role: user_id}
-    ):
-        activities_list.append(activity_helper(activity))
-    return activities_list
\ No newline at end of file
+class UserLoader:
+    '''Request-scoped batching loader for users.
+
+    Every load() issued in the same event loop iteration is resolved by
+    a single $in query, and each id is fetched at most once per loader.
+    '''
+
+    def __init__(self):
+        self._futures = {}
+        self._pending = []
+        self._dispatch_task = None
+
+    def load(self, user_id: str):
+        future = self._futures.get(user_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._futures[user_id] = future
+            self._pending.append(user_id)
+            if len(self._pending) == 1:
+                loop.call_soon(self._schedule_dispatch)
+        return future
+
+    def load_many(self, user_ids):
+        return asyncio.gather(*[self.load(user_id) for user_id in user_ids])
+
+    def _schedule_dispatch(self):
+        self._dispatch_task = asyncio.ensure_future(self._dispatch())
+
+    async def _dispatch(self):
+        user_ids, self._pending = self._pending, []
+        found = {}
+        try:
+            object_ids = [
+                ObjectId(user_id) for user_id in user_ids
+                if ObjectId.is_valid(user_id)
+            ]
+            if object_ids:
+                for user in await repository.find(
+                    database.users_collection, repository.UserSummary,
+                    {'_id': {'$in': object_ids}}
+                ):
+                    found[user.id] = user
+        except Exception as error:
+            for user_id in user_ids:
+                if not self._futures[user_id].done():
+                    self._futures[user_id].set_exception(error)
+            return
+        for user_id in user_ids:
+            if not self._futures[user_id].done():
+                self._futures[user_id].set_result(found.get(user_id))
+
+async def get_user_activities(
+    user_id: str, user_role: str, fields: list = None, limit: int = 0,
+    after: str = None,
+): #TESTED
+    return await repository.find(
+        database.activities_collection, repository.ActivityRecord,
+        _after_id(
+            {user_role: user_id, 'activity_name': {'$ne': 'initial_activity'}},
+            after
+        ),
+        fields,
+        sort=[('_id', 1)],
+        limit=limit,
+    )
\ No newline at end of file
@@ -0,0 +1,72 @@
+'''
+Monotonic version counters for the data scopes pages are rendered from.
+
+Every write in src/users.py bumps the scopes it touches, and pages derive
+their ETag from the versions of the scopes they read, so a conditional GET
+can be answered with 304 before any data is loaded.
+
+The counters live in this process. EPOCH is part of every ETag, so tags
+issued by another worker, or before a restart, never match by accident.
+Writes made by other workers arrive through src/invalidation.py, which
+bumps the same scopes here.
+'''
+import hashlib
+import secrets
+
+PROJECTS = 'projects'
+USERS = 'users'
+
+EPOCH = secrets.token_hex(4)
+
+_versions = {}
+
+
+def project_scope(project_id) -> str:
+    return f'project:{project_id}'
+
+def user_scope(user_id) -> str:
+    return f'user:{user_id}'
+
+def current(scope: str) -> int: #TESTED
+    return _versions.get(scope, 0)
+
+def bump(*scopes: str) -> list: #TESTED
+    for scope in scopes:
+        _versions[scope] = _versions.get(scope, 0) + 1
+    return list(scopes)
+
+def bump_activity(activity: dict) -> list:
+    return bump(
+        PROJECTS, project_scope(activity.get('project_id')),
+        user_scope(activity.get('translators')),
+        user_scope(activity.get('editor')),
+    )
+
+def reset(): #TESTED
+    '''Invalidates every ETag issued so far, for when writes may have
+    been missed.'''
+    global EPOCH
+    EPOCH = secrets.token_hex(4)
+    _versions.clear()
+
+def etag(scopes: tuple, *parts: str) -> str: #TESTED
+    '''Weak ETag over the versions of scopes and any extra parts that
+    make the rendered page differ, such as the viewer and the query.'''
+    digest = hashlib.blake2b(digest_size=12)
+    for scope in scopes:
+        digest.update(f'{scope}={current(scope)};'.encode())
+    for part in parts:
+        digest.update(f'{part};'.encode())
+    return f'W/"{EPOCH}-{digest.hexdigest()}"'
+
+def matches(if_none_match: str | None, tag: str) -> bool: #TESTED
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # Weak comparison: W/ prefixes are ignored on both sides.
+    opaque = tag.removeprefix('W/')
+    return any(
+        candidate.strip().removeprefix('W/') == opaque
+        for candidate in if_none_match.split(',')
+    )
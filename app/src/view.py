@@ -1,17 +1,43 @@
+import time
 from fastapi.templating import Jinja2Templates
 from fastapi import Request
+from jinja2 import FileSystemBytecodeCache
+from config import settings
+from src import assets, timing
 
-templates = Jinja2Templates(directory="templates/")
+# The single template environment shared by every page. Compiled templates
+# are persisted by the bytecode cache, so workers after the first one load
+# them instead of compiling.
+templates = Jinja2Templates(
+    directory="templates/",
+    bytecode_cache=FileSystemBytecodeCache(settings.template_cache_dir or None),
+    auto_reload=settings.template_auto_reload,
+)
+templates.env.globals['static_url'] = assets.static_url
+
+def render(name: str, context: dict):
+    started = time.perf_counter()
+    try:
+        return templates.TemplateResponse(name, context)
+    finally:
+        timing.record('render', started)
+
+def precompile() -> list:
+    names = templates.env.list_templates(extensions=['html'])
+    for name in names:
+        templates.env.get_template(name)
+    return names
 
 def main_page(request: Request):
-    return templates.TemplateResponse('test.html', {'request': request})
+    return render('test.html', {'request': request})
 
 def projects_page(
     request: Request, chief_editors_list: list, projects: list, 
     projects_current_page: list, translators_list: list, num_of_pages: int, 
     page: int, archive: bool, incorrect_time: bool, incorrect_name: bool,
+    next_cursor: str | None = None, page_cursors: list = (),
 ):
-    return templates.TemplateResponse(
+    return render(
         'projects.html', 
         {
             'request': request, 
@@ -24,6 +50,8 @@ def projects_page(
             'archive': archive,
             'incorrect_time': incorrect_time,
             'incorrect_name': incorrect_name,
+            'next_cursor': next_cursor,
+            'page_cursors': page_cursors,
         }
     )
 
@@ -33,7 +61,7 @@ def project_page(
     status: str, project_activities: list, project_id: str, 
     project_translators: list, incorrect_time: bool,
 ):
-    return templates.TemplateResponse(
+    return render(
         'project.html', 
         {
             'request': request, 
@@ -51,28 +79,34 @@ def project_page(
     )
 
 def registration_page(request: Request, not_valid: bool):
-    return templates.TemplateResponse(
+    return render(
         'registration_page.html', {'request': request, 'not_valid': not_valid}
     )
 
-def translator_page(request: Request, activities: list, current_user: str):
-    return templates.TemplateResponse(
+def translator_page(
+    request: Request, activities: list, current_user: str,
+    live_version: str = None,
+):
+    return render(
         'translator.html',
         {
             'request': request, 
             'activities': activities,
-            'current_user': current_user
+            'current_user': current_user,
+            'live_version': live_version,
         }
     )
 
 def chief_editor_page(
-    request: Request, current_chief_editor: str, activities: list
+    request: Request, current_chief_editor: str, activities: list,
+    live_version: str = None,
 ):
-    return templates.TemplateResponse(
+    return render(
         'chief_editor.html', {
             'request': request,
             'current_chief_editor': current_chief_editor,
             'chief_editor_activities': activities,
+            'live_version': live_version,
         }
     )
 
@@ -80,7 +114,7 @@ def translator_pm_page(
     request: Request, chief_editors_list: list, projects: list, 
     translators_list: list, username: str, activities: list
 ):
-    return templates.TemplateResponse(
+    return render(
         'translator_pm.html', 
         {
             'request': request,
@@ -96,7 +130,7 @@ def chief_editor_pm_page(
     request: Request, chief_editors_list: list, projects: list, 
     translators_list: list, current_chief_editor: str, activities: list
 ):
-    return templates.TemplateResponse(
+    return render(
         'chief_editor_pm.html', 
         {
             'request': request,
@@ -0,0 +1,72 @@
+// Keeps the /me activity table current from the server's event stream
+// (src/live.py). Rows are matched by data-activity-id; cells marked with
+// data-field take the activity's value, and new rows are cloned from the
+// #live-row template.
+(function () {
+  var table = document.querySelector('table[data-live-url]');
+  var template = document.getElementById('live-row');
+  if (!table || !template || !window.EventSource) {
+    return;
+  }
+  var body = table.tBodies[0];
+  var interrupted = false;
+
+  function findRow(id) {
+    return body.querySelector(
+      'tr[data-activity-id="' + CSS.escape(id) + '"]'
+    );
+  }
+
+  function fill(row, activity) {
+    row.setAttribute('data-activity-id', activity.id);
+    row.querySelectorAll('[data-field]').forEach(function (cell) {
+      var value = activity[cell.getAttribute('data-field')];
+      cell.textContent = value === null || value === undefined ? '' : value;
+    });
+  }
+
+  function onActivity(message) {
+    var change = JSON.parse(message.data);
+    var row = findRow(change.activity.id);
+    if (change.operation === 'remove') {
+      if (row) {
+        row.remove();
+      }
+      return;
+    }
+    if (!row) {
+      row = template.content.firstElementChild.cloneNode(true);
+      body.appendChild(row);
+    }
+    fill(row, change.activity);
+  }
+
+  function connect(since) {
+    var source = new EventSource(
+      table.getAttribute('data-live-url') + '?since=' +
+      encodeURIComponent(since)
+    );
+    source.addEventListener('activity', onActivity);
+    source.addEventListener('reload', function () {
+      source.close();
+      location.reload();
+    });
+    source.addEventListener('bye', function (message) {
+      // Everything up to this version was sent; reconnect from it so the
+      // session is checked again.
+      source.close();
+      connect(JSON.parse(message.data));
+    });
+    source.onopen = function () {
+      // Events sent while the connection was down are gone.
+      if (interrupted) {
+        location.reload();
+      }
+    };
+    source.onerror = function () {
+      interrupted = true;
+    };
+  }
+
+  connect(table.getAttribute('data-live-since'));
+})();
@@ -1,11 +1,26 @@
 import pytest
 from httpx import AsyncClient
 from bson.objectid import ObjectId
+from fastapi import HTTPException
 from pydantic import ValidationError
+from pymongo.errors import PyMongoError
+import asyncio
+from collections import defaultdict
 import datetime
+import time
 
 from app import app
-from src import users
+from src import (
+    api, assets, efficiency, exporter, importer, indexes, invalidation,
+    live, metrics, navigation, repository, rollups, search, timing, users,
+    versions, view,
+)
+from src.context import PageContext
+from starlette.requests import Request
+from src.cache import TTLCache
+from src.changefeed import ActivityFeed, feed
+import config
+import database
 import models
 
 @pytest.mark.anyio
@@ -55,6 +70,960 @@ async def test_auth_invalid_password():
         'detail': 'Incorrect login or password'
     }
 
+@pytest.mark.anyio
+async def test_pages_redirect_unauthorized():
+    async with AsyncClient(app=app, base_url="http://localhost:8000") as ac:
+        for page in ['/me', '/projects', '/project/645a5064728af5c5703f5aeb']:
+            response = await ac.get(page)
+            assert response.status_code == 303
+            assert response.headers['location'] == 'http://localhost:8000/login'
+
+def evaluate(expression, document: dict):
+    '''The aggregation operators score_stages uses, evaluated in Python.'''
+    if isinstance(expression, str) and expression.startswith('$'):
+        for field in expression[1:].split('.'):
+            document = document.get(field) if document else None
+        return document
+    if not isinstance(expression, dict):
+        return expression
+    (operator, arguments), = expression.items()
+    if operator == '$cond':
+        condition, then, otherwise = arguments
+        chosen = then if evaluate(condition, document) else otherwise
+        return evaluate(chosen, document)
+    values = [evaluate(argument, document) for argument in arguments]
+    present = [value for value in values if value is not None]
+    if operator == '$ifNull':
+        return present[0] if present else None
+    if operator == '$gt':
+        return values[0] > values[1]
+    if None in values:
+        return max(present) if operator == '$max' and present else None
+    if operator == '$subtract':
+        return (values[0] - values[1]).total_seconds() * 1000
+    return {
+        '$divide': lambda a, b: a / b, '$multiply': lambda a, b: a * b,
+        '$max': max, '$min': min, '$round': round,
+    }[operator](*values)
+
+def score(stats: dict, now: datetime.datetime) -> dict:
+    document = {'efficiency_stats': stats}
+    for stage in efficiency.score_stages(now):
+        document = {
+            **document,
+            **{
+                field: evaluate(expression, document)
+                for field, expression in stage['$set'].items()
+            },
+        }
+    del document['efficiency_stats']
+    return document
+
+def test_efficiency_score_stages():
+    now = datetime.datetime(2023, 5, 29)
+    stats = {
+        'finished': 10,
+        'on_time': 8,
+        'first_finished_at': datetime.datetime(2023, 5, 1),
+    }
+    assert score(stats, now) == {
+        'on_time_ratio': 0.8,
+        'throughput_per_week': 2.5,
+        'efficiency': 0.4,
+    }
+    assert score({}, now) == {
+        'on_time_ratio': 0.0, 'throughput_per_week': 0.0, 'efficiency': 0.0,
+    }
+    # Throughput falls while nothing is finished.
+    later = score(stats, now + datetime.timedelta(weeks=6))
+    assert later['throughput_per_week'] == 1.0
+    assert later['efficiency'] == 0.16
+
+def test_feed_missed():
+    activity_feed = ActivityFeed(maxsize=1)
+    queue = activity_feed.subscribe()
+    other = activity_feed.subscribe()
+    activity_feed.publish({'number': 0})
+    other.get_nowait()
+    for number in (1, 2):
+        activity_feed.publish({'number': number})
+    assert activity_feed.missed(queue) == 2
+    assert activity_feed.missed(queue) == 0
+    assert activity_feed.missed(other) == 1
+    activity_feed.unsubscribe(queue)
+    assert activity_feed.missed(queue) == 0
+
+def test_efficiency_on_time():
+    deadline = datetime.datetime(2023, 5, 31)
+    assert efficiency.is_on_time(datetime.datetime(2023, 5, 30, 9), deadline)
+    assert efficiency.is_on_time(datetime.datetime(2023, 5, 31, 18), deadline)
+    assert not efficiency.is_on_time(datetime.datetime(2023, 6, 1), deadline)
+
+def test_efficiency_newly_finished():
+    assert efficiency.is_newly_finished({
+        'activity': {'status': 'finished'}, 'before': {'status': 'created'}
+    })
+    assert not efficiency.is_newly_finished({
+        'activity': {'status': 'finished'}, 'before': {'status': 'finished'}
+    })
+    assert not efficiency.is_newly_finished({
+        'activity': {'status': 'created'}, 'before': None
+    })
+
+@pytest.mark.anyio
+async def test_api_requires_session():
+    async with AsyncClient(app=app, base_url="http://localhost:8000") as ac:
+        response = await ac.get('/api/v1/projects')
+        assert response.status_code == 401
+        response = await ac.get(
+            '/api/v1/projects', headers={'Authorization': 'Bearer forged.token'}
+        )
+        assert response.status_code == 401
+
+@pytest.mark.anyio
+async def test_api_require_role():
+    check_role = api.require_role('project_manager').dependency
+    user = {'_id': ObjectId('645a4bca08eca36c3778e6a0'), 'role': 'project_manager'}
+    assert await check_role(user) is user
+    with pytest.raises(HTTPException) as error:
+        await check_role({**user, 'role': 'translator'})
+    assert error.value.status_code == 403
+
+def test_api_check_cursor():
+    api.check_cursor(None)
+    api.check_cursor('645a4bca08eca36c3778e6a0')
+    with pytest.raises(HTTPException) as error:
+        api.check_cursor('not-an-id')
+    assert error.value.status_code == 400
+
+def test_api_select_fields():
+    items = [repository.UserRef({'_id': ObjectId('643bf7db29a8f8dcc00a1bd9'), 'username': 'test'})]
+    assert api.select_fields(items, 'username,unknown') == [
+        {'username': 'test'}
+    ]
+    assert api.select_fields(items, None) == [
+        {'id': '643bf7db29a8f8dcc00a1bd9', 'username': 'test'}
+    ]
+
+def test_project_record():
+    project = repository.ProjectRecord({
+        '_id': ObjectId('645a5064728af5c5703f5aeb'),
+        'project_name': 'test',
+        'editor': '645a4bca08eca36c3778e6a0',
+        'project_status': 'created',
+        'deadline': datetime.datetime(2023, 5, 31, 0, 0),
+    })
+    assert project['id'] == '645a5064728af5c5703f5aeb'
+    assert project['status'] == 'created'
+    assert project['progress'] is None
+    project['editor'] = 'Chief Editor'
+    assert project.editor == 'Chief Editor'
+    with pytest.raises(KeyError):
+        project['password']
+    assert repository.ProjectRecord.projection(['id', 'status']) == {
+        '_id': 1, 'project_status': 1
+    }
+    assert repository.UserRef.projection() == {'_id': 1, 'username': 1}
+
+@pytest.mark.anyio
+async def test_importer_iter_rows():
+    async def chunks():
+        yield 'activity_name,translator,deadline\r\nChapter 1,645c'.encode()
+        yield 'af84fc7d556776d73dbb,2030-01-01\n\nChapter 2,,'.encode()
+    rows = [row async for row in importer.iter_rows(chunks(), importer.CSV)]
+    assert rows == [
+        (1, {
+            'activity_name': 'Chapter 1',
+            'translator': '645caf84fc7d556776d73dbb',
+            'deadline': '2030-01-01'
+        }),
+        (2, {'activity_name': 'Chapter 2', 'translator': '', 'deadline': ''}),
+    ]
+
+@pytest.mark.anyio
+async def test_importer_iter_rows_ndjson():
+    async def chunks():
+        yield b'{"activity_name": "Chapter 1"}\n[1]\n{broken'
+    rows = [row async for row in importer.iter_rows(chunks(), importer.NDJSON)]
+    assert rows[0] == (1, {'activity_name': 'Chapter 1'})
+    assert rows[1] == (2, 'expected a JSON object')
+    assert rows[2][0] == 3 and type(rows[2][1]) is str
+
+@pytest.mark.anyio
+async def test_importer_iter_lines_rejects_bad_input():
+    async def chunks(*parts):
+        for part in parts:
+            yield part
+    lines = importer.iter_lines(chunks(b'a\r\nbcd\n', b'ef'), max_length=3)
+    assert [line async for line in lines] == ['a', 'bcd', 'ef']
+    with pytest.raises(ValueError, match='line 2 is longer'):
+        [line async for line in importer.iter_lines(
+            chunks(b'a\nbcde\n'), max_length=3
+        )]
+    with pytest.raises(ValueError, match='line 2 is longer'):
+        [line async for line in importer.iter_lines(
+            chunks(b'a\nbc', b'de', b'fg'), max_length=3
+        )]
+    with pytest.raises(ValueError, match='line 3 is not valid UTF-8'):
+        [line async for line in importer.iter_lines(
+            chunks(b'a\n', b'b\n\xff\xfe\n')
+        )]
+    with pytest.raises(ValueError, match='line 1 is not valid UTF-8'):
+        [line async for line in importer.iter_lines(chunks(b'a\xc3'))]
+
+def test_importer_build_activity():
+    project = {
+        'id': '645a5064728af5c5703f5aeb',
+        'project_name': 'test',
+        'editor': '645a4bca08eca36c3778e6a0'
+    }
+    activity = importer.build_activity(
+        {'activity_name': 'Chapter 1', 'deadline': '2030-01-01'}, project
+    )
+    assert activity.project_id == '645a5064728af5c5703f5aeb'
+    assert activity.editor == '645a4bca08eca36c3778e6a0'
+    assert activity.status == 'created'
+    assert activity.finished_at is None
+    with pytest.raises(ValidationError):
+        importer.build_activity({'activity_name': 'Chapter 2'}, project)
+    activity = importer.build_activity({
+        'activity_name': 'Chapter 3', 'deadline': '2023-01-01',
+        'status': 'finished', 'finished_at': '2022-12-30T10:00',
+    }, project)
+    assert activity.finished_at == datetime.datetime(2022, 12, 30, 10)
+    assert users.activity_document(activity)['finished_at'] == (
+        activity.finished_at
+    )
+    with pytest.raises(ValidationError, match='unknown status'):
+        importer.build_activity({
+            'activity_name': 'Chapter 4', 'deadline': '2030-01-01',
+            'status': 'activity_counts.$x',
+        }, project)
+
+@pytest.mark.anyio
+async def test_importer_reports_unknown_status(monkeypatch):
+    created = []
+    async def create_activities(activities):
+        created.extend(activities)
+    monkeypatch.setattr(users, 'create_activities', create_activities)
+    async def chunks():
+        yield b'activity_name,translator,deadline,status\n'
+        yield b'Chapter 1,,2030-01-01,created\n'
+        yield b'Chapter 2,,2030-01-01,archived\n'
+    project = {
+        'id': '645a5064728af5c5703f5aeb',
+        'project_name': 'test',
+        'editor': '645a4bca08eca36c3778e6a0'
+    }
+    report = await importer.import_activities(chunks(), importer.CSV, project)
+    assert [activity.activity_name for activity in created] == ['Chapter 1']
+    assert report['inserted'] == 1 and report['failed'] == 1
+    [error] = report['errors']
+    assert error['row'] == 2
+    assert error['errors'][0].startswith('status: unknown status')
+
+@pytest.mark.anyio
+async def test_indexes_apply_reports_failures(monkeypatch):
+    class Collection:
+        async def create_indexes(self, models):
+            raise PyMongoError('not authorized')
+    monkeypatch.setattr(database, 'database', defaultdict(Collection))
+    async def check_indexes():
+        raise PyMongoError('timed out')
+    monkeypatch.setattr(indexes, 'check_indexes', check_indexes)
+    report = await indexes.apply_indexes()
+    assert report == {'failed': [*indexes.INDEXES, 'check']}
+
+def test_indexes_compare():
+    def information(models):
+        # The shape index_information() returns.
+        return {
+            '_id_': {'v': 2, 'key': [('_id', 1)]},
+            **{
+                model.document['name']: {
+                    'v': 2, 'key': list(model.document['key'].items()),
+                    **indexes._options(model.document),
+                }
+                for model in models
+            },
+        }
+
+    existing = {
+        name: information(models) for name, models in indexes.INDEXES.items()
+    }
+    assert indexes.compare_indexes(existing) == {
+        'missing': [], 'changed': [], 'extra': [],
+    }
+    del existing['users_collection']['role_1']
+    existing['users_collection']['login_1'].pop('unique')
+    existing['tokens_collection']['expires_1']['expireAfterSeconds'] = 60
+    existing['projects_collection']['editor_1']['key'] = [('editor', -1)]
+    existing['projects_collection']['deadline_1'] = {
+        'v': 2, 'key': [('deadline', 1)],
+    }
+    del existing['activities_collection']
+    assert indexes.compare_indexes(existing) == {
+        'missing': [
+            'users_collection.role_1',
+            'activities_collection.project_id_1',
+            'activities_collection.project_name_1',
+            'activities_collection.translators_1__id_1',
+            'activities_collection.editor_1__id_1',
+        ],
+        'changed': [
+            'users_collection.login_1', 'tokens_collection.expires_1',
+            'projects_collection.editor_1',
+        ],
+        'extra': ['projects_collection.deadline_1'],
+    }
+
+def test_exporter_activities_query():
+    query = exporter.activities_query(
+        '645a5064728af5c5703f5aeb', 'created',
+        deadline_to=datetime.datetime(2030, 1, 1)
+    )
+    assert query == {
+        'activity_name': {'$ne': 'initial_activity'},
+        'project_id': ObjectId('645a5064728af5c5703f5aeb'),
+        'status': 'created',
+        'deadline': {'$lt': datetime.datetime(2030, 1, 2)},
+    }
+
+def test_exporter_activities_query_includes_last_day():
+    day = datetime.datetime(2030, 1, 1)
+    bounds = exporter.activities_query(
+        deadline_from=day, deadline_to=day
+    )['deadline']
+    for deadline in (day, day.replace(hour=23, minute=59)):
+        assert bounds['$gte'] <= deadline < bounds['$lt']
+    assert not datetime.datetime(2030, 1, 2) < bounds['$lt']
+
+def test_exporter_encode():
+    rows = [{'id': '1', 'deadline': datetime.datetime(2030, 1, 1)}]
+    assert exporter.encode(rows, ['id', 'deadline'], exporter.CSV) == (
+        b'1,2030-01-01T00:00:00\r\n'
+    )
+    assert exporter.encode(rows, ['id', 'deadline'], exporter.NDJSON) == (
+        b'{"id":"1","deadline":"2030-01-01T00:00:00"}\n'
+    )
+
+def test_search_tokenize():
+    assert search.tokenize('War and Peace, vol. 2') == [
+        'war', 'and', 'peace', 'vol', '2'
+    ]
+
+def test_search_index():
+    index = search.SearchIndex()
+    index.add('project', '1', 'War and Peace', '/project/1')
+    index.add('project', '2', 'Peace Treaty', '/project/2')
+    index.add('user', '3', 'warren', '/translator/3')
+    result = index.search('war')
+    assert [item['id'] for item in result['results']] == ['1', '3']
+    assert index.search('pea')['total'] == 2
+    assert index.search('peace war')['results'][0]['id'] == '1'
+    assert index.search('war', kinds=('user',))['total'] == 1
+    assert index.search('pea', limit=1, offset=1)['results'][0]['id'] == '1'
+    index.add('project', '1', 'Anna Karenina', '/project/1')
+    assert index.search('war')['total'] == 1
+    index.remove('user', '3')
+    assert index.search('war')['total'] == 0
+    assert index.search('')['total'] == 0
+
+def test_search_index_build_keeps_newer_writes():
+    index = search.SearchIndex()
+    index.begin_build()
+    index.add('project', '1', 'Renamed Zyzzyva', '/project/1')
+    index.remove('project', '2')
+    index.load('project', '1', 'Old Name', '/project/1')
+    index.load('project', '2', 'Deleted Project', '/project/2')
+    index.load('project', '3', 'Untouched', '/project/3')
+    index.end_build()
+    assert index.search('zyzzyva')['total'] == 1
+    assert index.search('old')['total'] == 0
+    assert index.search('deleted')['total'] == 0
+    assert index.search('untouched')['total'] == 1
+    index.add('project', '3', 'Renamed Again', '/project/3')
+    assert index.search('untouched')['total'] == 0
+
+@pytest.mark.anyio
+async def test_search_stop():
+    search.start()
+    await search.stop()
+    assert search._builder is None
+    assert search.index._written is None
+    await search.stop()
+
+@pytest.mark.anyio
+async def test_search_requires_project_manager():
+    translator_id = '645a4bca08eca36c3778e6a3'
+    manager_id = '645a4bca08eca36c3778e6a4'
+    users.get_user_cache().set(translator_id, {
+        '_id': ObjectId(translator_id), 'role': 'translator',
+    })
+    users.get_user_cache().set(manager_id, {
+        '_id': ObjectId(manager_id), 'role': 'project_manager',
+    })
+    try:
+        async with AsyncClient(app=app, base_url="http://localhost:8000") as ac:
+            response = await ac.get('/search', params={'q': 'war'})
+            assert response.status_code == 401
+            for user_id, role, expected in [
+                (translator_id, 'translator', 403),
+                (manager_id, 'project_manager', 200),
+            ]:
+                ac.cookies['Authorization'] = users.create_session_token(
+                    user_id, role
+                )
+                response = await ac.get('/search', params={'q': 'war'})
+                assert response.status_code == expected
+    finally:
+        users.invalidate_user(translator_id)
+        users.invalidate_user(manager_id)
+
+def test_search_index_ranking():
+    index = search.SearchIndex()
+    titles = ['War and Peace', 'war', 'Peace War', 'Warren', 'A War Story']
+    for number, title in enumerate(titles):
+        index.add('project', str(number), title, None)
+    # Exact matches first, then titles starting with the query, then the
+    # shortest titles.
+    assert [item['title'] for item in index.search('war')['results']] == [
+        'war', 'War and Peace', 'Warren', 'Peace War', 'A War Story',
+    ]
+    assert [item['score'] for item in index.search('war')['results']] == [
+        3, 3, 2, 2, 2,
+    ]
+    page = index.search('war', limit=2, offset=2)['results']
+    assert [item['title'] for item in page] == ['Warren', 'Peace War']
+    assert index.search('war pea')['results'][0]['title'] == 'Peace War'
+    assert index.search('war and pea')['results'][0]['score'] == 6
+
+def test_view_precompile():
+    names = view.precompile()
+    assert 'project.html' in names
+    assert 'static_url' in view.templates.env.globals
+    assert 'translator_pm.html' in names
+    assert view.templates.env.bytecode_cache is not None
+
+def test_versions_etag():
+    scope = versions.project_scope('645a5252a125ff04c2a26124')
+    tag = versions.etag((scope,), 'viewer')
+    assert versions.etag((scope,), 'viewer') == tag
+    assert versions.etag((scope,), 'other viewer') != tag
+    versions.bump(scope)
+    assert versions.etag((scope,), 'viewer') != tag
+    assert versions.matches(f'"x", {tag}', tag)
+    assert versions.matches(tag.removeprefix('W/'), tag)
+    assert versions.matches('*', tag)
+    assert not versions.matches(None, tag)
+    assert not versions.matches('"x"', tag)
+
+def test_page_context_not_modified():
+    def request(if_none_match: str = None):
+        headers = []
+        if if_none_match:
+            headers.append((b'if-none-match', if_none_match.encode()))
+        return Request({
+            'type': 'http', 'method': 'GET', 'scheme': 'http',
+            'server': ('localhost', 8000), 'path': '/projects',
+            'query_string': b'', 'headers': headers,
+        })
+    user = {'_id': ObjectId('645a4bca08eca36c3778e6a0'), 'role': 'translator'}
+    context = PageContext(request())
+    context.user = user
+    assert context.not_modified(versions.PROJECTS) is None
+    tag = context.etag
+    assert context.tagged(view.templates.TemplateResponse(
+        'registration_page.html', {'request': context.request}
+    )).headers['etag'] == tag
+    context = PageContext(request(tag))
+    context.user = user
+    assert context.not_modified(versions.PROJECTS).status_code == 304
+    versions.bump(versions.PROJECTS)
+    assert context.not_modified(versions.PROJECTS) is None
+
+def test_versions_reset():
+    tag = versions.etag((versions.PROJECTS,))
+    versions.reset()
+    assert versions.current(versions.PROJECTS) == 0
+    assert versions.etag((versions.PROJECTS,)) != tag
+
+@pytest.mark.anyio
+async def test_invalidation_apply():
+    project_id = '645a5252a125ff04c2a26199'
+    scope = versions.project_scope(project_id)
+    version = versions.current(scope)
+    invalidation.apply({
+        'kind': invalidation.PROJECT, 'scopes': [scope],
+        'project_id': project_id, 'project_name': 'Invalidated Zyzzyva',
+    })
+    assert versions.current(scope) == version + 1
+    assert search.index.search('zyzzyva')['results'][0]['id'] == project_id
+    search.index.remove(search.PROJECT, project_id)
+
+    user_id = '645a4bca08eca36c3778e6a9'
+    users.get_user_cache().set(user_id, {'_id': ObjectId(user_id)})
+    invalidation.apply({'kind': invalidation.USER, 'user_id': user_id})
+    assert users.get_user_cache().get(user_id) is None
+
+    queue = feed.subscribe()
+    try:
+        change = {
+            'operation': 'insert', 'before': None, 'activity': {
+                '_id': ObjectId('645a5252a125ff04c2a26198'),
+                'activity_name': 'Zyzzyva chapter', 'project_id': None,
+            },
+        }
+        invalidation.apply({'kind': invalidation.ACTIVITY, 'changes': [change]})
+        event = queue.get_nowait()
+        assert event['remote'] and event['activity'] == change['activity']
+        assert search.index.search('zyzzyva chapter')['total'] == 1
+        search.index.remove(search.ACTIVITY, '645a5252a125ff04c2a26198')
+    finally:
+        feed.unsubscribe(queue)
+
+def test_invalidation_receive_ignores_own_events():
+    scope = versions.project_scope('645a5252a125ff04c2a26197')
+    invalidation.receive({
+        'origin': invalidation.WORKER_ID, 'kind': invalidation.PROJECT,
+        'scopes': [scope], 'project_id': '645a5252a125ff04c2a26197',
+        'project_name': 'Own write',
+    })
+    invalidation.receive({'origin': 'other', 'kind': invalidation.HELLO})
+    assert versions.current(scope) == 0
+
+def test_invalidation_receive_survives_malformed_events(monkeypatch):
+    resyncs = []
+    monkeypatch.setattr(invalidation, 'resync', lambda: resyncs.append(1))
+    invalidation.receive({'origin': 'other', 'kind': invalidation.USER})
+    invalidation.receive({
+        'origin': 'other', 'kind': invalidation.ACTIVITY, 'changes': None,
+    })
+    invalidation.receive({'origin': 'other', 'at': 'yesterday'})
+    assert len(resyncs) == 3
+
+def test_invalidation_resync():
+    users.get_user_cache().set(
+        '645a4bca08eca36c3778e6a8', {'role': 'translator'}
+    )
+    versions.bump(versions.USERS)
+    tag = versions.etag((versions.USERS,))
+    invalidation.resync()
+    assert users.get_user_cache().get('645a4bca08eca36c3778e6a8') is None
+    assert versions.etag((versions.USERS,)) != tag
+
+def test_live_encode():
+    assert live.encode('reload') == b'event: reload\ndata: null\n\n'
+    payload = live.activity_payload({
+        '_id': ObjectId('645a5252a125ff04c2a26124'), 'activity_name': 'Ch 1',
+        'deadline': datetime.datetime(2024, 5, 1), 'translators': 'u1',
+    })
+    assert payload['id'] == '645a5252a125ff04c2a26124'
+    assert payload['deadline'] == '2024-05-01 00:00:00'
+    assert payload['translator'] == 'u1' and payload['status'] is None
+
+@pytest.mark.anyio
+async def test_live_dispatch():
+    hub = live.LiveHub(maxsize=2)
+    translator, old_translator = hub.connect('u1'), hub.connect('u2')
+    editor = hub.connect('e1')
+    activity = {
+        '_id': ObjectId('645a5252a125ff04c2a26124'), 'activity_name': 'Ch 1',
+        'translators': 'u1', 'editor': 'e1', 'status': 'in_progress',
+    }
+    hub.dispatch({
+        'operation': 'update', 'activity': activity,
+        'before': {**activity, 'translators': 'u2'},
+        'versions': {'u1': 4, 'u2': 7, 'e1': 2},
+    })
+    version, message = translator.get_nowait()
+    assert version == 4 and b'"operation":"update"' in message
+    assert b'"in_progress"' in editor.get_nowait()[1]
+    version, message = old_translator.get_nowait()
+    assert version == 7 and b'"operation":"remove"' in message
+    hub.dispatch({
+        'operation': 'insert', 'before': None,
+        'activity': {**activity, 'activity_name': 'initial_activity'},
+    })
+    assert translator.empty()
+    for _ in range(3):
+        hub.dispatch({'operation': 'insert', 'activity': activity})
+    assert translator.get_nowait() == (None, live.RELOAD)
+    assert translator.empty()
+    hub.disconnect('u1', translator)
+    hub.disconnect('u1', translator)
+    assert len(hub) == 2
+
+@pytest.mark.anyio
+async def test_live_stamp():
+    translator, editor = str(ObjectId()), str(ObjectId())
+    activity = {'translators': translator, 'editor': editor}
+    events = [
+        {'operation': 'insert', 'activity': activity, 'before': None},
+        {'operation': 'update', 'activity': activity, 'before': activity},
+    ]
+    await live.stamp(events)
+    assert [event['versions'][translator] for event in events] == [1, 2]
+    assert await live.page_version(translator) == 2
+    assert await live.page_version(str(ObjectId())) == 0
+
+@pytest.mark.anyio
+async def test_live_stream():
+    user_id = str(ObjectId())
+    since = str(await live.page_version(user_id))
+    # The page and the stream may be served by different workers, which
+    # have different epochs; the counters are shared.
+    versions.reset()
+    stream = live.stream(user_id, since, keepalive=0.01, max_age=0.05)
+    assert (await stream.__anext__()).startswith(b'retry:')
+    advanced = await live.advance({user_id: 1})
+    live.hub.send(
+        [user_id], live.encode('activity', {'id': 'a'}), advanced
+    )
+    assert (await stream.__anext__()).startswith(b'event: activity')
+    assert await stream.__anext__() == live.KEEPALIVE
+    messages = [message async for message in stream]
+    assert messages[-1] == live.encode('bye', advanced[user_id])
+    assert len(live.hub) == 0
+
+    stream = live.stream(user_id, since)
+    await stream.__anext__()
+    assert await stream.__anext__() == live.RELOAD
+    await stream.aclose()
+    stream = live.stream(user_id, str(advanced[user_id]), keepalive=0.01)
+    await stream.__anext__()
+    assert await stream.__anext__() == live.KEEPALIVE
+    await stream.aclose()
+    assert len(live.hub) == 0
+
+@pytest.mark.anyio
+async def test_live_events_requires_login():
+    async with AsyncClient(app=app, base_url="http://localhost:8000") as ac:
+        response = await ac.get("/me/events")
+    assert response.status_code == 401
+
+@pytest.mark.anyio
+async def test_project_page_not_found(monkeypatch):
+    manager_id = '645a4bca08eca36c3778e6a1'
+    users.get_user_cache().set(manager_id, {
+        '_id': ObjectId(manager_id), 'role': 'project_manager',
+    })
+
+    async def missing(project_id):
+        # What get_project_by_id does for an id with no project.
+        return users.project_helper(None)
+
+    async def nothing(*args):
+        return []
+
+    monkeypatch.setattr(users, 'get_project_by_id', missing)
+    monkeypatch.setattr(users, 'get_project_activities', nothing)
+    monkeypatch.setattr(navigation, 'get_snapshot', nothing)
+    cookies = {
+        'Authorization': users.create_session_token(
+            manager_id, 'project_manager'
+        ),
+    }
+    try:
+        async with AsyncClient(
+            app=app, base_url="http://localhost:8000", cookies=cookies
+        ) as ac:
+            for page in [
+                '/project/unknown', '/project/645a5064728af5c5703f5aff',
+            ]:
+                response = await ac.get(page)
+                assert response.status_code == 404, page
+    finally:
+        users.invalidate_user(manager_id)
+
+def test_page_cursors():
+    projects = [
+        {'deadline': f'2030-01-{day:02} 00:00:00', 'id': str(ObjectId())}
+        for day in range(1, 18)
+    ]
+    cursors = users.page_cursors(projects, 8)
+    assert cursors == [
+        None,
+        users.encode_project_cursor(projects[7]),
+        users.encode_project_cursor(projects[15]),
+    ]
+    assert users.page_cursors(projects[:16], 8) == cursors[:2]
+    assert users.page_cursors([], 8) == [None]
+
+@pytest.mark.anyio
+async def test_projects_page_links_use_cursors(monkeypatch):
+    manager_id = '645a4bca08eca36c3778e6a1'
+    users.get_user_cache().set(manager_id, {
+        '_id': ObjectId(manager_id), 'role': 'project_manager',
+    })
+    projects = [
+        repository.ProjectRecord({
+            '_id': ObjectId(), 'project_name': f'Project {day}',
+            'editor': '645a4bca08eca36c3778e6a0', 'project_status': 'created',
+            'deadline': datetime.datetime(2030, 1, day),
+        })
+        for day in range(1, 18)
+    ]
+    snapshot = navigation.NavigationSnapshot([], [], projects, [])
+    queries = []
+
+    async def get_snapshot():
+        return snapshot
+
+    async def get_projects(status, limit=0, cursor=None, **options):
+        assert 'skip' not in options
+        queries.append(cursor)
+        return projects[16:]
+
+    class Loader:
+        async def load_many(self, user_ids):
+            return [None] * len(user_ids)
+
+    monkeypatch.setattr(navigation, 'get_snapshot', get_snapshot)
+    monkeypatch.setattr(users, 'get_projects', get_projects)
+    monkeypatch.setattr(users, 'UserLoader', Loader)
+    cookies = {
+        'Authorization': users.create_session_token(
+            manager_id, 'project_manager'
+        ),
+    }
+    try:
+        async with AsyncClient(
+            app=app, base_url="http://localhost:8000", cookies=cookies
+        ) as ac:
+            response = await ac.get('/projects?page=3')
+        assert response.status_code == 200
+        cursor = users.encode_project_cursor(projects[15])
+        assert queries == [cursor]
+        assert f'/projects?page=3&cursor={cursor}' in response.text
+        assert (
+            '/projects?page=2&cursor='
+            f'{users.encode_project_cursor(projects[7])}'
+        ) in response.text
+        assert '/projects?page=1"' in response.text
+    finally:
+        users.invalidate_user(manager_id)
+
+@pytest.mark.anyio
+async def test_user_pages_not_found(monkeypatch):
+    manager_id = '645a4bca08eca36c3778e6a1'
+    users.get_user_cache().set(manager_id, {
+        '_id': ObjectId(manager_id), 'role': 'project_manager',
+    })
+    editor_id = '645a4bca08eca36c3778e6a0'
+
+    class Loader:
+        async def load(self, user_id):
+            if user_id == editor_id:
+                return {'id': editor_id, 'role': 'chief_editor'}
+
+    async def nothing(*args):
+        return None
+
+    monkeypatch.setattr(users, 'UserLoader', Loader)
+    monkeypatch.setattr(users, 'get_user_activities', nothing)
+    monkeypatch.setattr(navigation, 'get_snapshot', nothing)
+    cookies = {
+        'Authorization': users.create_session_token(
+            manager_id, 'project_manager'
+        ),
+    }
+    try:
+        async with AsyncClient(
+            app=app, base_url="http://localhost:8000", cookies=cookies
+        ) as ac:
+            for page in [
+                '/translator/unknown', f'/translator/{editor_id}',
+                '/translator/645a4bca08eca36c3778e6a2',
+                '/chief_editor/unknown', '/chief_editor/645a4bca08eca36c3778e6a2',
+            ]:
+                response = await ac.get(page)
+                assert response.status_code == 404, page
+    finally:
+        users.invalidate_user(manager_id)
+
+def test_assets_accepted_encodings():
+    assert assets.accepted_encodings('gzip, br;q=0.9') == {'gzip', 'br'}
+    assert assets.accepted_encodings('br;q=0, gzip') == {'gzip'}
+
+@pytest.mark.anyio
+async def test_assets_build_and_serve(tmp_path):
+    css = b'body { color: black; }\n' * 50
+    (tmp_path / 'site.css').write_bytes(css)
+    manifest = assets.build(str(tmp_path))
+    assert manifest['site.css'] == f"dist/{assets.fingerprint('site.css', css)}"
+    assert assets.load_manifest(str(tmp_path)) == manifest
+    static_app = assets.AssetFiles(directory=str(tmp_path))
+    async with AsyncClient(app=static_app, base_url='http://test') as ac:
+        response = await ac.get(
+            f"/{manifest['site.css']}", headers={'accept-encoding': 'gzip'}
+        )
+        assert response.headers['content-encoding'] == 'gzip'
+        assert response.headers['cache-control'] == assets.IMMUTABLE
+        assert response.content == css
+        response = await ac.get(
+            f"/{manifest['site.css']}", headers={'accept-encoding': 'identity'}
+        )
+        assert 'content-encoding' not in response.headers
+        assert response.content == css
+        response = await ac.get('/site.css')
+        assert response.headers['cache-control'] == assets.REVALIDATE
+
+def test_assets_build_rewrites_css_urls(tmp_path):
+    (tmp_path / 'ba.jpg').write_bytes(b'jpeg')
+    (tmp_path / 'site.css').write_bytes(
+        b'body { background: url(ba.jpg); }\n'
+        b'a { content: url("data:image/svg+xml,x"); }\n'
+    )
+    manifest = assets.build(str(tmp_path))
+    css = (tmp_path / manifest['site.css']).read_bytes()
+    hashed_image = manifest['ba.jpg'].removeprefix('dist/')
+    assert f'url({hashed_image})'.encode() in css
+    assert b'url("data:image/svg+xml,x")' in css
+    assert (tmp_path / 'dist' / hashed_image).exists()
+    assert assets.rewrite_css_urls(
+        'css/site.css', b"url('../ba.jpg?v=1')", manifest
+    ) == f"url('../{hashed_image}?v=1')".encode()
+
+def test_benchmark_dataset_deterministic():
+    from benchmarks import dataset
+    scale, all_users, projects, activities = dataset.generate(1000, seed=7)
+    assert (scale.projects, scale.translators, scale.chief_editors) == (
+        20, 10, 2
+    )
+    assert len(all_users) == 13
+    activities = list(activities)
+    assert len(activities) == 1000
+    again = dataset.generate(1000, seed=7)
+    assert again[2] == projects
+    assert list(again[3]) == activities
+    assert dataset.generate(1000, seed=8)[2] != projects
+    project_ids = {project['_id'] for project in projects}
+    assert all(activity['project_id'] in project_ids for activity in activities)
+
+def test_benchmark_database_is_separate():
+    from benchmarks import dataset
+    for name in (database.APP_DATABASE, database.TEST_DATABASE):
+        with pytest.raises(SystemExit):
+            dataset.use_benchmark_database(name)
+    try:
+        dataset.use_benchmark_database()
+        assert database.users_collection.database.name == 'benchmark'
+    finally:
+        database.use_database(None)
+    assert database.users_collection.database.name == database.TEST_DATABASE
+
+def test_timing_command_timer():
+    event = type('Event', (), {'command_name': 'find', 'duration_micros': 1500})
+    timing.command_timer.succeeded(event)
+    request_timing = timing.RequestTiming('1', 'GET', '/projects')
+    token = timing.current.set(request_timing)
+    try:
+        timing.command_timer.succeeded(event)
+        timing.command_timer.failed(event)
+    finally:
+        timing.current.reset(token)
+    assert request_timing.phases['mongo'] == (3.0, 2)
+    assert request_timing.commands['find'] == (3.0, 2)
+    header = request_timing.server_timing({'auth': 1.0})
+    assert 'mongo;dur=3.0;desc="2x"' in header
+    assert 'page-auth;dur=1.0' in header
+    assert 'total;dur=' in header
+
+@pytest.mark.anyio
+async def test_timing_middleware():
+    from fastapi import FastAPI
+    traced = FastAPI()
+    traced.add_middleware(timing.TimingMiddleware, sample_rate=1.0)
+
+    @traced.get('/page/{name}')
+    async def page(request: Request, name: str):
+        return view.registration_page(request, False)
+
+    untraced = FastAPI()
+    untraced.add_middleware(timing.TimingMiddleware, sample_rate=0.0)
+    untraced.add_api_route('/page/{name}', page)
+
+    async with AsyncClient(app=traced, base_url='http://test') as ac:
+        response = await ac.get('/page/a', headers={'x-request-id': 'abc'})
+    assert response.headers['x-request-id'] == 'abc'
+    assert 'render;dur=' in response.headers['server-timing']
+    async with AsyncClient(app=untraced, base_url='http://test') as ac:
+        response = await ac.get('/page/a')
+    assert 'server-timing' not in response.headers
+
+def test_metrics_histogram():
+    histogram = metrics.Histogram(
+        'test_seconds', 'Test.', ('route',), buckets=(0.1, 1.0)
+    )
+    metrics._metrics.remove(histogram)
+    histogram.observe(0.1, '/a')
+    histogram.observe(0.5, '/a')
+    histogram.observe(7, '/a')
+    assert histogram.count('/a') == 3
+    assert histogram.samples() == [
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1.0"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 3',
+        'test_seconds_sum{route="/a"} 7.6',
+        'test_seconds_count{route="/a"} 3',
+    ]
+
+@pytest.mark.anyio
+async def test_metrics_endpoint():
+    async with AsyncClient(app=app, base_url="http://localhost:8000") as ac:
+        await ac.get('/metrics')
+        response = await ac.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert (
+        'http_request_duration_seconds_count'
+        '{method="GET",route="/metrics",status="200"}'
+    ) in response.text
+    assert 'cache_hit_ratio{cache="users"}' in response.text
+    assert '# TYPE mongo_pool_max_size gauge' in response.text
+
+@pytest.mark.anyio
+async def test_metrics_loop_lag():
+    probe = asyncio.ensure_future(metrics.sample_loop_lag(0.01))
+    await asyncio.sleep(0)
+    time.sleep(0.05)
+    for _ in range(3):
+        await asyncio.sleep(0)
+    probe.cancel()
+    assert metrics.loop_lag.value() >= 0.03
+
+def test_database_client_options():
+    settings = config.Settings(
+        mongo_max_pool_size=10, mongo_min_pool_size=2,
+        mongo_wait_queue_timeout_ms=500, mongo_socket_timeout_ms=0,
+        mongo_compressors='zlib, bogus', mongo_read_concern='majority',
+    )
+    options = database.client_options(settings)
+    assert options['maxPoolSize'] == 10
+    assert options['minPoolSize'] == 2
+    assert options['waitQueueTimeoutMS'] == 500
+    assert 'socketTimeoutMS' not in options
+    assert options['compressors'] == ['zlib']
+    assert options['readConcernLevel'] == 'majority'
+    assert database.mongo_uri(settings).endswith(
+        f'@mongo:27017/{settings.mongo_initdb_database}?authSource=admin'
+    )
+
+def test_lazy_settings():
+    assert config.settings.session_ttl == config.get_settings().session_ttl
+    assert config.get_settings() is config.get_settings()
+
+def test_database_list_read_preference():
+    settings = config.Settings(mongo_list_max_staleness=120)
+    preference = database.list_read_preference(settings)
+    assert preference.mongos_mode == 'secondaryPreferred'
+    assert preference.max_staleness == 120
+    settings = config.Settings(mongo_list_read_preference='primary')
+    assert database.list_read_preference(settings).mongos_mode == 'primary'
+    collection = database.list_reads(database.projects_collection)
+    assert collection.read_preference.mongos_mode == 'secondaryPreferred'
+
 def test_get_random_string_len_12():
     result = users.get_random_string(12)
     assert type(result) is str
@@ -106,10 +1075,79 @@ async def test_create_user_token():
     assert type(result['access_token']) is str
     assert type(result['expires']) is datetime.datetime
 
+def test_session_token_valid():
+    token = users.create_session_token('643bf7db29a8f8dcc00a1bd9', 'translator')
+    result = users.decode_session_token(token)
+    assert result['id'] == '643bf7db29a8f8dcc00a1bd9'
+    assert result['role'] == 'translator'
+
+def test_session_token_tampered():
+    token = users.create_session_token('643bf7db29a8f8dcc00a1bd9', 'translator')
+    forged = users.create_session_token(
+        '643bf7db29a8f8dcc00a1bd9', 'project_manager'
+    )
+    assert users.decode_session_token(
+        forged.split('.')[0] + '.' + token.split('.')[1]
+    ) is None
+    assert users.decode_session_token("{'access_token': 'abc'}") is None
+
+def test_session_token_expired():
+    token = users.create_session_token(
+        '643bf7db29a8f8dcc00a1bd9', 'translator', ttl=-1
+    )
+    assert users.decode_session_token(token) is None
+
+def test_session_key(monkeypatch):
+    monkeypatch.setattr(config.get_settings(), 'session_secret', '')
+    monkeypatch.setattr(users, '_random_session_key', None)
+    key = users.session_key()
+    assert len(key) == 32 and users.session_key() == key
+    # Not derived from the Mongo root password.
+    monkeypatch.setattr(users, '_random_session_key', None)
+    assert users.session_key() != key
+    monkeypatch.setattr(config.get_settings(), 'session_secret', 'configured')
+    assert users.session_key() == b'configured'
+
+def test_ttl_cache():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+def test_caches_read_settings_on_first_use(monkeypatch):
+    monkeypatch.setattr(users, '_user_cache', None)
+    monkeypatch.setattr(exporter, '_username_cache', None)
+    monkeypatch.setattr(config.get_settings(), 'user_cache_size', 3)
+    monkeypatch.setattr(config.get_settings(), 'export_name_cache_size', 5)
+    assert users.get_user_cache().maxsize == 3
+    assert users.get_user_cache() is users.get_user_cache()
+    assert exporter.get_username_cache().maxsize == 5
+
 def test_hash_password():
     result = users.hash_password('manager_project')
     assert type(result) is str
 
+@pytest.mark.anyio
+async def test_hash_password_async():
+    result = await users.hash_password_async('manager_project', 'VgGdZKkexOUy')
+    assert result == users.hash_password('manager_project', 'VgGdZKkexOUy')
+
+@pytest.mark.anyio
+async def test_validate_password_async():
+    hashed_password = 'VgGdZKkexOUy$e1f631580bc78759077f5398a4b4661c846e0f3ddea4ae992b51991fc6ae95d5'
+    assert await users.validate_password_async(
+        'manager_project', hashed_password
+    ) == True
+    assert await users.validate_password_async(
+        'manareg_project', hashed_password
+    ) == False
+
 def test_user_helper_valid():
     user = {
         '_id': ObjectId("643bf7db29a8f8dcc00a1bd9"),
@@ -148,6 +1186,67 @@ def test_project_helper_valid():
         'id': '643bf7db29a8f8dcc00a1bd9'
     }
 
+def test_project_helper_progress():
+    project = {
+        'project_name': 'Test',
+        'editor': '643bf7db29a8f8dcc00a1bd9',
+        'project_status': 'created',
+        'deadline': "2023-04-30T19:36:40.236Z",
+        '_id': '643bf7db29a8f8dcc00a1bd9',
+        'activity_total': 4,
+        'activity_counts': {'created': 3, 'finished': 1},
+        'completeness_sum': 1.5,
+        'next_deadline': None,
+    }
+    assert users.project_helper(project)['progress'] == {
+        'activity_total': 4,
+        'activity_counts': {'created': 3, 'finished': 1},
+        'completeness': 0.375,
+        'next_deadline': None,
+    }
+
+def test_rollup_update():
+    deadline = datetime.datetime(2024, 5, 1)
+    [stage] = rollups.rollup_update(
+        {'activity_total': 1, 'activity_counts.created': 1}, deadline
+    )
+    assert stage['$set']['activity_total'] == {
+        '$add': [{'$ifNull': ['$activity_total', 0]}, 1]
+    }
+    assert stage['$set']['next_deadline'] == {
+        '$min': ['$next_deadline', deadline]
+    }
+    assert 'next_deadline' not in rollups.rollup_update({})[0]['$set']
+
+def test_rollup_status_counter():
+    assert rollups.status_counter('finished') == 'activity_counts.finished'
+    for status in ('$where', 'a.b', None, 'archived'):
+        assert rollups.status_counter(status) == 'activity_counts.unknown'
+
+@pytest.mark.anyio
+async def test_rollups_replace_null_next_deadline():
+    project_id = ObjectId()
+    await database.projects_collection.insert_one({
+        '_id': project_id, 'activity_total': 0, 'activity_counts': {},
+        'completeness_sum': 0, 'next_deadline': None,
+    })
+    deadline = datetime.datetime(2024, 5, 1)
+    await rollups.activity_created({
+        'project_id': project_id, 'status': 'created', 'completeness': 0,
+        'deadline': deadline,
+    })
+    project = await database.projects_collection.find_one({'_id': project_id})
+    assert project['next_deadline'] == deadline
+    assert project['activity_counts'] == {'created': 1}
+    await rollups.activity_created({
+        'project_id': project_id, 'status': 'created', 'completeness': 0,
+        'deadline': deadline + datetime.timedelta(days=1),
+    })
+    project = await database.projects_collection.find_one({'_id': project_id})
+    assert project['next_deadline'] == deadline
+    assert project['activity_total'] == 2
+    await database.projects_collection.delete_one({'_id': project_id})
+
 def test_project_helper_invalid():
     project = {
         'editor': '643bf7db29a8f8dcc00a1bd9',
@@ -434,6 +1533,43 @@ async def test_change_chief_editor():
     assert response_change_chief_editor.status_code == 303
     assert response_change_chief_editor.url == 'http://localhost:8000/project/change_chief_editor'
     
+@pytest.mark.anyio
+async def test_user_loader_batches_one_tick(monkeypatch):
+    user_ids = [str(ObjectId()) for _ in range(3)]
+    queries = []
+
+    class Collection:
+        def find(self, query, projection, **options):
+            queries.append(query)
+            async def documents():
+                for object_id in query['_id']['$in']:
+                    yield {'_id': object_id, 'username': str(object_id)}
+            return documents()
+
+    monkeypatch.setattr(database, 'users_collection', Collection())
+    loader = users.UserLoader()
+    found = await asyncio.gather(
+        loader.load(user_ids[0]), loader.load(user_ids[1]),
+        loader.load('aaaa'), loader.load(user_ids[0]),
+        loader.load_many(user_ids[1:]),
+    )
+    assert len(queries) == 1
+    assert queries[0]['_id']['$in'] == [
+        ObjectId(user_id) for user_id in user_ids
+    ]
+    assert [user and user['username'] for user in found[:4]] == [
+        user_ids[0], user_ids[1], None, user_ids[0],
+    ]
+    assert [user['username'] for user in found[4]] == user_ids[1:]
+    await loader.load(user_ids[2])
+    assert len(queries) == 1
+
+@pytest.mark.anyio
+async def test_user_loader_invalid_ids():
+    loader = users.UserLoader()
+    result = await loader.load_many(['aaaa', None, 'aaaa'])
+    assert result == [None, None, None]
+
 @pytest.mark.anyio
 async def test_get_user_activities():
     result = await users.get_user_activities("645a4bca08eca36c3778e6a0", 'chief_editor')
@@ -444,6 +1580,22 @@ async def test_get_activities_of_the_project():
     result = await users.get_activities_of_the_project('test')
     assert type(result) == type([])
 
+@pytest.mark.anyio
+async def test_get_project_activities():
+    result = await users.get_project_activities('645a5064728af5c5703f5aeb')
+    assert type(result) == type([])
+
+@pytest.mark.anyio
+async def test_create_project_unit():
+    project = {
+        'project_name': str(ObjectId()),
+        'editor': '645a4bca08eca36c3778e6a0',
+        'deadline': datetime.datetime(2030, 1, 1, 0, 0),
+    }
+    result = await users.create_project(models.ProjectCreate(**project))
+    assert type(result) is str
+    assert (await users.get_project_by_id(result))['status'] == 'created'
+
 @pytest.mark.anyio
 async def test_get_current_user():
     result = await users.get_current_user()
@@ -553,17 +1705,47 @@ async def test_create_user_invalid():
 async def test_get_projects_finished():
     result = await users.get_projects('finished')
     print(result)
-    assert result == [
+    assert [project.as_dict() for project in result] == [
         {
             'project_name': '645c90164496e85f3d4aa29f', 
             'editor': '645a4bca08eca36c3778e6a0', 
             'status': 'finished', 
-            'deadline': '2022-08-05 00:00:00', 
-            'id': '645c90164496e85f3d4aa2a0'
+            'deadline': datetime.datetime(2022, 8, 5, 0, 0), 
+            'id': '645c90164496e85f3d4aa2a0',
+            'progress': None
         }
     ]
 
 
+def test_project_cursor():
+    cursor = users.encode_project_cursor({
+        'deadline': '2023-05-31 00:00:00',
+        'id': '645a5064728af5c5703f5aeb'
+    })
+    assert users.decode_project_cursor(cursor) == (
+        datetime.datetime(2023, 5, 31, 0, 0),
+        ObjectId('645a5064728af5c5703f5aeb')
+    )
+    malformed = [
+        'garbage!', 'Zm9v', users._b64encode(b'2023-05-31|nope'),
+        users._b64encode(b'yesterday|645a5064728af5c5703f5aeb'),
+        users._b64encode(b'\xff\xfe'),
+    ]
+    for cursor in malformed:
+        with pytest.raises(ValueError):
+            users.decode_project_cursor(cursor)
+
+@pytest.mark.anyio
+async def test_get_projects_page():
+    result = await users.get_projects('created', limit=1)
+    assert len(result) <= 1
+
+@pytest.mark.anyio
+async def test_get_projects_secondary_ok():
+    result = await users.get_projects('finished', secondary_ok=True)
+    assert type(result) == type([])
+    assert await users.count_projects('finished', secondary_ok=True) >= 0
+
 @pytest.mark.anyio
 async def test_get_projects_created():
     result = await users.get_projects('created')
@@ -592,6 +1774,96 @@ async def test_edit_activity_valid():
     )
     assert result == 1
 
+@pytest.mark.anyio
+async def test_finish_activity():
+    activity = {
+        'activity_name': 'Finish me',
+        'project_name': 'test',
+        'project_id': None,
+        'translators': '645c90abc6520459d2080bb1',
+        'editor': '645a4bca08eca36c3778e6a0',
+        'deadline': datetime.datetime(2030, 1, 1),
+        'project_status': 'in work',
+        'completeness': 0.0,
+        'status': 'created',
+    }
+    activity_id = await users.create_activity(models.ActivityModel(**activity))
+    finished_at = datetime.datetime(2029, 12, 31, 12)
+    assert await users.finish_activity(activity_id, finished_at) == 1
+    assert await users.finish_activity(activity_id) == 0
+    document = await database.activities_collection.find_one(
+        {'_id': ObjectId(activity_id)}
+    )
+    assert document['status'] == 'finished'
+    assert document['finished_at'] == finished_at
+    await database.activities_collection.delete_one({'_id': document['_id']})
+
+@pytest.mark.anyio
+async def test_credit_user_and_rescore():
+    user = await database.users_collection.insert_one({
+        'login': 'efficiency_test', 'username': 'Efficiency',
+        'role': 'translator',
+    })
+    user_id = str(user.inserted_id)
+    try:
+        await efficiency.credit_user(
+            user_id, True, datetime.datetime(2023, 5, 1)
+        )
+        await efficiency.credit_user(
+            user_id, False, datetime.datetime(2023, 5, 8)
+        )
+        document = await database.users_collection.find_one(user.inserted_id)
+        assert document['efficiency_stats'] == {
+            'finished': 2, 'on_time': 1,
+            'first_finished_at': datetime.datetime(2023, 5, 1),
+        }
+        assert document['on_time_ratio'] == 0.5
+        assert user_id in await efficiency.rescore(
+            datetime.datetime(2023, 5, 29)
+        )
+        document = await database.users_collection.find_one(user.inserted_id)
+        assert document['throughput_per_week'] == 0.5
+        assert document['efficiency'] == 0.05
+    finally:
+        await database.users_collection.delete_one({'_id': user.inserted_id})
+
+@pytest.mark.anyio
+async def test_efficiency_rebuild_stats():
+    user = await database.users_collection.insert_one({
+        'login': 'rebuild_test', 'username': 'Rebuild', 'role': 'translator',
+        'efficiency_stats': {'finished': 40, 'on_time': 0},
+    })
+    user_id = str(user.inserted_id)
+    activities = await database.activities_collection.insert_many([
+        {
+            'activity_name': 'Rebuilt', 'translators': user_id, 'editor': '',
+            'status': 'finished', 'deadline': datetime.datetime(2023, 5, 1),
+            'finished_at': datetime.datetime(2023, 5, 1, 18),
+        },
+        {
+            'activity_name': 'Rebuilt', 'translators': user_id, 'editor': None,
+            'status': 'finished', 'deadline': datetime.datetime(2023, 5, 1),
+            'finished_at': datetime.datetime(2023, 5, 2),
+        },
+        {
+            'activity_name': 'Rebuilt', 'translators': user_id,
+            'status': 'created', 'deadline': datetime.datetime(2023, 5, 1),
+        },
+    ])
+    try:
+        await efficiency.rebuild_stats(datetime.datetime(2023, 5, 29))
+        document = await database.users_collection.find_one(user.inserted_id)
+        assert document['efficiency_stats'] == {
+            'finished': 2, 'on_time': 1,
+            'first_finished_at': datetime.datetime(2023, 5, 1, 18),
+        }
+        assert document['on_time_ratio'] == 0.5
+    finally:
+        await database.users_collection.delete_one({'_id': user.inserted_id})
+        await database.activities_collection.delete_many(
+            {'_id': {'$in': activities.inserted_ids}}
+        )
+
 @pytest.mark.anyio
 async def test_edit_activity_invalid():
     activity = {